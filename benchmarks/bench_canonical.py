@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of org name canonicalization: time to canonicalize growing numbers of names, which should grow
+about linearly, and the number of canonical entities found.
+
+    python benchmarks/bench_canonical.py --names 10000 100000 300000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'web' / 'app'))
+
+from canonical import Canonicalizer
+
+COMMON_WORDS = ['University', 'Institute', 'National', 'Health', 'Research', 'Foundation', 'Pharmaceuticals',
+                'Hospital', 'Center', 'Society']
+LEGAL_FORMS = ['', ' Inc.', ' Ltd', ' LLC', ' Corporation']
+
+
+def make_names(n_names, n_words, rng):
+    """
+    Org names made of a common word and one to three words of a vocabulary with a long tail, some of them
+    repeated with another legal form, another case or a typo.
+    """
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 10))).title()
+                  for _ in range(n_words)]
+    names = []
+    while len(names) < n_names:
+        if names and rng.random() < 0.2:
+            name = rng.choice(names)
+            variant = rng.randrange(3)
+            if variant == 0:
+                name += rng.choice(LEGAL_FORMS)
+            elif variant == 1:
+                name = name.upper()
+            else:
+                i = rng.randrange(len(name))
+                name = name[:i] + name[i + 1:]
+        else:
+            words = [vocabulary[min(int(rng.paretovariate(1.1)) - 1, n_words - 1)] for _ in range(rng.randint(1, 3))]
+            name = ' '.join([rng.choice(COMMON_WORDS)] + words)
+        names.append(name)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--names', type=int, nargs='+', default=[10000, 100000, 300000])
+    parser.add_argument('--words', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    names = make_names(max(args.names), args.words, random.Random(args.seed))
+    print(f'{"names":>8} {"entities":>9} {"total s":>9} {"us/name":>9}')
+    for n_names in args.names:
+        canonicalizer = Canonicalizer()
+        start = time.perf_counter()
+        for name in names[:n_names]:
+            canonicalizer.add(name)
+        total = time.perf_counter() - start
+        print(f'{n_names:>8} {len(canonicalizer):>9} {total:9.2f} {total / n_names * 1e6:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
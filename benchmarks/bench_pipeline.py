@@ -0,0 +1,191 @@
+"""
+End-to-end load test of the web app and the listener against a local Redis and the fake model server of
+fake_openai.py. Each run uploads a synthetic CSV, follows the session on /events until its archive is ready and
+reports the throughput, the p50/p99 time for a paper's results to be complete and the peak memory of the services.
+
+    python benchmarks/bench_pipeline.py --papers 10 1000 10000 50000 --latency-ms 800 --error-rate 0.01
+
+Redis must be running at REDIS_HOST:REDIS_PORT; use a scratch instance, the job streams are shared with any other
+listener connected to it. The listener and the web app inherit the environment, so their settings
+(AUTOSCALE_*, INFERENCE_CONCURRENCY, COMBINED_MODE, ...) can be varied between runs. Memory is read from /proc,
+so it is only reported on Linux.
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+
+import fake_openai
+
+ROOT = Path(__file__).parent.parent
+CSV_COLUMNS = ['Title', 'Author Name', 'Affiliation', 'Email', 'Disclosure Statement']
+
+
+def make_csv(n_papers, authors_per_paper):
+    """
+    A tab-separated upload with one row per author. Disclosures are unique so that the inference cache does not
+    answer for the model.
+    """
+    lines = ['\t'.join(CSV_COLUMNS)]
+    for paper in range(n_papers):
+        disclosure = (f'Paper {paper} was funded by the National Cancer Institute. Author 0 received research grant '
+                      f'funds directly from the National Cancer Institute. The other authors declare no conflict '
+                      f'of interest.')
+        for author in range(authors_per_paper):
+            lines.append('\t'.join([f'Title {paper}', f'Author {author}', 'McGill University',
+                                    f'author{author}@mcgill.ca', disclosure]))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def process_tree(pid):
+    pids, pending = [], [pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        for children in Path(f'/proc/{pid}/task').glob('*/children'):
+            try:
+                pending += [int(child) for child in children.read_text().split()]
+            except OSError:
+                pass
+    return pids
+
+
+def rss_bytes(pid):
+    total = 0
+    for pid in process_tree(pid):
+        try:
+            for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of process trees in the background and keeps the peak of each.
+    """
+
+    def __init__(self, processes, interval=0.2):
+        self.processes = processes
+        self.interval = interval
+        self.peaks = dict.fromkeys(processes, 0)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for name, process in self.processes.items():
+                self.peaks[name] = max(self.peaks[name], rss_bytes(process.pid))
+
+    def reset(self):
+        self.peaks = dict.fromkeys(self.processes, 0)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+def start_services(web_port, model_port):
+    env = dict(os.environ, OPENAI_BASE_URL=f'http://127.0.0.1:{model_port}/v1', METRICS_PORT='0')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.setdefault('INFERENCE_CACHE_TTL', '0')
+    listener = subprocess.Popen([sys.executable, '-c', 'import listener; listener.supervise("bench")'],
+                                cwd=ROOT / 'core' / 'app', env=env)
+    # The web app serves the frontend assets from dist/assets in its working directory
+    workdir = tempfile.mkdtemp()
+    (Path(workdir) / 'dist' / 'assets').mkdir(parents=True)
+    web = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:app', '--app-dir', str(ROOT / 'web' / 'app'),
+                            '--port', str(web_port), '--log-level', 'warning'], cwd=workdir, env=env)
+    return listener, web
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{base_url}/metrics', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Web app did not start at {base_url}')
+
+
+def run_session(base_url, n_papers, authors_per_paper, timeout):
+    """
+    Upload a CSV and follow its session. Returns the total time and the time at which each paper had both results.
+    """
+    content = make_csv(n_papers, authors_per_paper)
+    start = time.perf_counter()
+    response = requests.post(f'{base_url}/upload', files={'file': ('bench.csv', io.BytesIO(content), 'text/csv')})
+    response.raise_for_status()
+    session_id = response.json()['session_id']
+    received, completed = {}, []
+    with requests.get(f'{base_url}/events', params={'session_id': session_id}, stream=True, timeout=timeout) as events:
+        event = None
+        for line in events.iter_lines(decode_unicode=True):
+            if line.startswith('event: '):
+                event = line.removeprefix('event: ')
+            elif line.startswith('data: ') and event in ('received_study', 'received_author'):
+                data_id = json.loads(line.removeprefix('data: '))['id']
+                received[data_id] = received.get(data_id, 0) + 1
+                if received[data_id] == 2:
+                    completed.append(time.perf_counter() - start)
+            elif line.startswith('data: ') and event == 'done':
+                break
+    return time.perf_counter() - start, completed
+
+
+def report(n_papers, total, completed, peaks):
+    p50, p99 = np.percentile(completed, [50, 99]) if completed else (float('nan'), float('nan'))
+    memory = ' '.join(f'{peak / 2 ** 20:9.0f}' for peak in peaks.values())
+    print(f'{n_papers:>8} {total:9.1f} {n_papers / total:11.1f} {p50:9.1f} {p99:9.1f} {memory}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, nargs='+', default=[10, 1000, 10000, 50000])
+    parser.add_argument('--authors-per-paper', type=int, default=3)
+    parser.add_argument('--web-port', type=int, default=8765)
+    parser.add_argument('--model-port', type=int, default=8766)
+    parser.add_argument('--timeout', type=float, default=3600)
+    fake_openai.add_arguments(parser)
+    args = parser.parse_args()
+    model_server = fake_openai.serve(fake_openai.model_from_arguments(args), args.model_port)
+    listener, web = start_services(args.web_port, args.model_port)
+    sampler = MemorySampler({'web': web, 'listener': listener})
+    base_url = f'http://127.0.0.1:{args.web_port}'
+    try:
+        wait_until_up(base_url)
+        sampler.start()
+        print(f'{"papers":>8} {"total s":>9} {"papers/s":>11} {"p50 s":>9} {"p99 s":>9} '
+              f'{"web MB":>9} {"core MB":>9}')
+        for n_papers in args.papers:
+            sampler.reset()
+            total, completed = run_session(base_url, n_papers, args.authors_per_paper, args.timeout)
+            report(n_papers, total, completed, sampler.peaks)
+    finally:
+        sampler.stop()
+        for process in (web, listener):
+            process.terminate()
+        for process in (web, listener):
+            process.wait()
+        model_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Micro-benchmark of the result post-processing: the original nested loops, the row-at-a-time builders and
+the columnar pipeline. Every run starts with a cold infer_is_funded cache, like a web worker meeting the orgs of a
+session for the first time.
+
+    python benchmarks/bench_postprocess.py --relationships 100000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'web' / 'app'))
+
+import pandas as pd
+from influencemapper.util import infer_is_funded as uncached_infer_is_funded
+
+from postprocess import AuthorResultsBuilder, StudyResultsBuilder, author_details, author_tables, infer_is_funded, \
+    study_tables
+
+STUDY_RELATIONSHIPS = ['Perform analysis', 'Collect data', 'Coordinate the study', 'Design the study',
+                       'Fund the study', 'Participate in the study', 'Review the study', 'Supply the study',
+                       'Supply data to the study', 'Support the study', 'Write the study', 'Other']
+AUTHOR_RELATIONSHIPS = ['Honorarium', 'Consultant', 'Board member', 'Employee of', 'Equity', 'Personal fees',
+                        'Received research grant funds directly', 'Received travel support', 'Speakers’ bureau']
+
+
+def make_study_results(n_relationships, n_orgs, rng):
+    results = []
+    while n_relationships > 0:
+        study_info = []
+        for org in rng.sample(range(n_orgs), rng.randint(1, 4)):
+            relationships = [{'relationship_type': rel, 'relationship_indication': rng.choice(['Yes', 'No'])}
+                             for rel in rng.sample(STUDY_RELATIONSHIPS, rng.randint(1, 3))]
+            study_info.append({'org_name': f'Organization {org}', 'relationships': relationships})
+            n_relationships -= len(relationships)
+        results.append({'id': len(results), 'source': {'title': f'Title {len(results)}', 'disclosure': 'Disclosure'},
+                        'payload': {'study_info': study_info}, 'error': None, 'channel': 'study_channel'})
+    return results
+
+
+def make_author_results(n_relationships, n_orgs, rng):
+    results = []
+    while n_relationships > 0:
+        authors = [f'Author {rng.randrange(n_orgs * 2)}' for _ in range(rng.randint(1, 4))]
+        author_info = []
+        for author in authors:
+            organization = [{'org_name': f'Organization {org}',
+                             'relationship_type': rng.sample(AUTHOR_RELATIONSHIPS, rng.randint(1, 3))}
+                            for org in rng.sample(range(n_orgs), rng.randint(1, 3))]
+            author_info.append({'author_name': author, 'organization': organization})
+            n_relationships -= sum(len(org['relationship_type']) for org in organization)
+        source = {'title': f'Title {len(results)}', 'disclosure': 'Disclosure', 'authors': authors,
+                  'affiliation': ['McGill University'] * len(authors), 'email': [''] * len(authors)}
+        results.append({'id': len(results), 'source': source, 'payload': {'author_info': author_info},
+                        'error': None, 'channel': 'author_channel'})
+    return results
+
+
+def original_study_tables(results):
+    """
+    The implementation postprocess_study_results had before the columnar pipeline: two passes over the results,
+    set() based IDs and an uncached infer_is_funded call per org.
+    """
+    sources, orgs, rel_types, study_results = [], [], [], []
+    for result in results:
+        for study_info in result['payload']['study_info']:
+            orgs.append(study_info['org_name'])
+            for rel in study_info['relationships']:
+                rel_types.append(rel['relationship_type'])
+        sources.append((result['id'], result['source']['title'], result['source']['disclosure']))
+    df_source = pd.DataFrame(sources, columns=['id', 'title', 'disclosure'])
+    df_ent = pd.DataFrame([(f'ent-{i}', org, uncached_infer_is_funded(org)) for i, org in enumerate(set(orgs))],
+                          columns=['ent_id', 'org_name', 'ent-ind support'])
+    df_rel_type = pd.DataFrame([(f'rel-{i}', rel) for i, rel in enumerate(set(rel_types))],
+                               columns=['rel_id', 'relationship_type'])
+    dict_ent = dict(zip(df_ent['org_name'], df_ent['ent_id']))
+    dict_rel_type = dict(zip(df_rel_type['relationship_type'], df_rel_type['rel_id']))
+    for result in results:
+        for study_info in result['payload']['study_info']:
+            for rel in study_info['relationships']:
+                study_results.append({
+                    'res_id': f'res_{len(study_results)}',
+                    'source': result['id'],
+                    'entity': dict_ent[study_info['org_name']],
+                    'relationship_type': dict_rel_type[rel['relationship_type']],
+                    'relationship_indication': rel['relationship_indication']
+                })
+    df_results = pd.DataFrame(study_results, columns=['res_id', 'source', 'entity', 'relationship_type',
+                                                      'relationship_indication'])
+    return df_source, df_ent, df_rel_type, df_results
+
+
+def original_author_tables(results):
+    """
+    The implementation postprocess_author_results had before the columnar pipeline.
+    """
+    sources, orgs, authors, author_results, rel_types = [], [], [], [], []
+    for result in results:
+        for author_info in result['payload']['author_info']:
+            for rel in author_info['organization']:
+                orgs.append(rel['org_name'])
+                rel_types.extend(rel['relationship_type'])
+            authors.append((author_info['author_name'], *author_details(author_info, result['source'])))
+        sources.append((result['id'], result['source']['title'], result['source']['disclosure']))
+    df_source = pd.DataFrame(sources, columns=['id', 'title', 'disclosure'])
+    df_ent = pd.DataFrame([(f'ent-{i}', org, uncached_infer_is_funded(org)) for i, org in enumerate(set(orgs))],
+                          columns=['ent_id', 'org_name', 'ent-ind support'])
+    df_author = pd.DataFrame([(f'author-{i}', *author) for i, author in enumerate(set(authors))],
+                             columns=['author_id', 'author_name', 'affiliation', 'email'])
+    df_rel_type = pd.DataFrame([(f'rel-{i}', rel) for i, rel in enumerate(set(rel_types))],
+                               columns=['rel_id', 'relationship_type'])
+    dict_ent = dict(zip(df_ent['org_name'], df_ent['ent_id']))
+    dict_author = dict(zip(df_author['author_name'], df_author['author_id']))
+    dict_rel_type = dict(zip(df_rel_type['relationship_type'], df_rel_type['rel_id']))
+    for result in results:
+        for author_info in result['payload']['author_info']:
+            for rel in author_info['organization']:
+                for relationship in rel['relationship_type']:
+                    author_results.append({
+                        'res_id': f'res_{len(author_results)}',
+                        'source': result['id'],
+                        'entity': dict_ent[rel['org_name']],
+                        'author': dict_author[author_info['author_name']],
+                        'relationship_type': dict_rel_type[relationship]
+                    })
+    df_results = pd.DataFrame(author_results, columns=['res_id', 'source', 'entity', 'author', 'relationship_type'])
+    return df_source, df_ent, df_author, df_rel_type, df_results
+
+
+def build(builder_class, results):
+    builder = builder_class()
+    for result in results:
+        builder.add(result)
+    return builder.tables()
+
+
+def timed(label, function, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        infer_is_funded.cache_clear()
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    print(f'{label:<32} {best * 1000:10.1f} ms')
+    return best
+
+
+def compare(name, original_function, builder_class, columnar_function, results):
+    original = timed(f'{name}, original loops', original_function, results)
+    builder = timed(f'{name}, builder', build, builder_class, results)
+    columnar = timed(f'{name}, columnar', columnar_function, results)
+    print(f'{"speedup, builder / columnar":<32} {original / builder:9.1f}x {original / columnar:9.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--relationships', type=int, default=100000)
+    parser.add_argument('--orgs', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    study_results = make_study_results(args.relationships, args.orgs, rng)
+    author_results = make_author_results(args.relationships, args.orgs, rng)
+    print(f'{args.relationships} relationships, {len(study_results)} study and {len(author_results)} author results')
+    compare('study', original_study_tables, StudyResultsBuilder, study_tables, study_results)
+    compare('author', original_author_tables, AuthorResultsBuilder, author_tables, author_results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+An OpenAI-compatible chat completions server answering with synthetic structured outputs, with injectable
+latency and errors. The listener is pointed at it with OPENAI_BASE_URL.
+
+    python benchmarks/fake_openai.py --port 8766 --latency-ms 800 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A plausible answer for each top-level property of the result models
+ANSWERS = {
+    'study_info': [{'org_name': 'National Cancer Institute',
+                    'relationships': [{'relationship_type': 'Fund the study', 'relationship_indication': 'Yes'}]}],
+    'author_info': [{'author_name': 'Author 0',
+                     'organization': [{'org_name': 'National Cancer Institute',
+                                       'relationship_type': ['Received research grant funds directly']}]}]
+}
+PAPER_NUMBER = re.compile(r'Paper \d+:')
+
+
+def answer(schema, messages):
+    if 'papers' not in schema.get('properties', {}):
+        return {name: ANSWERS.get(name, []) for name in schema.get('properties', {})}
+    # A packed request: one answer per numbered paper of the user message
+    paper = schema['$defs'][schema['properties']['papers']['items']['$ref'].split('/')[-1]]
+    count = len(PAPER_NUMBER.findall(json.dumps(messages[-1])))
+    return {'papers': [dict({name: ANSWERS.get(name, []) for name in paper['properties'] if name != 'paper'},
+                            paper=number) for number in range(1, count + 1)]}
+
+
+class FakeModel:
+    """
+    Decides the latency and the outcome of each request. Latencies are drawn from a normal distribution around
+    latency_ms; error_rate of the requests fail with error_status and length_rate do not finish.
+    """
+
+    def __init__(self, latency_ms=500, jitter_ms=100, error_rate=0.0, error_status=500, length_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.length_rate = length_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def draw(self):
+        with self.lock:
+            self.requests += 1
+            latency = max(self.rng.gauss(self.latency_ms, self.jitter_ms), 0) / 1000
+            outcome = self.rng.random()
+        if outcome < self.error_rate:
+            return latency, 'error'
+        if outcome < self.error_rate + self.length_rate:
+            return latency, 'length'
+        return latency, 'stop'
+
+    def completion(self, body, finish_reason):
+        schema = body.get('response_format', {}).get('json_schema', {}).get('schema', {})
+        content = json.dumps(answer(schema, body.get('messages', [])))
+        prompt_tokens = len(json.dumps(body.get('messages', []))) // 4
+        completion_tokens = len(content) // 4
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content, 'refusal': None},
+                         'finish_reason': finish_reason, 'logprobs': None}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        }
+
+
+def make_handler(model):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, document, headers=()):
+            body = json.dumps(document).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request'}})
+                return
+            latency, outcome = model.draw()
+            time.sleep(latency)
+            if outcome == 'error':
+                headers = [('Retry-After', '1')] if model.error_status == 429 else []
+                self.send_json(model.error_status, {'error': {'message': 'Injected error', 'type': 'server_error'}},
+                               headers)
+                return
+            self.send_json(200, model.completion(body, outcome))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(model, port):
+    """
+    Start the server on a background thread and return it; stop it with shutdown().
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(model))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=500)
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--length-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def model_from_arguments(args):
+    return FakeModel(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status, args.length_rate, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8766)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(model_from_arguments(args), args.port)
+    print(f'Fake OpenAI server on http://127.0.0.1:{args.port}/v1')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
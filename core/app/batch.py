@@ -0,0 +1,129 @@
+import io
+import json
+import logging
+import time
+import uuid
+from types import SimpleNamespace
+
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def build_request(custom_id, model, prompt, result_model):
+    """
+    One line of a batch input file, with the same parameters as influencemapper's infer functions.
+    """
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {
+            'model': model,
+            'messages': prompt,
+            'temperature': 0.5,
+            'max_tokens': 16384,
+            'top_p': 0.9,
+            'frequency_penalty': 0,
+            'presence_penalty': 0,
+            'response_format': {
+                'type': 'json_schema',
+                'json_schema': {
+                    'name': 'result',
+                    'schema': result_model.model_json_schema(),
+                    'strict': True
+                }
+            }
+        }
+    }
+
+
+def submit(batch_client, requests):
+    content = '\n'.join(json.dumps(request) for request in requests).encode('utf-8')
+    input_file = batch_client.files.create(file=(f'batch-{uuid.uuid4()}.jsonl', content), purpose='batch')
+    batch = batch_client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                        completion_window='24h')
+    logging.info(f"Submitted batch {batch.id} with {len(requests)} requests")
+    return batch.id
+
+
+def wait(batch_client, batch_id, poll_seconds, on_poll=None):
+    """
+    Poll a batch until it reaches a final status. on_poll is called on every poll while the batch is running.
+    """
+    while True:
+        batch = batch_client.batches.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            logging.info(f"Batch {batch_id} finished with status {batch.status}")
+            return batch
+        if on_poll:
+            on_poll()
+        time.sleep(poll_seconds)
+
+
+def read_output(batch_client, batch):
+    """
+    The model answers of a finished batch by custom_id. Requests that failed or did not finish are left out.
+    Expired and cancelled batches still return the answers of the requests they completed.
+    """
+    contents = {}
+    if not batch.output_file_id:
+        return contents
+    for line in batch_client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        output = json.loads(line)
+        response = output.get('response') or {}
+        if output.get('error') or response.get('status_code') != 200:
+            continue
+        choice = response['body']['choices'][0]
+        if choice['finish_reason'] == 'stop':
+            contents[output['custom_id']] = choice['message']['content']
+    return contents
+
+
+class LocalBatchClient:
+    """
+    Stand-in for the OpenAI batch endpoint. Batches are executed synchronously when they are created by
+    calling `respond` with the body of each request, which returns the chat completion as a dict.
+    This lets batch mode run offline against a fake model, or against the regular chat completions endpoint.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.stored_files = {}
+        self.stored_batches = {}
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    @classmethod
+    def from_client(cls, client):
+        return cls(lambda body: client.chat.completions.create(**body).model_dump())
+
+    def create_file(self, file, purpose):
+        file_id = f'file-{uuid.uuid4()}'
+        content = file[1] if isinstance(file, tuple) else file
+        self.stored_files[file_id] = content.read() if isinstance(content, io.IOBase) else content
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def file_content(self, file_id):
+        return SimpleNamespace(text=self.stored_files[file_id].decode('utf-8'))
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        outputs = []
+        for line in self.stored_files[input_file_id].decode('utf-8').splitlines():
+            request = json.loads(line)
+            try:
+                body = self.respond(request['body'])
+                outputs.append({'id': f'batch_req_{uuid.uuid4()}', 'custom_id': request['custom_id'],
+                                'response': {'status_code': 200, 'body': body}, 'error': None})
+            except Exception as e:
+                outputs.append({'id': f'batch_req_{uuid.uuid4()}', 'custom_id': request['custom_id'],
+                                'response': None, 'error': {'code': type(e).__name__, 'message': str(e)}})
+        output_file = self.create_file(('output.jsonl', '\n'.join(json.dumps(o) for o in outputs).encode('utf-8')),
+                                       'batch_output')
+        batch = SimpleNamespace(id=f'batch_{uuid.uuid4()}', status='completed', input_file_id=input_file_id,
+                                output_file_id=output_file.id, error_file_id=None)
+        self.stored_batches[batch.id] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id):
+        return self.stored_batches[batch_id]
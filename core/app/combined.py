@@ -0,0 +1,64 @@
+import json
+import os
+
+from pydantic import BaseModel, ConfigDict
+
+from influencemapper.author_org.infer import AuthorInfo, AuthorInfoRequest, build_prompt as author_org_build_prompt
+from influencemapper.study_org.infer import StudyInfo, StudyInfoRequest, build_prompt as study_org_build_prompt
+
+# The fine-tuned models only know one of the two tasks, so the combined call uses a general model
+COMBINED_MODEL = os.getenv('COMBINED_MODEL', 'gpt-4o-mini-2024-07-18')
+
+
+class CombinedResult(BaseModel):
+    """
+    The study-org and the author-org relationships of a paper, extracted in one call
+    """
+    model_config = ConfigDict(extra='forbid')
+    study_info: list[StudyInfo]
+    author_info: list[AuthorInfo]
+
+
+def build_prompt(data: dict):
+    """
+    A prompt asking for both extractions, made of the instructions of influencemapper's study and author prompts.
+    """
+    study_prompt = study_org_build_prompt(StudyInfoRequest(disclosure=data['disclosure'], title=data['title']))
+    author_prompt = author_org_build_prompt(AuthorInfoRequest(**data))
+    system_prompt = {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": "You will perform two extractions on the same disclosure statement and return them together "
+                        "in one JSON object: the relationships between sponsoring entities and the study in "
+                        "study_info, and the relationships between sponsoring entities and the authors in "
+                        "author_info.\n"
+                        "Instructions for study_info:\n" + study_prompt[0]['content'][0]['text'] + "\n"
+                        "Instructions for author_info:\n" + author_prompt[0]['content'][0]['text']
+            }
+        ]
+    }
+    return [system_prompt, author_prompt[1]]
+
+
+def split_data(data: dict):
+    """
+    Split a combined job into the study job and the author job it stands for, so that their results look exactly
+    like the results of separate study_channel and author_channel jobs.
+    """
+    payload = data['payload']
+    study_data = dict(data, channel='study_channel',
+                      payload={'disclosure': payload['disclosure'], 'title': payload['title']})
+    author_data = dict(data, channel='author_channel')
+    return study_data, author_data
+
+
+def split_content(content):
+    """
+    Split a combined answer into the study answer and the author answer.
+    """
+    if content is None:
+        return None, None
+    result = json.loads(content)
+    return json.dumps({'study_info': result['study_info']}), json.dumps({'author_info': result['author_info']})
@@ -0,0 +1,33 @@
+import hashlib
+import json
+
+STATS_KEY = 'inference_cache:stats'
+
+
+class InferenceCache:
+    """
+    Cache of model answers stored in Redis, keyed on a hash of the channel, the model and the built prompt.
+    Entries expire after `ttl` seconds. The cache can be kept in a Redis instance of its own with an allkeys-lru
+    maxmemory policy, so that answers are evicted under memory pressure while the sessions' data is left untouched.
+    """
+
+    def __init__(self, redis_client, ttl):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(channel_name, model, prompt):
+        content = json.dumps([channel_name, model, prompt], sort_keys=True, ensure_ascii=False)
+        return f'inference_cache:{hashlib.sha256(content.encode("utf-8")).hexdigest()}'
+
+    def get(self, channel_name, model, prompt):
+        content = self.redis_client.get(self.key(channel_name, model, prompt))
+        self.redis_client.hincrby(STATS_KEY, 'misses' if content is None else 'hits', 1)
+        return content.decode('utf-8') if content is not None else None
+
+    def set(self, channel_name, model, prompt, content):
+        self.redis_client.set(self.key(channel_name, model, prompt), content, ex=self.ttl)
+
+    def stats(self):
+        stats = self.redis_client.hgetall(STATS_KEY)
+        return {'hits': int(stats.get(b'hits', 0)), 'misses': int(stats.get(b'misses', 0))}
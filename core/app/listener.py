@@ -2,74 +2,688 @@ import json
 import multiprocessing
 import os
 import logging
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from pathlib import Path
 
+import openai
 import redis
 from openai import OpenAI
 
 
-from influencemapper.author_org.infer import build_prompt as author_org_build_prompt, infer as author_org_infer, \
-    AuthorInfoRequest
-from influencemapper.study_org.infer import build_prompt as study_org_build_prompt, infer as study_org_infer, \
-    StudyInfoRequest
+from influencemapper.author_org.infer import build_prompt as author_org_build_prompt, AuthorInfoRequest, \
+    Result as AuthorResult
+from influencemapper.study_org.infer import build_prompt as study_org_build_prompt, StudyInfoRequest, \
+    Result as StudyResult
 
+import batch
+import combined
+from inference_cache import InferenceCache
+import packing
+from rate_limiter import RateLimiter
+from retry import InferenceError, RetryQueue, is_retryable
+from scheduler import SCHEDULE_WINDOW, Scheduler
+from supervisor import Supervisor
+from throughput import record_completed
+import worker_metrics
 
-def infer_study(data: dict, client):
+# The models used by influencemapper's infer functions, part of the inference cache key
+MODELS = {
+    'study_channel': 'ft:gpt-4o-mini-2024-07-18:network-dynamics-lab:study-org:A0zjJe9i',
+    'author_channel': 'ft:gpt-4o-mini-2024-07-18:network-dynamics-lab:author-org-legal:A5jUNqa3',
+    'paper_channel': combined.COMBINED_MODEL
+}
+RESULT_MODELS = {
+    'study_channel': StudyResult,
+    'author_channel': AuthorResult,
+    'paper_channel': combined.CombinedResult
+}
+PACKED_RESULT_MODELS = {channel_name: packing.packed_model(result_model)
+                        for channel_name, result_model in RESULT_MODELS.items()}
+
+# Rough size of the system prompts and of a typical structured answer, used to estimate the tokens of a request
+# before it is sent. The estimate is corrected with the actual usage once the response arrives.
+PROMPT_OVERHEAD_TOKENS = 400
+EXPECTED_COMPLETION_TOKENS = int(os.getenv('EXPECTED_COMPLETION_TOKENS', 500))
+MAX_COMPLETION_TOKENS = 16384
+# Completion tokens of a first attempt; a truncated answer is retried with twice the budget, up to the model's limit
+INFERENCE_MAX_TOKENS = int(os.getenv('INFERENCE_MAX_TOKENS', MAX_COMPLETION_TOKENS))
+# Deliveries of a job after which it is given up on, e.g. because it crashes every worker that reads it
+MAX_DELIVERIES = int(os.getenv('STREAM_MAX_DELIVERIES', 3))
+# Seconds a session's result stream is kept after its last result
+RESULT_TTL = int(os.getenv('RESULT_TTL', 24 * 3600))
+
+JOBS_PROCESSED = worker_metrics.Counter('listener_jobs_total', 'Jobs processed', ['channel'])
+QUEUE_WAIT_SECONDS = worker_metrics.Histogram('listener_queue_wait_seconds',
+                                              'Time between a job being queued and a listener reading it',
+                                              ['channel'], buckets=worker_metrics.DEFAULT_BUCKETS)
+INFERENCE_SECONDS = worker_metrics.Histogram('listener_inference_seconds', 'Time of a model inference', ['channel'],
+                                             buckets=worker_metrics.DEFAULT_BUCKETS)
+INFERENCE_TOKENS = worker_metrics.Counter('listener_inference_tokens_total', 'Tokens used by model inferences',
+                                          ['channel', 'kind'])
+FINISH_REASONS = worker_metrics.Counter('listener_finish_reasons_total', 'Model inferences by finish reason',
+                                        ['channel', 'finish_reason'])
+PUBLISH_SECONDS = worker_metrics.Histogram('listener_publish_seconds', 'Time to publish a result to Redis',
+                                           buckets=worker_metrics.DEFAULT_BUCKETS)
+BATCH_SECONDS = worker_metrics.Histogram('listener_batch_seconds', 'Time from submitting a batch to its output',
+                                         ['channel'], buckets=worker_metrics.DEFAULT_BUCKETS)
+RETRIES = worker_metrics.Counter('listener_retries_total', 'Failed jobs scheduled for another attempt',
+                                 ['channel', 'reason'])
+DEAD_LETTERS = worker_metrics.Counter('listener_dead_letters_total', 'Jobs given up on after their last attempt',
+                                      ['channel'])
+JOBS_DISPATCHED = worker_metrics.Counter('listener_jobs_dispatched_total',
+                                         'Jobs moved from session queues to the job streams', ['channel'])
+JOBS_PACKED = worker_metrics.Counter('listener_packed_jobs_total', 'Jobs inferred in a packed request', ['channel'])
+
+def build_study_prompt(data: dict):
     data = StudyInfoRequest(disclosure=data['disclosure'])
-    prompt = study_org_build_prompt(data)
-    return  study_org_infer(client, prompt)
+    return study_org_build_prompt(data)
 
-def infer_author(data: dict, client):
+def build_author_prompt(data: dict):
     data = AuthorInfoRequest(authors=data['authors'], disclosure=data['disclosure'])
-    prompt = author_org_build_prompt(data)
-    return author_org_infer(client, prompt)
-
-def process_message(redis_client, data, client, channel_name):
-    result, result_channel, parse_result = None, None, None
-    result_channel = 'result'
-    data_id = data['id']
-    payload = data['payload']
-    if channel_name == 'study_channel':
-        result = infer_study(payload, client)
-    elif channel_name == 'author_channel':
-        result = infer_author(payload, client)
+    return author_org_build_prompt(data)
+
+def build_prompt(data: dict, channel_name):
+    if channel_name == 'paper_channel':
+        return combined.build_prompt(data)
+    return build_study_prompt(data) if channel_name == 'study_channel' else build_author_prompt(data)
+
+def complete(client, prompt, channel_name, max_tokens, packed=False):
+    """
+    A structured-output completion with the same parameters as influencemapper's infer functions,
+    except for the completion token budget. A packed prompt is answered by the pack model, paper by paper.
+    """
+    return client.beta.chat.completions.parse(
+        model=packing.PACK_MODEL if packed else MODELS[channel_name],
+        messages=prompt,
+        temperature=0.5,
+        max_tokens=max_tokens,
+        top_p=0.9,
+        frequency_penalty=0,
+        presence_penalty=0,
+        response_format=(PACKED_RESULT_MODELS if packed else RESULT_MODELS)[channel_name]
+    )
+
+def infer_study(data: dict, client, max_tokens=MAX_COMPLETION_TOKENS):
+    prompt = build_study_prompt(data)
+    return complete(client, prompt, 'study_channel', max_tokens)
+
+def infer_author(data: dict, client, max_tokens=MAX_COMPLETION_TOKENS):
+    prompt = build_author_prompt(data)
+    return complete(client, prompt, 'author_channel', max_tokens)
+
+def infer_combined(data: dict, client, max_tokens=MAX_COMPLETION_TOKENS):
+    prompt = combined.build_prompt(data)
+    return complete(client, prompt, 'paper_channel', max_tokens)
+
+def estimate_tokens(payload: dict):
+    # ~4 characters per token for English text
+    return len(json.dumps(payload)) // 4 + PROMPT_OVERHEAD_TOKENS + EXPECTED_COMPLETION_TOKENS
+
+def get_usage_tokens(result):
+    usage = getattr(result, 'usage', None)
+    return getattr(usage, 'total_tokens', None)
+
+def record_usage(result, channel_name):
+    usage = getattr(result, 'usage', None)
+    for kind in ('prompt', 'completion'):
+        tokens = getattr(usage, f'{kind}_tokens', None)
+        if isinstance(tokens, int):
+            INFERENCE_TOKENS.labels(channel=channel_name, kind=kind).inc(tokens)
+    FINISH_REASONS.labels(channel=channel_name, finish_reason=result.choices[0].finish_reason).inc()
+
+def record_queue_wait(entry_id, channel_name):
+    # Stream entry IDs start with the time the job was queued, in milliseconds
+    entry_id = entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id
+    QUEUE_WAIT_SECONDS.labels(channel=channel_name).observe(max(time.time() - int(entry_id.split('-')[0]) / 1000, 0))
+
+def infer_content(payload, client, channel_name, limiter=None, cache=None, max_tokens=MAX_COMPLETION_TOKENS):
+    """
+    Run the inference for a job and return the model answer. Raises InferenceError if the inference did not
+    finish, and lets the errors of the OpenAI client through.
+    Answers are looked up in and stored to the cache when one is given.
+    """
+    prompt, model = None, MODELS[channel_name]
+    if cache:
+        prompt = build_prompt(payload, channel_name)
+        content = cache.get(channel_name, model, prompt)
+        if content is not None:
+            logging.debug(f"Cache hit for {channel_name} job")
+            return content
+    estimated_tokens = estimate_tokens(payload)
+    if limiter:
+        limiter.acquire(estimated_tokens)
+    with INFERENCE_SECONDS.labels(channel=channel_name).time():
+        try:
+            if channel_name == 'study_channel':
+                result = infer_study(payload, client, max_tokens)
+            elif channel_name == 'author_channel':
+                result = infer_author(payload, client, max_tokens)
+            elif channel_name == 'paper_channel':
+                result = infer_combined(payload, client, max_tokens)
+        except openai.LengthFinishReasonError as e:
+            # Structured outputs raise instead of returning a truncated answer
+            result = e.completion
+    record_usage(result, channel_name)
+    if limiter:
+        limiter.settle(estimated_tokens, get_usage_tokens(result))
+    finish_reason = result.choices[0].finish_reason
+    if finish_reason != 'stop':
+        raise InferenceError(f"Inference stopped with finish_reason {finish_reason}",
+                             truncated=finish_reason == 'length')
+    content = result.choices[0].message.content
+    if cache:
+        cache.set(channel_name, model, prompt, content)
+    return content
+
+def infer_packed(prompts, client, channel_name, limiter=None, cache=None):
+    """
+    Run the inference for the prompts of several jobs with one packed request and return their answers, in order.
+    A paper the model left out has no answer. Raises InferenceError if the inference did not finish, and lets the
+    errors of the OpenAI client through.
+    Each paper's answer is cached apart, so a job is only sent again if its own answer is missing.
+    """
+    contents = [cache.get(channel_name, packing.PACK_MODEL, prompt) if cache else None for prompt in prompts]
+    missing = [i for i, content in enumerate(contents) if content is None]
+    if not missing:
+        return contents
+    prompt = packing.build_prompt([prompts[i] for i in missing])
+    estimated_tokens = estimate_tokens({'text': prompt[1]['content'][0]['text']}) + \
+        (len(missing) - 1) * EXPECTED_COMPLETION_TOKENS
+    max_tokens = min(len(missing) * INFERENCE_MAX_TOKENS, MAX_COMPLETION_TOKENS)
+    if limiter:
+        limiter.acquire(estimated_tokens)
+    with INFERENCE_SECONDS.labels(channel=channel_name).time():
+        try:
+            result = complete(client, prompt, channel_name, max_tokens, packed=True)
+        except openai.LengthFinishReasonError as e:
+            result = e.completion
+    record_usage(result, channel_name)
+    if limiter:
+        limiter.settle(estimated_tokens, get_usage_tokens(result))
     finish_reason = result.choices[0].finish_reason
-    if finish_reason == 'stop':
-        result = {
-            'id': data_id,
-            'source': payload,
-            'payload': json.loads(result.choices[0].message.content),
+    if finish_reason != 'stop':
+        raise InferenceError(f"Packed inference stopped with finish_reason {finish_reason}",
+                             truncated=finish_reason == 'length')
+    for i, content in zip(missing, packing.split_content(result.choices[0].message.content, len(missing))):
+        contents[i] = content
+        if cache and content is not None:
+            cache.set(channel_name, packing.PACK_MODEL, prompts[i], content)
+    return contents
+
+def publish_result(redis_client, result, session_id):
+    """
+    Append a result to its session's result stream, which the web app reads from with blocking reads.
+    """
+    result_stream = f'result:{session_id}'
+    with PUBLISH_SECONDS.time():
+        pipe = redis_client.pipeline()
+        pipe.xadd(result_stream, {'data': json.dumps(result)})
+        pipe.expire(result_stream, RESULT_TTL)
+        pipe.execute()
+
+def build_result(data, channel_name, content):
+    """
+    The result message of a job, given the model answer or None if the inference did not finish.
+    """
+    if content is not None:
+        return {
+            'id': data['id'],
+            'source': data['payload'],
+            'payload': json.loads(content),
             'error': None,
-            'channel': channel_name
+            'channel': channel_name,
+            'session_id': data['session_id']
         }
+    return {
+        'id': data['id'],
+        'source': data['payload'],
+        'payload': None,
+        'error': 'Inference did not finish. Try again later.',
+        'channel': channel_name,
+        'session_id': data['session_id']
+    }
+
+def build_results(data, channel_name, content):
+    """
+    The result messages of a job. A paper_channel job answers for both channels, so it is split into a
+    study_channel result and an author_channel result, shaped as if the two had been inferred separately.
+    """
+    if channel_name != 'paper_channel':
+        return [build_result(data, channel_name, content)]
+    study_data, author_data = combined.split_data(data)
+    study_content, author_content = combined.split_content(content)
+    return [build_result(study_data, 'study_channel', study_content),
+            build_result(author_data, 'author_channel', author_content)]
+
+def publish_results(redis_client, data, channel_name, content):
+    for result in build_results(data, channel_name, content):
+        publish_result(redis_client, result, data['session_id'])
+
+def fail_job(redis_client, data, channel_name, error, retries=None):
+    """
+    Schedule another attempt of a failed job, or publish its error result once it is out of attempts or the error
+    is permanent. Without a retry queue, the error result is published right away.
+    Returns whether the job is done, i.e. its error result was published.
+    """
+    attempt = data.get('attempt', 0) + 1
+    if retries and is_retryable(error) and attempt < retries.max_attempts:
+        retry = dict(data, attempt=attempt)
+        if getattr(error, 'truncated', False):
+            retry['max_tokens'] = min(data.get('max_tokens', INFERENCE_MAX_TOKENS) * 2, MAX_COMPLETION_TOKENS)
+        delay = retries.delay(error, attempt - 1)
+        retries.schedule(retry, delay)
+        RETRIES.labels(channel=channel_name, reason=type(error).__name__).inc()
+        logging.warning(f"Job {data['id']} of session {data['session_id']} failed on attempt {attempt}: {error}. "
+                        f"Retrying in {delay:.1f}s")
+        return False
+    logging.error(f"Job {data['id']} of session {data['session_id']} failed on attempt {attempt}: {error}")
+    dead_letter_job(redis_client, data, channel_name, error, retries)
+    return True
+
+def dead_letter_job(redis_client, data, channel_name, error, retries=None):
+    """
+    Give up on a job: move it to the dead-letter stream, if there is a retry queue, and publish its error result.
+    """
+    if retries:
+        retries.dead_letter(data, error)
+        DEAD_LETTERS.labels(channel=channel_name).inc()
+    publish_results(redis_client, data, channel_name, None)
+
+def retry_alone(redis_client, data, channel_name, error, retries=None):
+    """
+    Schedule a job that failed with its pack, or that the packed answer left out, to be inferred alone. Whatever the
+    error, it may come from another paper of the pack, so the packed attempt does not count and the job is only
+    given up on once it fails alone. Without a retry queue, the job fails right away.
+    Returns whether the job is done, like fail_job.
+    """
+    if retries is None:
+        return fail_job(redis_client, data, channel_name, error, retries)
+    # A job with an attempt number is never packed again
+    retries.schedule(dict(data, attempt=data.get('attempt', 0)), retries.delay(error, 0) if is_retryable(error) else 0)
+    RETRIES.labels(channel=channel_name, reason=type(error).__name__).inc()
+    logging.warning(f"Job {data['id']} of session {data['session_id']} failed in a pack: {error}. Retrying alone")
+    return False
+
+def process_message(redis_client, data, client, channel_name, limiter=None, cache=None, retries=None):
+    """
+    Infer a job and publish its result. Returns whether the job is done, rather than scheduled for another attempt.
+    """
+    try:
+        content = infer_content(data['payload'], client, channel_name, limiter, cache,
+                                data.get('max_tokens', INFERENCE_MAX_TOKENS))
+    except (openai.OpenAIError, InferenceError, ValueError) as e:
+        return fail_job(redis_client, data, channel_name, e, retries)
+    publish_results(redis_client, data, channel_name, content)
+    return True
+
+def get_consumer_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def ensure_group(redis_client, channel_name, group_name):
+    """
+    Create the consumer group for a job stream, creating the stream if needed.
+    """
+    try:
+        redis_client.xgroup_create(channel_name, group_name, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def claim_stale_jobs(redis_client, channel_name, group_name, consumer_name, min_idle_ms, count, retries=None):
+    """
+    Take over jobs that were delivered to a consumer but not acknowledged within min_idle_ms,
+    e.g. because the worker holding them crashed.
+    Jobs delivered more than MAX_DELIVERIES times are given up on and acknowledged rather than returned, so that a
+    job that crashes every worker that reads it does not keep coming back.
+    """
+    response = redis_client.xautoclaim(channel_name, group_name, consumer_name, min_idle_ms,
+                                       start_id='0-0', count=count)
+    entries = response[1]
+    if not entries:
+        return entries
+    pipe = redis_client.pipeline(transaction=False)
+    for entry_id, _ in entries:
+        pipe.xpending_range(channel_name, group_name, min=entry_id, max=entry_id, count=1)
+    claimed = []
+    for (entry_id, fields), pending in zip(entries, pipe.execute()):
+        deliveries = pending[0]['times_delivered'] if pending else 0
+        if not fields or deliveries <= MAX_DELIVERIES:
+            claimed.append((entry_id, fields))
+            continue
+        data = json.loads(fields[b'data'])
+        error = InferenceError(f"Delivered {deliveries} times without finishing")
+        logging.error(f"Job {data['id']} of session {data['session_id']} given up on: {error}")
+        dead_letter_job(redis_client, data, channel_name, error, retries)
+        ack_job(redis_client, channel_name, group_name, entry_id)
+        count_processed(redis_client, channel_name)
+    return claimed
+
+def ack_job(redis_client, channel_name, group_name, entry_id):
+    pipe = redis_client.pipeline()
+    pipe.xack(channel_name, group_name, entry_id)
+    pipe.xdel(channel_name, entry_id)
+    pipe.execute()
+
+def count_processed(redis_client, channel_name, count=1):
+    # Jobs done, published or given up on, are counted for the metrics, and for the web app to measure each channel's
+    # throughput. Jobs scheduled for another attempt are counted once they are done.
+    JOBS_PROCESSED.labels(channel=channel_name).inc(count)
+    record_completed(redis_client, channel_name, count)
+
+def handle_entry(entry_id, fields, channel_name, group_name, client, redis_client, limiter, cache, retries=None):
+    # Empty fields mean the entry was deleted while pending; there is nothing left to process
+    if fields:
+        record_queue_wait(entry_id, channel_name)
+        data = json.loads(fields[b'data'])
+        if process_message(redis_client, data, client, channel_name, limiter, cache, retries):
+            count_processed(redis_client, channel_name)
+    ack_job(redis_client, channel_name, group_name, entry_id)
+
+def handle_pack(jobs, channel_name, group_name, client, redis_client, limiter, cache, retries=None):
+    """
+    Process (entry_id, data, prompt) jobs with one packed inference, publishing and acknowledging each job apart.
+    A job the answer left out, or that failed with the pack, goes through the retry queue, which runs it alone,
+    whatever the error of the pack.
+    """
+    for entry_id, _, _ in jobs:
+        record_queue_wait(entry_id, channel_name)
+    error = None
+    try:
+        contents = infer_packed([prompt for _, _, prompt in jobs], client, channel_name, limiter, cache)
+    except (openai.OpenAIError, InferenceError, ValueError) as e:
+        contents, error = [None] * len(jobs), e
+    for (entry_id, data, _), content in zip(jobs, contents):
+        if content is None:
+            done = retry_alone(redis_client, data, channel_name,
+                               error or InferenceError("Packed answer left the paper out"), retries)
+        else:
+            publish_results(redis_client, data, channel_name, content)
+            done = True
+        ack_job(redis_client, channel_name, group_name, entry_id)
+        if done:
+            count_processed(redis_client, channel_name)
+        JOBS_PACKED.labels(channel=channel_name).inc()
+
+def pack_entries(packer, entries, channel_name):
+    """
+    Split stream entries into packs of short jobs, as (entry_id, data, prompt) tuples, and the entries to process
+    alone. Retried jobs are never packed again.
+    """
+    jobs, singles = [], []
+    for entry_id, fields in entries:
+        if not fields:
+            singles.append((entry_id, fields))
+            continue
+        data = json.loads(fields[b'data'])
+        try:
+            prompt = build_prompt(data['payload'], channel_name)
+        except ValueError:
+            # The job fails on its own, with the error of its single inference
+            prompt = None
+        if prompt is None or 'attempt' in data:
+            singles.append((entry_id, fields))
+        else:
+            jobs.append(((entry_id, fields, data, prompt), packing.prompt_tokens(prompt)))
+    packs, unpacked = packer.pack(jobs)
+    singles += [(entry_id, fields) for entry_id, fields, _, _ in unpacked]
+    return [[(entry_id, data, prompt) for entry_id, _, data, prompt in pack] for pack in packs], singles
+
+def reap(in_flight, block):
+    """
+    Remove finished jobs from the in-flight set, re-raising any error they ended with.
+    """
+    if block:
+        done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
     else:
-        result = {
-            'id': data_id,
-            'source': payload,
-            'payload': None,
-            'error': 'Inference did not finish. Try again later.',
-            'channel': channel_name
-        }
-    redis_client.publish(result_channel, json.dumps(result))
+        done = {future for future in in_flight if future.done()}
+        pending = in_flight - done
+    for future in done:
+        future.result()
+    return pending
+
+def stopped(stop):
+    return stop is not None and stop.is_set()
+
+def remove_consumer(redis_client, channel_name, group_name, consumer_name):
+    """
+    Remove a consumer that stopped from its group, unless it still holds jobs for other consumers to reclaim.
+    """
+    if not redis_client.xpending_range(channel_name, group_name, '-', '+', 1, consumername=consumer_name):
+        redis_client.xgroup_delconsumer(channel_name, group_name, consumer_name)
 
-def handle_messages(channel_name, client, redis_client):
+def requeue_retries(retries, next_requeue):
     """
-    Function to listen to messages for a specific channel.
+    Queue the retries that are due again, at most once a second. Returns when to check next.
     """
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe(channel_name)
+    if retries is None or time.monotonic() < next_requeue:
+        return next_requeue
+    count = retries.requeue_due()
+    if count:
+        logging.info(f"Queued {count} retries of {retries.channel_name} again")
+    return time.monotonic() + 1
+
+def dispatch_jobs(scheduler, window=None):
+    if scheduler is None:
+        return
+    moved = scheduler.dispatch(window)
+    if moved:
+        JOBS_DISPATCHED.labels(channel=scheduler.channel_name).inc(moved)
+
+def handle_messages(channel_name, client, redis_client, limiter=None, cache=None, stop=None, retries=None,
+                    scheduler=None, packer=None):
+    """
+    Function to consume jobs for a specific channel.
+    Jobs are read from the channel's stream through a consumer group shared by all listener replicas, and are only
+    acknowledged once their result has been published. Jobs left pending by a dead consumer are reclaimed.
+    Failed jobs go through the retry queue and are read from the stream again once their backoff is over.
+    With a scheduler, the stream is fed from the sessions' job queues before every read.
+    With a packer, short jobs are inferred several at a time, each pack taking one of the inferences in flight.
+    Up to INFERENCE_CONCURRENCY jobs are processed at the same time on a thread pool.
+    Once `stop` is set, no new jobs are read and the function returns when the jobs in flight are done.
+    """
+    group_name = os.getenv('STREAM_GROUP', 'listener')
+    block_ms = int(os.getenv('STREAM_BLOCK_MS', 5000))
+    claim_idle_ms = int(os.getenv('STREAM_CLAIM_IDLE_MS', 300000))
+    concurrency = int(os.getenv('INFERENCE_CONCURRENCY', 8))
+    consumer_name = get_consumer_name()
+    ensure_group(redis_client, channel_name, group_name)
     print(f"Listening to messages from channel: {channel_name}")
-    logging.info("Starting to listen for messages...")
-    for message in pubsub.listen():
-        if message["type"] == "message":
-            data = json.loads(message["data"])
-            process_message(redis_client, data, client, channel_name)
-
-def run_listener(secret_key, channel_name, pool):
-    openAI_client = OpenAI(api_key=secret_key)
+    logging.info(f"Starting to consume {channel_name} as {group_name}/{consumer_name} "
+                 f"with {concurrency} inferences in flight...")
+    in_flight = set()
+    next_requeue = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while not stopped(stop):
+            in_flight = reap(in_flight, block=False)
+            # The jobs a packer leaves to process alone can outnumber the free inferences
+            while len(in_flight) >= concurrency:
+                in_flight = reap(in_flight, block=True)
+            next_requeue = requeue_retries(retries, next_requeue)
+            free = concurrency - len(in_flight)
+            # Enough jobs are read to fill a pack per free inference
+            count = free * packer.max_jobs if packer else free
+            dispatch_jobs(scheduler, max(count, SCHEDULE_WINDOW) if packer else None)
+            entries = claim_stale_jobs(redis_client, channel_name, group_name, consumer_name, claim_idle_ms, count,
+                                       retries)
+            if entries:
+                logging.info(f"Reclaimed {len(entries)} stale jobs from {channel_name}")
+            else:
+                response = redis_client.xreadgroup(group_name, consumer_name, {channel_name: '>'}, count=count,
+                                                   block=block_ms)
+                entries = [entry for _, stream_entries in response for entry in stream_entries]
+            if packer:
+                packs, entries = pack_entries(packer, entries, channel_name)
+                for jobs in packs:
+                    in_flight.add(executor.submit(handle_pack, jobs, channel_name, group_name, client, redis_client,
+                                                  limiter, cache, retries))
+            for entry_id, fields in entries:
+                in_flight.add(executor.submit(handle_entry, entry_id, fields, channel_name, group_name, client,
+                                              redis_client, limiter, cache, retries))
+        logging.info(f"Draining {len(in_flight)} jobs of {channel_name}...")
+        while in_flight:
+            in_flight = reap(in_flight, block=True)
+    remove_consumer(redis_client, channel_name, group_name, consumer_name)
+
+def collect_jobs(redis_client, channel_name, group_name, consumer_name, max_jobs, collect_ms, claim_idle_ms,
+                 scheduler=None, retries=None):
+    """
+    Read jobs until max_jobs are collected or collect_ms have passed since the first one arrived.
+    """
+    entries = claim_stale_jobs(redis_client, channel_name, group_name, consumer_name, claim_idle_ms, max_jobs,
+                               retries)
+    deadline = time.monotonic() + collect_ms / 1000 if entries else None
+    while len(entries) < max_jobs:
+        block_ms = collect_ms
+        if deadline is not None:
+            block_ms = int((deadline - time.monotonic()) * 1000)
+            if block_ms <= 0:
+                break
+        dispatch_jobs(scheduler, max_jobs - len(entries))
+        response = redis_client.xreadgroup(group_name, consumer_name, {channel_name: '>'},
+                                           count=max_jobs - len(entries), block=block_ms)
+        entries += [entry for _, stream_entries in response for entry in stream_entries]
+        if not entries:
+            return entries
+        if deadline is None:
+            deadline = time.monotonic() + collect_ms / 1000
+    return entries
+
+def run_batch(entries, channel_name, group_name, consumer_name, redis_client, batch_client, cache=None,
+              poll_seconds=30, retries=None):
+    """
+    Run a set of jobs through the batch endpoint and publish their results like process_message does.
+    Jobs answered from the cache, or whose prompt cannot be built, are published or retried right away. The jobs of the running batch are claimed again on
+    every poll so that other listeners do not reclaim them while the batch is in progress.
+    Requests of the batch that failed or did not finish go through the retry queue.
+    """
+    model = MODELS[channel_name]
+    jobs, requests = {}, []
+    for entry_id, fields in entries:
+        if not fields:
+            ack_job(redis_client, channel_name, group_name, entry_id)
+            continue
+        record_queue_wait(entry_id, channel_name)
+        data = json.loads(fields[b'data'])
+        try:
+            prompt = build_prompt(data['payload'], channel_name)
+        except ValueError as e:
+            if fail_job(redis_client, data, channel_name, e, retries):
+                count_processed(redis_client, channel_name)
+            ack_job(redis_client, channel_name, group_name, entry_id)
+            continue
+        content = cache.get(channel_name, model, prompt) if cache else None
+        if content is not None:
+            publish_results(redis_client, data, channel_name, content)
+            ack_job(redis_client, channel_name, group_name, entry_id)
+            count_processed(redis_client, channel_name)
+            continue
+        custom_id = entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id
+        jobs[custom_id] = (entry_id, data, prompt)
+        requests.append(batch.build_request(custom_id, model, prompt, RESULT_MODELS[channel_name]))
+    if not requests:
+        return
+
+    def keep_jobs():
+        redis_client.xclaim(channel_name, group_name, consumer_name, 0, [job[0] for job in jobs.values()],
+                            justid=True)
+
+    start = time.monotonic()
+    batch_id = batch.submit(batch_client, requests)
+    contents = batch.read_output(batch_client, batch.wait(batch_client, batch_id, poll_seconds, keep_jobs))
+    BATCH_SECONDS.labels(channel=channel_name).observe(time.monotonic() - start)
+    for custom_id, (entry_id, data, prompt) in jobs.items():
+        content = contents.get(custom_id)
+        if content is None:
+            done = fail_job(redis_client, data, channel_name, InferenceError("Batch request did not finish"), retries)
+        else:
+            if cache:
+                cache.set(channel_name, model, prompt, content)
+            publish_results(redis_client, data, channel_name, content)
+            done = True
+        ack_job(redis_client, channel_name, group_name, entry_id)
+        if done:
+            count_processed(redis_client, channel_name)
+
+def handle_batches(channel_name, redis_client, batch_client, cache=None, stop=None, retries=None, scheduler=None):
+    """
+    Function to consume jobs for a specific channel through the batch endpoint.
+    Jobs are collected into batches of up to BATCH_MAX_JOBS, waiting at most BATCH_COLLECT_MS for a batch to fill.
+    Once `stop` is set, the function returns after the running batch.
+    """
+    group_name = os.getenv('STREAM_GROUP', 'listener')
+    claim_idle_ms = int(os.getenv('STREAM_CLAIM_IDLE_MS', 300000))
+    max_jobs = int(os.getenv('BATCH_MAX_JOBS', 1000))
+    collect_ms = int(os.getenv('BATCH_COLLECT_MS', 60000))
+    poll_seconds = int(os.getenv('BATCH_POLL_SECONDS', 30))
+    consumer_name = get_consumer_name()
+    ensure_group(redis_client, channel_name, group_name)
+    logging.info(f"Starting to consume {channel_name} in batches as {group_name}/{consumer_name}...")
+    next_requeue = 0
+    while not stopped(stop):
+        next_requeue = requeue_retries(retries, next_requeue)
+        entries = collect_jobs(redis_client, channel_name, group_name, consumer_name, max_jobs, collect_ms,
+                               claim_idle_ms, scheduler, retries)
+        if entries:
+            run_batch(entries, channel_name, group_name, consumer_name, redis_client, batch_client, cache,
+                      poll_seconds, retries)
+    remove_consumer(redis_client, channel_name, group_name, consumer_name)
+
+def get_batch_client(openAI_client):
+    if os.getenv('BATCH_ENDPOINT', 'openai') == 'local':
+        return batch.LocalBatchClient.from_client(openAI_client)
+    return openAI_client
+
+def get_rate_limiter(redis_client):
+    requests_per_minute = int(os.getenv('RATE_LIMIT_RPM', 0))
+    tokens_per_minute = int(os.getenv('RATE_LIMIT_TPM', 0))
+    if not requests_per_minute and not tokens_per_minute:
+        return None
+    return RateLimiter(redis_client, requests_per_minute, tokens_per_minute)
+
+def get_inference_cache(redis_client):
+    ttl = int(os.getenv('INFERENCE_CACHE_TTL', 30 * 24 * 3600))
+    if ttl <= 0:
+        return None
+    # The cache is best kept in a Redis of its own, free to evict answers without touching the sessions' data
+    cache_host = os.getenv('INFERENCE_CACHE_HOST')
+    if cache_host:
+        cache_port = os.getenv('INFERENCE_CACHE_PORT', 6379)
+        redis_client = redis.Redis.from_url(f"redis://{cache_host}:{cache_port}")
+    return InferenceCache(redis_client, ttl)
+
+def get_packer():
+    if os.getenv('PACK_MODE', '0') != '1':
+        return None
+    return packing.Packer(token_budget=int(os.getenv('PACK_TOKEN_BUDGET', 2000)),
+                          max_jobs=int(os.getenv('PACK_MAX_JOBS', 10)),
+                          max_job_tokens=int(os.getenv('PACK_JOB_MAX_TOKENS', 200)))
+
+def get_retry_queue(redis_client, channel_name):
+    return RetryQueue(redis_client, channel_name,
+                      max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', 5)),
+                      base_delay=float(os.getenv('RETRY_BASE_DELAY', 1)),
+                      max_delay=float(os.getenv('RETRY_MAX_DELAY', 300)))
+
+def run_listener(secret_key, channel_name, pool, stop=None):
+    if stop is not None:
+        # Terminating a worker drains it like a scale-down does
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Failed requests are retried through the retry queue rather than by the client, so they do not hold a thread
+    openAI_client = OpenAI(api_key=secret_key, max_retries=0)
     redis_client = redis.Redis(connection_pool=pool)
-    handle_messages(channel_name, openAI_client, redis_client)
+    retries = get_retry_queue(redis_client, channel_name)
+    scheduler = Scheduler(redis_client, channel_name, os.getenv('STREAM_GROUP', 'listener'))
+    if os.getenv('BATCH_MODE', '0') == '1':
+        handle_batches(channel_name, redis_client, get_batch_client(openAI_client), get_inference_cache(redis_client),
+                       stop, retries, scheduler)
+    else:
+        handle_messages(channel_name, openAI_client, redis_client, get_rate_limiter(redis_client),
+                        get_inference_cache(redis_client), stop, retries, scheduler, get_packer())
 
 def get_redis_pool():
     redis_host = os.getenv('REDIS_HOST', 'localhost')
@@ -82,17 +696,36 @@ def main():
     secret_path = Path(__file__).parent.parent / 'secret_key'
     with secret_path.open() as f:
         secret_key = f.read().strip()
-    pool = get_redis_pool()
-    processes = [
-        multiprocessing.Process(target=run_listener, args=(secret_key, 'author_channel', pool)),
-        multiprocessing.Process(target=run_listener, args=(secret_key, 'study_channel', pool))
-    ]
-    for process in processes:
-        process.start()
-    for process in processes:
-        process.join()
+    supervise(secret_key)
     # asyncio.create_task(run_listener(secret_key, 'author_channel', pool))
     # asyncio.create_task(run_listener(secret_key, 'study_channel', pool))
 
+def supervise(secret_key):
+    """
+    Run the listener processes of every channel under a supervisor until SIGTERM or SIGINT.
+    """
+    pool = get_redis_pool()
+    redis_client = redis.Redis(connection_pool=pool)
+    channels = ('author_channel', 'study_channel', 'paper_channel')
+    group_name = os.getenv('STREAM_GROUP', 'listener')
+    for channel_name in channels:
+        ensure_group(redis_client, channel_name, group_name)
+
+    def spawn(channel_name, stop):
+        return multiprocessing.Process(target=run_listener, args=(secret_key, channel_name, pool, stop))
+
+    supervisor = Supervisor(redis_client, channels, spawn, group_name,
+                            min_workers=int(os.getenv('AUTOSCALE_MIN_WORKERS', 1)),
+                            max_workers=int(os.getenv('AUTOSCALE_MAX_WORKERS', 4)),
+                            jobs_per_worker=int(os.getenv('AUTOSCALE_JOBS_PER_WORKER', 50)),
+                            scale_down_delay=int(os.getenv('AUTOSCALE_SCALE_DOWN_DELAY', 60)))
+    worker_metrics.reset()
+    metrics_port = int(os.getenv('METRICS_PORT', 9100))
+    if metrics_port:
+        worker_metrics.serve(metrics_port)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run(int(os.getenv('AUTOSCALE_INTERVAL', 5)))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
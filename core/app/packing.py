@@ -0,0 +1,101 @@
+import json
+import os
+
+from pydantic import ConfigDict, create_model
+
+# The fine-tuned models only know the one-disclosure format, so packed requests use a general model
+PACK_MODEL = os.getenv('PACK_MODEL', 'gpt-4o-mini-2024-07-18')
+
+PACK_INSTRUCTIONS = ("\nYou will be given several disclosure statements, each introduced by its paper number. "
+                     "Extract the relationships of every paper separately, as if it were the only one, and return "
+                     "one entry per paper in papers, with the paper number in paper.")
+
+
+def packed_model(result_model):
+    """
+    The structured output of a packed request: the fields of result_model for each paper, with its number.
+    """
+    fields = {name: (field.annotation, ...) for name, field in result_model.model_fields.items()}
+    paper = create_model(f'Packed{result_model.__name__}', __config__=ConfigDict(extra='forbid'), paper=(int, ...),
+                         **fields)
+    return create_model(f'Packed{result_model.__name__}s', __config__=ConfigDict(extra='forbid'),
+                        papers=(list[paper], ...))
+
+
+def prompt_tokens(prompt):
+    # ~4 characters per token for English text
+    return len(prompt[1]['content'][0]['text']) // 4 + 1
+
+
+def build_prompt(prompts):
+    """
+    One prompt for the prompts of several jobs of a channel: their shared system prompt, and their user messages
+    numbered from 1.
+    """
+    system_prompt = {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": prompts[0][0]['content'][0]['text'] + PACK_INSTRUCTIONS
+            }
+        ]
+    }
+    user_prompt = {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": '\n\n'.join(f"Paper {number}:\n{prompt[1]['content'][0]['text']}"
+                                    for number, prompt in enumerate(prompts, 1))
+            }
+        ]
+    }
+    return [system_prompt, user_prompt]
+
+
+def split_content(content, count):
+    """
+    Split a packed answer into the answers of its `count` papers, in order, shaped like the answer of a request for
+    one paper. Papers the model left out are None.
+    """
+    answers = {}
+    for paper in json.loads(content)['papers']:
+        number = paper.pop('paper')
+        if 1 <= number <= count:
+            answers.setdefault(number, json.dumps(paper))
+    return [answers.get(number) for number in range(1, count + 1)]
+
+
+class Packer:
+    """
+    Groups the short jobs of a channel into packs that are inferred with one request, so that they share the system
+    prompt. A job is short when its user message has at most `max_job_tokens` tokens; a pack holds up to `max_jobs`
+    jobs and `token_budget` tokens of user messages.
+    """
+
+    def __init__(self, token_budget, max_jobs, max_job_tokens):
+        self.token_budget = token_budget
+        self.max_jobs = max_jobs
+        self.max_job_tokens = min(max_job_tokens, token_budget)
+
+    def pack(self, jobs):
+        """
+        Split (job, tokens) pairs into packs of short jobs, filled first-fit from the longest job down, and the jobs
+        left to infer alone. Returns both as lists of jobs.
+        """
+        packs, singles = [], []
+        for job, tokens in sorted(jobs, key=lambda job: job[1], reverse=True):
+            if tokens > self.max_job_tokens:
+                singles.append(job)
+                continue
+            for pack in packs:
+                if len(pack[0]) < self.max_jobs and pack[1] + tokens <= self.token_budget:
+                    pack[0].append(job)
+                    pack[1] += tokens
+                    break
+            else:
+                packs.append([[job], tokens])
+        # A pack of one saves nothing
+        singles += [pack_jobs[0] for pack_jobs, _ in packs if len(pack_jobs) == 1]
+        return [pack_jobs for pack_jobs, _ in packs if len(pack_jobs) > 1], singles
@@ -0,0 +1,75 @@
+import time
+
+# Refill the bucket from the elapsed time since the last call, then try to take `amount` from it.
+# Returns the number of seconds to wait before retrying, or 0 when the amount was taken.
+# When `force` is set the amount is always taken, letting the bucket go into debt (used to settle estimates).
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local force = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'level', 'ts')
+local level = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+level = math.min(capacity, level + math.max(0, now - ts) * rate)
+local needed = math.min(amount, capacity)
+local wait = 0
+if force == 1 or level >= needed then
+    level = level - amount
+else
+    wait = (needed - level) / rate
+end
+redis.call('HSET', KEYS[1], 'level', tostring(level), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    A token bucket stored in Redis so that every listener process and replica draws from the same quota.
+    """
+
+    def __init__(self, redis_client, name, per_minute):
+        self.key = f'ratelimit:{name}'
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.script = redis_client.register_script(TAKE_SCRIPT)
+
+    def take(self, amount, force=False):
+        return float(self.script(keys=[self.key], args=[self.capacity, self.rate, amount, int(force)]))
+
+    def acquire(self, amount=1):
+        """
+        Block until `amount` can be taken from the bucket.
+        """
+        while True:
+            wait = self.take(amount)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1))
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min limiter for the OpenAI API. Either limit can be None to disable it.
+    """
+
+    def __init__(self, redis_client, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(redis_client, 'requests', requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(redis_client, 'tokens', tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens):
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens:
+            self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """
+        Correct the token bucket once the actual usage of a request is known.
+        """
+        if self.tokens and actual_tokens is not None and actual_tokens != estimated_tokens:
+            self.tokens.take(actual_tokens - estimated_tokens, force=True)
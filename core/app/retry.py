@@ -0,0 +1,96 @@
+import json
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+# Move the retries that are due back to the job stream. Done in one script so that two listeners never
+# queue the same retry twice.
+REQUEUE_SCRIPT = """
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job in ipairs(jobs) do
+    redis.call('XADD', KEYS[2], '*', 'data', job)
+    redis.call('ZREM', KEYS[1], job)
+end
+return #jobs
+"""
+
+# Errors that fail the same way however often the request is repeated
+PERMANENT_ERRORS = (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError,
+                    openai.NotFoundError, openai.UnprocessableEntityError, openai.ContentFilterFinishReasonError)
+
+
+class InferenceError(Exception):
+    """
+    An inference that returned without finishing. `truncated` is set when it ran out of completion tokens.
+    """
+
+    def __init__(self, message, truncated=False):
+        super().__init__(message)
+        self.truncated = truncated
+
+
+def is_retryable(error):
+    return not isinstance(error, PERMANENT_ERRORS)
+
+
+def retry_after(error):
+    """
+    The delay in seconds the API asked for in the Retry-After headers of an error response, if any.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(headers['retry-after']).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def backoff(attempt, base_delay, max_delay, rng=random):
+    """
+    Exponential backoff with jitter: a random delay between half and all of base_delay * 2 ** attempt.
+    """
+    delay = min(base_delay * 2 ** attempt, max_delay)
+    return rng.uniform(delay / 2, delay)
+
+
+class RetryQueue:
+    """
+    Failed jobs of a channel waiting to be retried, in a sorted set scored by the time they are due, and the
+    dead-letter stream of the jobs that failed too often.
+    """
+
+    def __init__(self, redis_client, channel_name, max_attempts, base_delay, max_delay, dead_letter_max_len=10000):
+        self.redis_client = redis_client
+        self.channel_name = channel_name
+        self.key = f'retry:{channel_name}'
+        self.dead_letter_key = f'dead:{channel_name}'
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter_max_len = dead_letter_max_len
+        self.script = redis_client.register_script(REQUEUE_SCRIPT)
+
+    def delay(self, error, attempt):
+        return max(backoff(attempt, self.base_delay, self.max_delay), retry_after(error) or 0)
+
+    def schedule(self, data, delay):
+        self.redis_client.zadd(self.key, {json.dumps(data): time.time() + delay})
+
+    def requeue_due(self, count=100):
+        return self.script(keys=[self.key, self.channel_name], args=[time.time(), count])
+
+    def dead_letter(self, data, error):
+        self.redis_client.xadd(self.dead_letter_key, {'data': json.dumps(data), 'error': str(error)},
+                               maxlen=self.dead_letter_max_len, approximate=True)
@@ -0,0 +1,95 @@
+import os
+
+# Priority classes, highest first. Sessions of a class only get jobs dispatched once no session of a higher class
+# has jobs waiting.
+PRIORITIES = ('high', 'normal', 'low')
+# Jobs kept waiting in a channel's stream, ahead of the listeners; the rest wait in their session's queue
+SCHEDULE_WINDOW = int(os.getenv('SCHEDULE_WINDOW', 16))
+
+# Move jobs from the session queues to the channel stream until `window` jobs are waiting in it. Each priority
+# class is a sorted set of the sessions with jobs queued, scored by virtual time: the next job always comes from the
+# session with the lowest score, which then advances by 1 / weight. Sessions of equal weight thus take turns, and a
+# session of weight 2 gets twice the jobs of one of weight 1.
+DISPATCH_SCRIPT = """
+local window = tonumber(ARGV[2])
+local waiting = redis.call('XLEN', KEYS[1])
+local summary = redis.pcall('XPENDING', KEYS[1], ARGV[1])
+if type(summary) == 'table' and summary.err == nil then
+    waiting = waiting - summary[1]
+end
+local room = window - waiting
+local moved = 0
+for i = 4, #KEYS do
+    while room > 0 do
+        local head = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+        if #head == 0 then
+            break
+        end
+        local session, time = head[1], tonumber(head[2])
+        local queue = ARGV[3] .. session
+        local job = redis.call('LPOP', queue)
+        if job then
+            redis.call('XADD', KEYS[1], '*', 'data', job)
+            room = room - 1
+            moved = moved + 1
+        end
+        if redis.call('LLEN', queue) == 0 then
+            redis.call('ZREM', KEYS[i], session)
+            redis.call('HDEL', KEYS[3], session)
+        else
+            local weight = tonumber(redis.call('HGET', KEYS[3], session)) or 1
+            redis.call('ZADD', KEYS[i], time + 1 / weight, session)
+        end
+    end
+end
+if moved > 0 then
+    redis.call('DECRBY', KEYS[2], moved)
+end
+return moved
+"""
+
+
+def queue_prefix(channel_name):
+    return f'jobs:{channel_name}:'
+
+
+def schedule_key(channel_name, priority):
+    return f'schedule:{channel_name}:{priority}'
+
+
+def backlog_key(channel_name):
+    return f'backlog:{channel_name}'
+
+
+def weights_key(channel_name):
+    return f'weights:{channel_name}'
+
+
+class Scheduler:
+    """
+    Feeds a channel's stream from the job queues of its sessions, so that the jobs of a small session are not stuck
+    behind those of a large one uploaded before it. The web app queues the jobs of each session apart; listeners
+    call dispatch() before reading from the stream, keeping a few jobs waiting in it.
+    """
+
+    def __init__(self, redis_client, channel_name, group_name, window=SCHEDULE_WINDOW):
+        self.redis_client = redis_client
+        self.channel_name = channel_name
+        self.group_name = group_name
+        self.window = window
+        self.keys = [channel_name, backlog_key(channel_name), weights_key(channel_name)] + \
+            [schedule_key(channel_name, priority) for priority in PRIORITIES]
+        self.script = redis_client.register_script(DISPATCH_SCRIPT)
+
+    def dispatch(self, window=None):
+        """
+        Move jobs to the stream until `window` jobs are waiting in it. Returns the number of jobs moved.
+        """
+        window = self.window if window is None else window
+        return self.script(keys=self.keys, args=[self.group_name, window, queue_prefix(self.channel_name)])
+
+    def backlog(self):
+        """
+        The number of jobs waiting in session queues.
+        """
+        return int(self.redis_client.get(backlog_key(self.channel_name)) or 0)
@@ -0,0 +1,135 @@
+import logging
+import math
+import multiprocessing
+import time
+
+from scheduler import backlog_key
+
+
+class Worker:
+    """
+    A listener process and the event that asks it to stop reading new jobs.
+    """
+
+    def __init__(self, process, stop):
+        self.process = process
+        self.stop = stop
+        self.draining = False
+
+    def drain(self):
+        self.draining = True
+        self.stop.set()
+
+
+class Supervisor:
+    """
+    Keeps between min_workers and max_workers listener processes per channel, sized on the channel's backlog:
+    one worker per jobs_per_worker jobs waiting or in flight. Workers are added as soon as the backlog grows,
+    and only removed once the backlog has stayed low for scale_down_delay seconds. Removed workers finish the jobs
+    they hold before exiting. Workers that exit on their own are replaced.
+
+    `spawn(channel_name, stop)` creates an unstarted process for a channel, which stops when the event is set.
+    """
+
+    def __init__(self, redis_client, channels, spawn, group_name, min_workers=1, max_workers=4, jobs_per_worker=50,
+                 scale_down_delay=60, make_event=multiprocessing.Event):
+        self.redis_client = redis_client
+        self.channels = channels
+        self.spawn = spawn
+        self.group_name = group_name
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.jobs_per_worker = jobs_per_worker
+        self.scale_down_delay = scale_down_delay
+        self.make_event = make_event
+        self.workers = {channel_name: [] for channel_name in channels}
+        # Since when each channel has needed fewer workers than it has
+        self.low_since = {}
+        self.stopping = False
+
+    def queue_depth(self, channel_name):
+        """
+        The number of jobs waiting, in a channel's stream or in the queues of its sessions, and the number delivered
+        but not yet acknowledged. Acknowledged jobs are deleted from the stream, so its length counts both.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.xlen(channel_name)
+        pipe.xpending(channel_name, self.group_name)
+        pipe.get(backlog_key(channel_name))
+        length, pending, backlog = pipe.execute()
+        in_flight = pending['pending']
+        return max(length - in_flight, 0) + int(backlog or 0), in_flight
+
+    def desired_workers(self, waiting, in_flight):
+        needed = math.ceil((waiting + in_flight) / self.jobs_per_worker)
+        return min(max(needed, self.min_workers), self.max_workers)
+
+    def active(self, channel_name):
+        return [worker for worker in self.workers[channel_name] if not worker.draining]
+
+    def reap(self, channel_name):
+        """
+        Forget the workers that exited, logging the ones that were not asked to stop.
+        """
+        alive = []
+        for worker in self.workers[channel_name]:
+            if worker.process.is_alive():
+                alive.append(worker)
+            elif not worker.draining:
+                logging.warning(f"Worker {worker.process.pid} of {channel_name} exited with code "
+                                f"{worker.process.exitcode}, replacing it")
+            else:
+                logging.info(f"Worker {worker.process.pid} of {channel_name} drained")
+        self.workers[channel_name] = alive
+
+    def start_worker(self, channel_name):
+        stop = self.make_event()
+        process = self.spawn(channel_name, stop)
+        process.start()
+        self.workers[channel_name].append(Worker(process, stop))
+
+    def scale(self, channel_name, now=None):
+        now = time.monotonic() if now is None else now
+        self.reap(channel_name)
+        waiting, in_flight = self.queue_depth(channel_name)
+        desired = self.desired_workers(waiting, in_flight)
+        active = self.active(channel_name)
+        if desired >= len(active):
+            self.low_since.pop(channel_name, None)
+            if desired > len(active):
+                logging.info(f"Scaling {channel_name} up to {desired} workers "
+                             f"({waiting} jobs waiting, {in_flight} in flight)")
+            for _ in range(desired - len(active)):
+                self.start_worker(channel_name)
+            return
+        low_since = self.low_since.setdefault(channel_name, now)
+        if now - low_since < self.scale_down_delay:
+            return
+        logging.info(f"Scaling {channel_name} down to {desired} workers "
+                     f"({waiting} jobs waiting, {in_flight} in flight)")
+        # The newest workers are drained first
+        for worker in active[desired:]:
+            worker.drain()
+        self.low_since.pop(channel_name, None)
+
+    def run(self, interval):
+        while not self.stopping:
+            for channel_name in self.channels:
+                self.scale(channel_name)
+            time.sleep(interval)
+        self.shutdown()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def shutdown(self, timeout=None):
+        """
+        Drain every worker and wait for them to exit.
+        """
+        workers = [worker for channel_workers in self.workers.values() for worker in channel_workers]
+        for worker in workers:
+            worker.drain()
+        for worker in workers:
+            worker.process.join(timeout)
+        for channel_name in self.channels:
+            self.reap(channel_name)
@@ -0,0 +1,23 @@
+import logging
+import time
+
+# Completed jobs are counted per channel in buckets of BUCKET_SECONDS, kept for KEEP_SECONDS. The web app estimates
+# the recent throughput of each channel from them to admit uploads and estimate when they will be done.
+BUCKET_SECONDS = 10
+KEEP_SECONDS = 3600
+
+
+def completed_key(channel_name, bucket):
+    return f'completed:{channel_name}:{bucket}'
+
+
+def record_completed(redis_client, channel_name, count=1, now=None):
+    bucket = int((time.time() if now is None else now) // BUCKET_SECONDS)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.incrby(completed_key(channel_name, bucket), count)
+        pipe.expire(completed_key(channel_name, bucket), KEEP_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        # Like metrics, counting a job must never fail it
+        logging.warning(f"Could not record completed jobs of {channel_name}: {e}")
@@ -0,0 +1,39 @@
+import glob
+import os
+import tempfile
+
+# Listener processes write their metrics to files in this directory, and the supervisor's /metrics endpoint adds them
+# up, so that every worker process reports into the same totals. prometheus_client reads the directory when it is
+# imported, so it is set first.
+MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                      os.path.join(tempfile.gettempdir(), 'listener-metrics'))
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
+
+# Latency buckets in seconds, from cache hits to slow inferences
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+
+def reset():
+    """
+    Remove the metric files of the processes of a previous run, before any worker starts.
+    """
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, '*.db')):
+        os.remove(path)
+
+
+def registry():
+    """
+    A registry of the metrics of every listener process.
+    """
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def serve(port):
+    """
+    Serve the metrics of every listener process in the Prometheus text format from a background thread.
+    """
+    return start_http_server(port, registry=registry())
@@ -1,56 +1,44 @@
 import asyncio
 import json
 import os
+import time
 from pathlib import Path
+from types import SimpleNamespace
 
 import redis.asyncio as redis
+import httpx
+import openai
+import redis as sync_redis
 import pytest
 
+# Sets up the multiprocess mode of prometheus_client, which has to happen before server imports it
+import worker_metrics
 import server
 import listener
+import rate_limiter
+import inference_cache
+import batch
+import combined
+import packing
+import scheduler
+import supervisor
+import throughput
+import retry
 import pandas as pd
 
 
-def mock_infer(client, prompt):
-    mock_result = {
-        'response': {
-            'body': {
-                'choices': [
-                    {
-                        'finish_reason': 'stop',
-                        'message': {
-                            'content': json.dumps('mocked response')
-                        }
-                    }
-                ]
-            }
-        }
-    }
-    return mock_result
+def mock_infer(data, client, max_tokens):
+    result = SimpleNamespace(finish_reason='stop', message=SimpleNamespace(content=json.dumps({'mocked': 'response'})))
+    return SimpleNamespace(choices=[result], usage=None)
 
 @pytest.fixture
 def my_client(mocker):
-    mock_client = mocker.MagicMock()
-    mock_client.beta.chat.completions.parse.return_value = {
-        'response': {
-            'body': {
-                'choices': [
-                    {
-                        'finish_reason': 'stop',
-                        'message': {
-                            'content': json.dumps('mocked response')
-                        }
-                    }
-                ]
-            }
-        }
-    }
-    return mock_client
+    return mocker.MagicMock()
 
 @pytest.fixture
 def test_df():
     resource_path = Path(__file__).parent / 'resources' / 'data.csv'
-    return pd.read_csv(resource_path)
+    return pd.read_csv(resource_path, sep='\t')
 
 @pytest.fixture
 async def redisdb():
@@ -58,39 +46,406 @@ async def redisdb():
     redis_port = os.getenv('REDIS_PORT', 6379)
     return await redis.from_url(f"redis://{redis_host}:{redis_port}")
 
+@pytest.fixture
+def sync_redisdb():
+    redis_host = os.getenv('REDIS_HOST', 'localhost')
+    redis_port = os.getenv('REDIS_PORT', 6379)
+    return sync_redis.Redis.from_url(f"redis://{redis_host}:{redis_port}")
 
-@pytest.mark.asyncio
-async def test_infer_study(redisdb, monkeypatch, my_client, test_df):
-    monkeypatch.setattr(server, 'redis_client', redisdb)
-    pubsub = redisdb.pubsub()
-    await pubsub.subscribe(*['study_channel', 'study_result'])
-    await asyncio.sleep(1)
-    await pubsub.get_message()
-    await pubsub.get_message()
-    await server.publish_infos(test_df, 'study_channel')
-    await asyncio.sleep(1)
-    message = await pubsub.get_message()
-    data = json.loads(message['data'].decode('utf-8'))
-    monkeypatch.setattr(listener, 'infer_study', mock_infer)
-    await listener.process_message(redisdb, data, my_client, 'study_channel')
-    await asyncio.sleep(1)
-    message2 = await pubsub.get_message()
-    assert message2['data'].decode('utf-8') == json.dumps('mocked response')
 
 @pytest.mark.asyncio
-async def test_infer_author(redisdb, monkeypatch, my_client, test_df):
+@pytest.mark.parametrize('channel_name, infer', [('study_channel', 'infer_study'), ('author_channel', 'infer_author')])
+async def test_infer(redisdb, sync_redisdb, monkeypatch, my_client, test_df, channel_name, infer):
     monkeypatch.setattr(server, 'redis_client', redisdb)
-    pubsub = redisdb.pubsub()
-    await pubsub.subscribe(*['author_channel', 'author_result'])
-    await asyncio.sleep(1)
-    await pubsub.get_message()
-    await pubsub.get_message()
-    await server.publish_infos(test_df, 'author_channel')
-    await asyncio.sleep(1)
-    message = await pubsub.get_message()
-    data = json.loads(message['data'].decode('utf-8'))
-    monkeypatch.setattr(listener, 'infer_author', mock_infer)
-    await listener.process_message(redisdb, data, my_client, 'author_channel')
-    await asyncio.sleep(1)
-    message2 = await pubsub.get_message()
-    assert message2['data'].decode('utf-8') == json.dumps('mocked response')
+    await redisdb.delete(channel_name, 'result:infer-session')
+    tasks, _ = await server.publish_infos(test_df, channel_name, 'infer-session')
+    await asyncio.gather(*tasks)
+    entries = await redisdb.xrange(channel_name)
+    data = json.loads(entries[0][1][b'data'].decode('utf-8'))
+    monkeypatch.setattr(listener, infer, mock_infer)
+    listener.process_message(sync_redisdb, data, my_client, channel_name)
+    [(_, fields)] = sync_redisdb.xrange('result:infer-session')
+    result = json.loads(fields[b'data'])
+    assert result['payload'] == {'mocked': 'response'}
+    assert (result['id'], result['channel'], result['session_id']) == (0, channel_name, 'infer-session')
+    assert result['source'] == data['payload']
+
+def test_claim_stale_jobs(sync_redisdb):
+    channel_name = 'test_claim_channel'
+    sync_redisdb.delete(channel_name)
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    sync_redisdb.xadd(channel_name, {'data': json.dumps({'id': 0})})
+    # A consumer reads the job and dies before acknowledging it
+    sync_redisdb.xreadgroup('listener', 'dead-consumer', {channel_name: '>'}, count=1)
+    assert listener.claim_stale_jobs(sync_redisdb, channel_name, 'listener', 'live-consumer', 60000, 10) == []
+    entries = listener.claim_stale_jobs(sync_redisdb, channel_name, 'listener', 'live-consumer', 0, 10)
+    assert len(entries) == 1
+    listener.ack_job(sync_redisdb, channel_name, 'listener', entries[0][0])
+    assert sync_redisdb.xpending(channel_name, 'listener')['pending'] == 0
+    assert sync_redisdb.xlen(channel_name) == 0
+
+def test_claim_stale_jobs_gives_up(sync_redisdb, monkeypatch):
+    channel_name = 'test_poison_channel'
+    sync_redisdb.delete(channel_name, 'dead:test_poison_channel', 'result:poison-session')
+    monkeypatch.setattr(listener, 'MAX_DELIVERIES', 2)
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    data = {'id': 0, 'payload': {'disclosure': 'None.', 'title': 'Poison'}, 'session_id': 'poison-session'}
+    sync_redisdb.xadd(channel_name, {'data': json.dumps(data)})
+    retries = retry.RetryQueue(sync_redisdb, channel_name, max_attempts=5, base_delay=0, max_delay=0)
+    # The job crashes every worker that reads it
+    sync_redisdb.xreadgroup('listener', 'dead-consumer', {channel_name: '>'}, count=1)
+    assert len(listener.claim_stale_jobs(sync_redisdb, channel_name, 'listener', 'worker-1', 0, 10, retries)) == 1
+    assert listener.claim_stale_jobs(sync_redisdb, channel_name, 'listener', 'worker-2', 0, 10, retries) == []
+    assert sync_redisdb.xpending(channel_name, 'listener')['pending'] == 0
+    [(_, fields)] = sync_redisdb.xrange('dead:test_poison_channel')
+    assert fields[b'error'] == b'Delivered 3 times without finishing'
+    [(_, fields)] = sync_redisdb.xrange('result:poison-session')
+    assert json.loads(fields[b'data'])['error'] == 'Inference did not finish. Try again later.'
+    sync_redisdb.delete(channel_name, 'dead:test_poison_channel', 'result:poison-session')
+
+def test_rate_limiter(sync_redisdb):
+    sync_redisdb.delete('ratelimit:requests', 'ratelimit:tokens')
+    limiter = rate_limiter.RateLimiter(sync_redisdb, requests_per_minute=2, tokens_per_minute=1000)
+    limiter.acquire(600)
+    # The token bucket is short of 600 tokens and must wait for the refill
+    assert limiter.tokens.take(600) > 0
+    # A request that used fewer tokens than estimated gives the difference back
+    limiter.settle(600, 100)
+    assert limiter.tokens.take(600) == 0
+    assert limiter.requests.take(1) == 0
+    assert limiter.requests.take(1) > 0
+
+def test_inference_cache(sync_redisdb, monkeypatch, mocker):
+    sync_redisdb.delete(inference_cache.STATS_KEY)
+    result = mocker.MagicMock()
+    result.choices[0].finish_reason = 'stop'
+    result.choices[0].message.content = json.dumps({'study_info': []})
+    mock_infer_study = mocker.MagicMock(return_value=result)
+    monkeypatch.setattr(listener, 'infer_study', mock_infer_study)
+    monkeypatch.setattr(listener, 'build_study_prompt', lambda data: [{'role': 'user', 'content': data['disclosure']}])
+    cache = inference_cache.InferenceCache(sync_redisdb, 60)
+    payload = {'disclosure': 'The author declares no conflict of interest.', 'title': 'Cached'}
+    sync_redisdb.delete(cache.key('study_channel', listener.MODELS['study_channel'],
+                                  listener.build_study_prompt(payload)))
+    first = listener.infer_content(payload, None, 'study_channel', cache=cache)
+    second = listener.infer_content(payload, None, 'study_channel', cache=cache)
+    assert first == second == json.dumps({'study_info': []})
+    assert mock_infer_study.call_count == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+def test_combined_results(sync_redisdb, monkeypatch, mocker):
+    result = mocker.MagicMock()
+    result.choices[0].finish_reason = 'stop'
+    result.choices[0].message.content = json.dumps({
+        'study_info': [{'org_name': 'Pfizer', 'relationships': []}],
+        'author_info': [{'author_name': 'A. Author', 'organization': []}]
+    })
+    mock_infer_combined = mocker.MagicMock(return_value=result)
+    monkeypatch.setattr(listener, 'infer_combined', mock_infer_combined)
+    sync_redisdb.delete('result:combined-session')
+    payload = {'authors': ['A. Author'], 'disclosure': 'Funded by Pfizer.', 'title': 'Combined',
+               'affiliation': ['McGill'], 'email': ['a@mcgill.ca']}
+    data = {'id': 0, 'payload': payload, 'channel': 'paper_channel', 'session_id': 'combined-session'}
+    listener.process_message(sync_redisdb, data, None, 'paper_channel')
+    assert mock_infer_combined.call_count == 1
+    results = [json.loads(fields[b'data']) for _, fields in sync_redisdb.xrange('result:combined-session')]
+    assert [result['channel'] for result in results] == ['study_channel', 'author_channel']
+    assert results[0]['source'] == {'disclosure': 'Funded by Pfizer.', 'title': 'Combined'}
+    assert results[0]['payload'] == {'study_info': [{'org_name': 'Pfizer', 'relationships': []}]}
+    assert results[1]['source'] == payload
+    assert results[1]['payload'] == {'author_info': [{'author_name': 'A. Author', 'organization': []}]}
+
+def test_combined_prompt():
+    payload = {'authors': ['A. Author'], 'disclosure': 'Funded by Pfizer.', 'title': 'Combined',
+               'affiliation': ['McGill'], 'email': ['a@mcgill.ca']}
+    prompt = combined.build_prompt(payload)
+    assert 'study_info' in prompt[0]['content'][0]['text']
+    assert 'author_info' in prompt[0]['content'][0]['text']
+    assert prompt[1]['content'][0]['text'] == "Authors: ['A. Author']\nStatement: Funded by Pfizer."
+
+class FakeProcess:
+
+    def __init__(self, stop):
+        self.stop = stop
+        self.pid = None
+        self.exitcode = None
+        self.crashed = False
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return not (self.stop.is_set() or self.crashed)
+
+    def join(self, timeout=None):
+        pass
+
+def test_supervisor_scaling(sync_redisdb):
+    channel_name = 'test_scaling_channel'
+    sync_redisdb.delete(channel_name)
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    scaler = supervisor.Supervisor(sync_redisdb, [channel_name], lambda channel, stop: FakeProcess(stop), 'listener',
+                                   min_workers=1, max_workers=3, jobs_per_worker=10, scale_down_delay=60)
+    scaler.scale(channel_name, now=0)
+    assert len(scaler.active(channel_name)) == 1
+    ids = [sync_redisdb.xadd(channel_name, {'data': '{}'}) for _ in range(25)]
+    scaler.scale(channel_name, now=1)
+    assert len(scaler.active(channel_name)) == 3
+    # A crashed worker is replaced
+    scaler.workers[channel_name][0].process.crashed = True
+    scaler.scale(channel_name, now=2)
+    assert len(scaler.workers[channel_name]) == 3
+    # Workers are drained only once the backlog has been low for the scale down delay
+    sync_redisdb.xdel(channel_name, *ids)
+    scaler.scale(channel_name, now=3)
+    assert len(scaler.active(channel_name)) == 3
+    scaler.scale(channel_name, now=70)
+    assert len(scaler.active(channel_name)) == 1
+    scaler.scale(channel_name, now=71)
+    assert len(scaler.workers[channel_name]) == 1
+    scaler.shutdown()
+    assert scaler.workers[channel_name] == []
+
+def test_fair_dispatch(sync_redisdb):
+    channel_name = 'test_fair_channel'
+    sessions = ['bulk', 'small', 'heavy', 'urgent']
+    schedules = [scheduler.schedule_key(channel_name, priority) for priority in scheduler.PRIORITIES]
+    sync_redisdb.delete(channel_name, scheduler.backlog_key(channel_name), scheduler.weights_key(channel_name),
+                        *schedules, *(scheduler.queue_prefix(channel_name) + session for session in sessions))
+
+    def queue(session, count, priority='normal', weight=1):
+        sync_redisdb.rpush(scheduler.queue_prefix(channel_name) + session,
+                           *[json.dumps({'id': i, 'session_id': session}) for i in range(count)])
+        sync_redisdb.incrby(scheduler.backlog_key(channel_name), count)
+        sync_redisdb.hset(scheduler.weights_key(channel_name), session, weight)
+        # New sessions start at the virtual time of the session served next, as the web app queues them
+        head = sync_redisdb.zrange(scheduler.schedule_key(channel_name, priority), 0, 0, withscores=True)
+        sync_redisdb.zadd(scheduler.schedule_key(channel_name, priority), {session: head[0][1] if head else 0})
+
+    def dispatched():
+        entries = sync_redisdb.xrange(channel_name)
+        sync_redisdb.delete(channel_name)
+        return [json.loads(fields[b'data'])['session_id'] for _, fields in entries]
+
+    queue('bulk', 100)
+    queue('small', 2)
+    jobs = scheduler.Scheduler(sync_redisdb, channel_name, 'listener', window=4)
+    # Sessions take turns, and no more jobs are dispatched while the window is full
+    assert jobs.dispatch() == 4
+    assert jobs.dispatch() == 0
+    assert dispatched() == ['bulk', 'small', 'bulk', 'small']
+    assert sync_redisdb.zrange(schedules[1], 0, -1) == [b'bulk']
+    # A session of weight 2 gets twice the jobs, and sessions of a higher priority go first
+    queue('heavy', 10, weight=2)
+    queue('urgent', 1, priority='high')
+    assert jobs.dispatch(window=7) == 7
+    assert dispatched() == ['urgent', 'bulk', 'heavy', 'heavy', 'bulk', 'heavy', 'heavy']
+    assert jobs.backlog() == 100 + 2 + 10 + 1 - 11
+
+def test_handle_messages_drains(sync_redisdb, monkeypatch, mocker):
+    channel_name = 'test_drain_channel'
+    sync_redisdb.delete(channel_name, 'result:drain-session',
+                        *sync_redisdb.scan_iter(throughput.completed_key(channel_name, '*')))
+    monkeypatch.setenv('STREAM_BLOCK_MS', '100')
+    process_message = mocker.MagicMock()
+    monkeypatch.setattr(listener, 'process_message', process_message)
+    data = {'id': 0, 'payload': {'disclosure': 'None.', 'title': 'Drain'}, 'session_id': 'drain-session'}
+    sync_redisdb.xadd(channel_name, {'data': json.dumps(data)})
+    stop = mocker.MagicMock()
+    # The job is read on the first iteration, then the listener is asked to stop
+    stop.is_set.side_effect = [False, True]
+    listener.handle_messages(channel_name, None, sync_redisdb, stop=stop)
+    assert process_message.call_count == 1
+    # The job is counted towards the channel's throughput
+    bucket = int(time.time() // throughput.BUCKET_SECONDS)
+    assert sum(int(sync_redisdb.get(throughput.completed_key(channel_name, b)) or 0) for b in (bucket - 1, bucket)) == 1
+    assert sync_redisdb.xlen(channel_name) == 0
+    assert sync_redisdb.xinfo_consumers(channel_name, 'listener') == []
+
+def test_worker_metrics(monkeypatch, mocker):
+    def sample(name, **labels):
+        return worker_metrics.registry().get_sample_value(name, labels) or 0
+    # Metric files outlive the test process, so the test compares values before and after
+    samples = [('listener_inference_seconds_count', {'channel': 'study_channel'}),
+               ('listener_inference_tokens_total', {'channel': 'study_channel', 'kind': 'prompt'}),
+               ('listener_finish_reasons_total', {'channel': 'study_channel', 'finish_reason': 'length'}),
+               ('listener_queue_wait_seconds_bucket', {'channel': 'study_channel', 'le': '5.0'}),
+               ('listener_queue_wait_seconds_count', {'channel': 'study_channel'})]
+    before = [sample(name, **labels) for name, labels in samples]
+    result = mocker.MagicMock()
+    result.choices[0].finish_reason = 'length'
+    result.usage.prompt_tokens = 120
+    result.usage.completion_tokens = 30
+    monkeypatch.setattr(listener, 'infer_study', mocker.MagicMock(return_value=result))
+    with pytest.raises(retry.InferenceError):
+        listener.infer_content({'disclosure': 'None.', 'title': 'Metrics'}, None, 'study_channel')
+    listener.record_queue_wait(b'1000-0', 'study_channel')
+    after = [sample(name, **labels) for name, labels in samples]
+    assert [a - b for a, b in zip(after, before)] == [1, 120, 1, 0, 1]
+    types = {metric.name: metric.type for metric in worker_metrics.registry().collect()}
+    assert types['listener_inference_seconds'] == 'histogram'
+
+def test_retry_and_dead_letter(sync_redisdb, monkeypatch, mocker):
+    channel_name = 'study_channel'
+    sync_redisdb.delete('retry:study_channel', 'dead:study_channel', 'result:retry-session', channel_name)
+    result = mocker.MagicMock()
+    result.choices[0].finish_reason = 'length'
+    mock_infer_study = mocker.MagicMock(return_value=result)
+    monkeypatch.setattr(listener, 'infer_study', mock_infer_study)
+    # A first attempt below the model's limit leaves room for a bigger budget on the retry
+    monkeypatch.setattr(listener, 'INFERENCE_MAX_TOKENS', 4096)
+    retries = retry.RetryQueue(sync_redisdb, channel_name, max_attempts=2, base_delay=0, max_delay=0)
+    data = {'id': 0, 'payload': {'disclosure': 'None.', 'title': 'Retry'}, 'channel': channel_name,
+            'session_id': 'retry-session'}
+    assert not listener.process_message(sync_redisdb, data, None, channel_name, retries=retries)
+    assert mock_infer_study.call_args.args[2] == 4096
+    assert sync_redisdb.xlen('result:retry-session') == 0
+    assert retries.requeue_due() == 1
+    [(_, fields)] = sync_redisdb.xrange(channel_name)
+    retried = json.loads(fields[b'data'])
+    # A truncated answer is retried with a bigger completion budget
+    assert retried['attempt'] == 1
+    assert retried['max_tokens'] == 2 * 4096
+    assert listener.process_message(sync_redisdb, retried, None, channel_name, retries=retries)
+    assert mock_infer_study.call_args.args[2] == 2 * 4096
+    [(_, fields)] = sync_redisdb.xrange('dead:study_channel')
+    assert json.loads(fields[b'data'])['attempt'] == 1
+    [(_, fields)] = sync_redisdb.xrange('result:retry-session')
+    assert json.loads(fields[b'data'])['error'] == 'Inference did not finish. Try again later.'
+
+def test_retry_delay(sync_redisdb):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(429, headers={'retry-after': '20'}, request=request)
+    error = openai.RateLimitError('Rate limited', response=response, body=None)
+    assert retry.retry_after(error) == 20
+    assert retry.is_retryable(error)
+    retries = retry.RetryQueue(sync_redisdb, 'study_channel', max_attempts=5, base_delay=1, max_delay=60)
+    assert retries.delay(error, 0) == 20
+    assert 4 <= retries.delay(ValueError('Invalid JSON'), 3) <= 8
+    response = httpx.Response(400, request=request)
+    assert not retry.is_retryable(openai.BadRequestError('Bad request', response=response, body=None))
+
+def test_run_batch(sync_redisdb, monkeypatch):
+    channel_name = 'test_batch_channel'
+    monkeypatch.setitem(listener.MODELS, channel_name, listener.MODELS['study_channel'])
+    monkeypatch.setitem(listener.RESULT_MODELS, channel_name, listener.RESULT_MODELS['study_channel'])
+
+    def build_prompt(data, channel):
+        if not data['disclosure']:
+            raise ValueError('Empty disclosure')
+        return [{'role': 'user', 'content': data['disclosure']}]
+
+    monkeypatch.setattr(listener, 'build_prompt', build_prompt)
+    sync_redisdb.delete(channel_name, 'result:batch-session')
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    for i, disclosure in enumerate(['Funded by Pfizer.', 'Too long to finish.', '']):
+        data = {'id': i, 'payload': {'disclosure': disclosure, 'title': f'Title {i}'}, 'channel': channel_name,
+                'session_id': 'batch-session'}
+        sync_redisdb.xadd(channel_name, {'data': json.dumps(data)})
+
+    def respond(body):
+        finished = body['messages'][0]['content'] == 'Funded by Pfizer.'
+        content = json.dumps({'study_info': [{'org_name': 'Pfizer', 'relationships': []}]})
+        return {'choices': [{'finish_reason': 'stop' if finished else 'length', 'message': {'content': content}}]}
+
+    entries = listener.collect_jobs(sync_redisdb, channel_name, 'listener', 'batcher', 10, 100, 60000)
+    assert len(entries) == 3
+    listener.run_batch(entries, channel_name, 'listener', 'batcher', sync_redisdb, batch.LocalBatchClient(respond))
+    results = sorted((json.loads(fields[b'data']) for _, fields in sync_redisdb.xrange('result:batch-session')),
+                     key=lambda result: result['id'])
+    assert [result['id'] for result in results] == [0, 1, 2]
+    assert results[0]['payload'] == {'study_info': [{'org_name': 'Pfizer', 'relationships': []}]}
+    assert results[0]['source'] == {'disclosure': 'Funded by Pfizer.', 'title': 'Title 0'}
+    assert results[1]['error'] == 'Inference did not finish. Try again later.'
+    # A job whose prompt cannot be built fails on its own, without stopping the batch
+    assert results[2]['error'] == 'Inference did not finish. Try again later.'
+    assert sync_redisdb.xpending(channel_name, 'listener')['pending'] == 0
+
+def test_packing():
+    packer = packing.Packer(token_budget=100, max_jobs=3, max_job_tokens=50)
+    packs, singles = packer.pack([('a', 40), ('b', 60), ('c', 30), ('d', 30), ('e', 20), ('f', 10), ('g', 45)])
+    # b is too long to pack; the rest are packed first-fit from the longest down
+    assert packs == [['g', 'a', 'f'], ['c', 'd', 'e']]
+    assert singles == ['b']
+    prompts = [[{'role': 'system', 'content': [{'type': 'text', 'text': 'Extract.'}]},
+                {'role': 'user', 'content': [{'type': 'text', 'text': disclosure}]}]
+               for disclosure in ('None.', 'Funded by Pfizer.')]
+    prompt = packing.build_prompt(prompts)
+    assert prompt[0]['content'][0]['text'] == 'Extract.' + packing.PACK_INSTRUCTIONS
+    assert prompt[1]['content'][0]['text'] == 'Paper 1:\nNone.\n\nPaper 2:\nFunded by Pfizer.'
+    schema = listener.PACKED_RESULT_MODELS['study_channel'].model_json_schema()
+    assert schema['required'] == ['papers']
+
+def test_packed_results(sync_redisdb, monkeypatch, mocker):
+    channel_name = 'study_channel'
+    monkeypatch.setattr(listener, 'build_study_prompt', lambda data: [
+        {'role': 'system', 'content': [{'type': 'text', 'text': 'Extract.'}]},
+        {'role': 'user', 'content': [{'type': 'text', 'text': data['disclosure']}]}])
+    sync_redisdb.delete(channel_name, 'result:pack-session', 'retry:study_channel')
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    disclosures = ['The author declares no conflict of interest.', 'Funded by Pfizer.', 'None.',
+                   'Funded by Merck. ' * 100]
+    for i, disclosure in enumerate(disclosures):
+        data = {'id': i, 'payload': {'disclosure': disclosure, 'title': f'Title {i}'}, 'channel': channel_name,
+                'session_id': 'pack-session'}
+        sync_redisdb.xadd(channel_name, {'data': json.dumps(data)})
+    entries = sync_redisdb.xreadgroup('listener', 'packer', {channel_name: '>'}, count=10)[0][1]
+    packer = packing.Packer(token_budget=1000, max_jobs=10, max_job_tokens=100)
+    [jobs], singles = listener.pack_entries(packer, entries, channel_name)
+    assert [data['id'] for _, data, _ in jobs] == [0, 1, 2]
+    assert [json.loads(fields[b'data'])['id'] for _, fields in singles] == [3]
+    result = mocker.MagicMock()
+    result.choices[0].finish_reason = 'stop'
+    # The answer is out of order and leaves the third paper out
+    result.choices[0].message.content = json.dumps({'papers': [
+        {'paper': 2, 'study_info': [{'org_name': 'Pfizer', 'relationships': []}]},
+        {'paper': 1, 'study_info': []}]})
+    complete = mocker.MagicMock(return_value=result)
+    monkeypatch.setattr(listener, 'complete', complete)
+    retries = retry.RetryQueue(sync_redisdb, channel_name, max_attempts=2, base_delay=0, max_delay=0)
+    listener.handle_pack(jobs, channel_name, 'listener', None, sync_redisdb, None, None, retries)
+    assert complete.call_count == 1
+    assert complete.call_args.kwargs['packed']
+    results = [json.loads(fields[b'data']) for _, fields in sync_redisdb.xrange('result:pack-session')]
+    assert [result['id'] for result in results] == [0, 1]
+    assert results[1]['payload'] == {'study_info': [{'org_name': 'Pfizer', 'relationships': []}]}
+    assert results[1]['source'] == {'disclosure': 'Funded by Pfizer.', 'title': 'Title 1'}
+    assert sync_redisdb.xpending(channel_name, 'listener')['pending'] == 1
+    # The paper left out is retried alone
+    assert retries.requeue_due() == 1
+    entries = sync_redisdb.xreadgroup('listener', 'packer', {channel_name: '>'}, count=10)[0][1]
+    packs, singles = listener.pack_entries(packer, entries, channel_name)
+    assert packs == [] and json.loads(singles[0][1][b'data'])['id'] == 2
+
+
+def test_failed_pack_retried_alone(sync_redisdb, monkeypatch, mocker):
+    channel_name = 'study_channel'
+    monkeypatch.setattr(listener, 'build_study_prompt', lambda data: [
+        {'role': 'system', 'content': [{'type': 'text', 'text': 'Extract.'}]},
+        {'role': 'user', 'content': [{'type': 'text', 'text': data['disclosure']}]}])
+    sync_redisdb.delete(channel_name, 'result:pack-session', 'retry:study_channel', 'dead:study_channel',
+                        *sync_redisdb.scan_iter(throughput.completed_key(channel_name, '*')))
+    listener.ensure_group(sync_redisdb, channel_name, 'listener')
+    for i, disclosure in enumerate(['Funded by Pfizer.', 'None.', 'Funded by Merck.']):
+        data = {'id': i, 'payload': {'disclosure': disclosure, 'title': f'Title {i}'}, 'channel': channel_name,
+                'session_id': 'pack-session'}
+        sync_redisdb.xadd(channel_name, {'data': json.dumps(data)})
+    entries = sync_redisdb.xreadgroup('listener', 'packer', {channel_name: '>'}, count=10)[0][1]
+    packer = packing.Packer(token_budget=1000, max_jobs=10, max_job_tokens=100)
+    [jobs], _ = listener.pack_entries(packer, entries, channel_name)
+    response = httpx.Response(400, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    # One bad disclosure fails the whole pack with a permanent error
+    monkeypatch.setattr(listener, 'complete', mocker.MagicMock(
+        side_effect=openai.BadRequestError('Invalid prompt', response=response, body=None)))
+    retries = retry.RetryQueue(sync_redisdb, channel_name, max_attempts=2, base_delay=0, max_delay=0)
+    listener.handle_pack(jobs, channel_name, 'listener', None, sync_redisdb, None, None, retries)
+    assert sync_redisdb.xlen('dead:study_channel') == 0
+    assert sync_redisdb.xlen('result:pack-session') == 0
+    # Jobs scheduled for another attempt do not count towards the channel's throughput until they are done
+    assert list(sync_redisdb.scan_iter(throughput.completed_key(channel_name, '*'))) == []
+    assert retries.requeue_due() == 3
+    entries = sync_redisdb.xreadgroup('listener', 'packer', {channel_name: '>'}, count=10)[0][1]
+    packs, singles = listener.pack_entries(packer, entries, channel_name)
+    assert packs == [] and sorted(json.loads(fields[b'data'])['id'] for _, fields in singles) == [0, 1, 2]
+    sync_redisdb.delete(channel_name, 'result:pack-session', 'retry:study_channel', 'dead:study_channel')
@@ -0,0 +1,101 @@
+import math
+import os
+import time
+
+CHANNELS = ('author_channel', 'study_channel', 'paper_channel')
+# Listeners count completed jobs in buckets of BUCKET_SECONDS, see the listener's throughput module
+BUCKET_SECONDS = 10
+# Seconds of completed jobs the throughput of a channel is measured over
+THROUGHPUT_WINDOW = int(os.getenv('THROUGHPUT_WINDOW', 300))
+# Longest the queued jobs may take to be done for an upload to be accepted; beyond it, uploads are deferred.
+# 0 for no limit.
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 3600))
+# Most jobs queued across channels, whatever the throughput; beyond it, uploads are rejected. 0 for no limit.
+ADMISSION_MAX_JOBS = int(os.getenv('ADMISSION_MAX_JOBS', 100000))
+# Seconds a rejected upload is asked to wait when the throughput is unknown
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 60))
+
+ACCEPT, DEFER, REJECT = 'accept', 'defer', 'reject'
+
+
+def completed_key(channel_name, bucket):
+    return f'completed:{channel_name}:{bucket}'
+
+
+class Decision:
+    """
+    Whether to accept, defer or reject an upload, when to try again if it is not accepted, and the seconds until
+    the jobs already queued are done, or None if the throughput is unknown.
+    """
+
+    def __init__(self, action, retry_after=None, eta=None):
+        self.action = action
+        self.retry_after = retry_after
+        self.eta = eta
+
+
+class Admission:
+    """
+    Admits uploads on the jobs queued on each channel, waiting or in flight, and the rate at which listeners completed
+    jobs recently. An upload is deferred while the queued jobs would take more than max_wait seconds to be done, and
+    rejected while max_jobs or more are queued; either way it is told when to try again. The queue can thus only
+    grow by one upload past these bounds.
+    """
+
+    def __init__(self, redis_client, max_wait=ADMISSION_MAX_WAIT, max_jobs=ADMISSION_MAX_JOBS,
+                 window=THROUGHPUT_WINDOW, retry_after=ADMISSION_RETRY_AFTER):
+        self.redis_client = redis_client
+        self.max_wait = max_wait
+        self.max_jobs = max_jobs
+        self.window = window
+        self.retry_after = retry_after
+
+    async def load(self, now=None):
+        """
+        The jobs queued on each channel and its throughput in jobs per second, or None if no job completed within
+        the window.
+        """
+        current = int((time.time() if now is None else now) // BUCKET_SECONDS)
+        # Only whole buckets are counted
+        buckets = range(current - max(self.window // BUCKET_SECONDS, 1), current)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for channel_name in CHANNELS:
+            # Acknowledged jobs are deleted from the stream, so its length counts the jobs waiting and in flight
+            pipe.xlen(channel_name)
+            pipe.get(f'backlog:{channel_name}')
+            pipe.mget([completed_key(channel_name, bucket) for bucket in buckets])
+        responses = await pipe.execute()
+        load = {}
+        for i, channel_name in enumerate(CHANNELS):
+            length, backlog, completed = responses[3 * i:3 * i + 3]
+            completed = [int(count) for count in completed if count]
+            # Buckets without completed jobs are left out, so that idle time does not count as slowness
+            rate = sum(completed) / (len(completed) * BUCKET_SECONDS) if completed else None
+            load[channel_name] = (length + int(backlog or 0), rate)
+        return load
+
+    @staticmethod
+    def eta(load):
+        """
+        Seconds until every queued job is done, with the channels running in parallel, or None if a channel with
+        queued jobs has no measured throughput.
+        """
+        etas = [queued / rate if rate else None for queued, rate in load.values() if queued]
+        if None in etas:
+            return None
+        return max(etas, default=0)
+
+    async def estimate(self):
+        return self.eta(await self.load())
+
+    async def check(self):
+        load = await self.load()
+        eta = self.eta(load)
+        queued = sum(queued for queued, _ in load.values())
+        if self.max_jobs and queued >= self.max_jobs:
+            rate = sum(rate or 0 for _, rate in load.values())
+            retry_after = math.ceil((queued - self.max_jobs + 1) / rate) if rate else self.retry_after
+            return Decision(REJECT, retry_after, eta)
+        if self.max_wait and eta is not None and eta > self.max_wait:
+            return Decision(DEFER, math.ceil(eta - self.max_wait), eta)
+        return Decision(ACCEPT, eta=eta)
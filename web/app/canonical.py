@@ -0,0 +1,156 @@
+import os
+import re
+import unicodedata
+from collections import defaultdict
+
+# Names whose character trigrams are at least this similar (Dice coefficient) are the same entity
+SIMILARITY_THRESHOLD = float(os.getenv('CANONICAL_THRESHOLD', 0.9))
+# Words shared by more names than this, like "university", are too common to find candidates with; a name made only
+# of such words is matched by its normalized key alone
+MAX_BLOCK_SIZE = int(os.getenv('CANONICAL_MAX_BLOCK_SIZE', 200))
+
+LEGAL_SUFFIXES = {'inc', 'incorporated', 'corp', 'corporation', 'co', 'company', 'ltd', 'limited', 'llc', 'lp',
+                  'llp', 'plc', 'gmbh', 'ag', 'sa', 'nv', 'bv', 'srl', 'spa', 'kk'}
+AUTHOR_TITLES = {'dr', 'prof', 'professor', 'mr', 'mrs', 'ms', 'phd', 'md', 'msc', 'mph', 'rn', 'jr', 'sr'}
+NON_WORD = re.compile(r'[^\w]+')
+DIGITS = re.compile(r'\d+')
+
+
+def words(name):
+    # Accents are dropped and case folded, so that "Hôpital" and "HOPITAL" are the same word
+    name = unicodedata.normalize('NFKD', name.replace('&', ' and '))
+    name = ''.join(char for char in name if not unicodedata.combining(char)).casefold()
+    return NON_WORD.sub(' ', name).split()
+
+
+def normalize_org(org_name):
+    """
+    The key of an org name: its words without a leading "the" and trailing legal forms, e.g. "pfizer" for
+    "Pfizer Inc." and "The Pfizer Company", and "merck" for "Merck & Co.".
+    """
+    tokens = words(org_name)
+    if len(tokens) > 1 and tokens[0] == 'the':
+        tokens = tokens[1:]
+    while len(tokens) > 1 and tokens[-1] in LEGAL_SUFFIXES:
+        tokens = tokens[:-1]
+        # The "and" of "& Co." or "and Company" goes with the legal form
+        if len(tokens) > 1 and tokens[-1] == 'and':
+            tokens = tokens[:-1]
+    return ' '.join(tokens)
+
+
+def normalize_author(author_name):
+    """
+    The key of an author name: its words without titles and degrees, e.g. "john smith" for "Dr. John Smith, PhD".
+    """
+    tokens = [token for token in words(author_name) if token not in AUTHOR_TITLES]
+    return ' '.join(tokens or words(author_name))
+
+
+def trigrams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def blocking_keys(key):
+    # The words of a name and its pairs of adjacent words: a near-duplicate differs in a few characters, so it still
+    # has most of them, and pairs stay uncommon when the words themselves are not, as in "national health"
+    tokens = key.split()
+    return set(tokens) | {f'{first} {second}' for first, second in zip(tokens, tokens[1:])}
+
+
+def numbers(key):
+    return DIGITS.findall(key)
+
+
+class Canonicalizer:
+    """
+    Assigns names that are the same up to normalization or a few characters to one canonical ID. IDs are numbered
+    from 0 in order of first appearance and never change, and the first name of each ID is its canonical name.
+
+    Names with the same normalized key are matched with a dict lookup. Other names are compared, by the similarity
+    of their character trigrams, only with the canonical names they share an uncommon word or pair of words with.
+    These are found through an inverted index, so the cost of adding a name does not grow with the number of names.
+    """
+
+    def __init__(self, normalize=normalize_org, threshold=SIMILARITY_THRESHOLD, max_block_size=MAX_BLOCK_SIZE):
+        self.normalize = normalize
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.name_ids = {}
+        self.ids = {}
+        self.names = []
+        self.keys = []
+        self.grams = []
+        self.index = defaultdict(list)
+
+    def __len__(self):
+        return len(self.names)
+
+    def match(self, key):
+        grams = trigrams(key)
+        min_size, max_size = self.threshold * len(grams) / (2 - self.threshold), \
+            len(grams) * (2 - self.threshold) / self.threshold
+        best, best_score, seen = None, self.threshold, set()
+        for block_key in blocking_keys(key):
+            block = self.index.get(block_key, ())
+            if len(block) > self.max_block_size:
+                continue
+            for canonical_id in block:
+                candidate = self.grams[canonical_id]
+                if canonical_id in seen or not min_size <= len(candidate) <= max_size:
+                    continue
+                seen.add(canonical_id)
+                score = 2 * len(grams & candidate) / (len(grams) + len(candidate))
+                # Names that only differ by a number, like "Study Group 1" and "Study Group 2", stay apart
+                if score >= best_score and numbers(key) == numbers(self.keys[canonical_id]):
+                    best, best_score = canonical_id, score
+        return best
+
+    def new_id(self, name, key):
+        canonical_id = len(self.names)
+        self.names.append(name)
+        self.keys.append(key)
+        self.grams.append(trigrams(key))
+        for block_key in blocking_keys(key):
+            self.index[block_key].append(canonical_id)
+        return canonical_id
+
+    def add(self, name):
+        """
+        The canonical ID of a name, assigning a new one if it matches no name seen before.
+        """
+        if name in self.name_ids:
+            return self.name_ids[name]
+        key = self.normalize(name)
+        if key not in self.ids:
+            canonical_id = self.match(key) if key else None
+            self.ids[key] = self.new_id(name, key) if canonical_id is None else canonical_id
+        self.name_ids[name] = self.ids[key]
+        return self.ids[key]
+
+    def register(self, name):
+        """
+        Add a name known to be canonical, e.g. one loaded from the result store, without looking for a match.
+        """
+        key = self.normalize(name)
+        if key not in self.ids:
+            self.ids[key] = self.new_id(name, key)
+        self.name_ids[name] = self.ids[key]
+        return self.ids[key]
+
+
+class AuthorCanonicalizer:
+    """
+    Assigns authors to canonical IDs. Authors are the same person when their names match and they have the same
+    email, or, without an email, the same affiliation.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_block_size=MAX_BLOCK_SIZE):
+        self.names = Canonicalizer(normalize_author, threshold, max_block_size)
+        self.ids = {}
+
+    def add(self, author_name, affiliation, email, register=False):
+        name_id = self.names.register(author_name) if register else self.names.add(author_name)
+        contact = email.strip().casefold() if email else normalize_org(affiliation or '')
+        return self.ids.setdefault((name_id, contact), len(self.ids))
@@ -0,0 +1,132 @@
+import asyncio
+import glob
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+
+from pandas import DataFrame
+
+# Archives up to this size are built in memory, larger ones spill to a temporary file
+SPOOL_MAX_SIZE = int(os.getenv('EXPORT_SPOOL_MAX_SIZE', 64 * 1024 * 1024))
+# Directory the archives are stored in, shared by the web replicas. Redis only keeps the name of each session's archive.
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+# Seconds an archive is kept for download after its session finished
+EXPORT_TTL = int(os.getenv('EXPORT_TTL', 24 * 3600))
+CHUNK_SIZE = 1024 * 1024
+
+# File extension of the tables in each export format. Parquet and Arrow IPC need pyarrow, which is optional.
+EXPORT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+# Columns holding IDs of other tables or a few distinct values, dictionary-encoded in the columnar formats
+DICTIONARY_COLUMNS = ['source', 'entity', 'author', 'relationship_type', 'relationship_indication']
+
+
+def export_key(session_id: str, export_format: str = 'csv'):
+    if export_format == 'csv':
+        return f'export:{session_id}'
+    return f'export:{session_id}:{export_format}'
+
+
+def check_format(export_format: str):
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {', '.join(EXPORT_FORMATS)}")
+    if export_format != 'csv':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError(f"The {export_format} export format is not available on this server")
+
+
+def write_table(zipf, name: str, df: DataFrame, export_format: str):
+    name += EXPORT_FORMATS[export_format]
+    if export_format == 'csv':
+        with zipf.open(name, 'w') as f, io.TextIOWrapper(f, encoding='utf-8', newline='') as text:
+            df.to_csv(text, index=False)
+        return
+    df = df.astype({column: 'category' for column in DICTIONARY_COLUMNS if column in df.columns})
+    # pyarrow needs a seekable file, and the columnar formats are compressed already
+    buffer = io.BytesIO()
+    if export_format == 'parquet':
+        df.to_parquet(buffer, index=False, compression='zstd')
+    else:
+        df.to_feather(buffer, compression='zstd')
+    zipf.writestr(name, buffer.getvalue(), compress_type=zipfile.ZIP_STORED)
+
+
+def write_archive(fileobj, tables: dict[str, DataFrame], documents: dict[str, object], export_format: str = 'csv'):
+    """
+    Write the JSON documents and the tables, as files of the export format, into a zip archive.
+    """
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        for name, document in documents.items():
+            with zipf.open(name, 'w') as f, io.TextIOWrapper(f, encoding='utf-8') as text:
+                json.dump(document, text)
+        for name, df in tables.items():
+            write_table(zipf, name, df, export_format)
+
+
+def build_archive(tables: dict[str, DataFrame], documents: dict[str, object], export_format: str = 'csv'):
+    """
+    Build the archive into a spooled buffer, rewound and ready to be read. Meant to run in a worker thread.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    write_archive(buffer, tables, documents, export_format)
+    buffer.seek(0)
+    return buffer
+
+
+def write_file(buffer, name: str):
+    """
+    Copy an archive to its file in EXPORT_DIR, and remove the archives older than EXPORT_TTL, whose keys have expired.
+    Meant to run in a worker thread.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with buffer, open(os.path.join(EXPORT_DIR, name), 'wb') as f:
+        shutil.copyfileobj(buffer, f, CHUNK_SIZE)
+    expired = time.time() - EXPORT_TTL
+    for path in glob.glob(os.path.join(EXPORT_DIR, '*.zip')):
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except FileNotFoundError:
+            # Another replica removed it first
+            pass
+
+
+async def store_archive(redis_client, session_id: str, buffer, export_format: str = 'csv'):
+    """
+    Copy an archive to the export directory so any web replica can serve the download, and point the session's key to
+    it. The archive only becomes visible under its key once it is complete. Each copy has its own file, so that two
+    connections finishing the same session do not write into each other's copy.
+    """
+    name = f'{uuid.uuid4()}.zip'
+    await asyncio.to_thread(write_file, buffer, name)
+    await redis_client.set(export_key(session_id, export_format), name, ex=EXPORT_TTL)
+
+
+async def find_archive(redis_client, session_id: str, export_format: str = 'csv'):
+    """
+    The path and size of a session's archive, or None if there is none or it expired.
+    """
+    name = await redis_client.get(export_key(session_id, export_format))
+    if not name:
+        return None
+    path = os.path.join(EXPORT_DIR, os.path.basename(name.decode('utf-8')))
+    try:
+        return path, await asyncio.to_thread(os.path.getsize, path)
+    except FileNotFoundError:
+        return None
+
+
+async def stream_archive(path: str):
+    # The file is read in a worker thread, so that a slow disk does not hold up the event loop
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,177 @@
+import codecs
+import csv
+import logging
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+
+class MultipartFileReader:
+    """
+    Extracts the content of the uploaded file from a multipart/form-data body as the body arrives.
+    """
+
+    def __init__(self, content_type: str, field_name: str = 'file'):
+        _, params = parse_options_header(content_type)
+        if b'boundary' not in params:
+            raise ValueError("Request is not a multipart upload")
+        self.field_name = field_name
+        self.filename = None
+        self.in_file = False
+        self.headers = {}
+        self.header_field = b''
+        self.header_value = b''
+        self.data = []
+        self.parser = MultipartParser(params[b'boundary'], {
+            'on_part_begin': self.on_part_begin,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+            'on_part_data': self.on_part_data
+        })
+
+    def on_part_begin(self):
+        self.headers, self.in_file = {}, False
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field, self.header_value = b'', b''
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b'content-disposition', b''))
+        if options.get(b'name', b'').decode('utf-8') == self.field_name:
+            self.in_file = True
+            self.filename = options.get(b'filename', b'').decode('utf-8')
+
+    def on_part_data(self, data, start, end):
+        if self.in_file:
+            self.data.append(data[start:end])
+
+    def feed(self, chunk: bytes):
+        """
+        Parse a chunk of the body and return the file content it contained.
+        """
+        self.parser.write(chunk)
+        data, self.data = b''.join(self.data), []
+        return data
+
+
+class CsvRecordReader:
+    """
+    Splits text into CSV records as it arrives, keeping quoted fields that span several lines together.
+    """
+
+    def __init__(self, delimiter: str = '\t'):
+        self.delimiter = delimiter
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.pending = ''
+        self.record = ''
+        self.quoted = False
+
+    def ends_quoted(self, line: str, quoted: bool):
+        """
+        Whether line ends inside a quoted field, given whether it starts in one. Like csv's reader, only a quote at the
+        start of a field opens a quoted field; any other quote outside one is part of the field's text.
+        """
+        i = line.find('"')
+        while i >= 0:
+            if quoted:
+                if line.startswith('"', i + 1):
+                    # Escaped quote
+                    i += 1
+                else:
+                    quoted = False
+            elif i == 0 or line[i - 1] == self.delimiter:
+                quoted = True
+            i = line.find('"', i + 1)
+        return quoted
+
+    def parse(self, record: str):
+        try:
+            return next(csv.reader([record], delimiter=self.delimiter))
+        except csv.Error as e:
+            raise ValueError(f"CSV is malformed: {e}") from e
+
+    def feed(self, data: bytes, final: bool = False):
+        try:
+            text = self.decoder.decode(data, final)
+        except UnicodeDecodeError as e:
+            raise ValueError(f"CSV is not UTF-8 encoded: {e}") from e
+        lines = (self.pending + text).split('\n')
+        self.pending = '' if final else lines.pop()
+        records = []
+        for line in lines:
+            self.record += line + '\n'
+            self.quoted = self.ends_quoted(line, self.quoted)
+            if not self.quoted:
+                records.append(self.parse(self.record))
+                self.record = ''
+        if final and self.record.strip():
+            records.append(self.parse(self.record))
+        if final:
+            self.record, self.quoted = '', False
+        return [record for record in records if record]
+
+
+class PaperGrouper:
+    """
+    Groups consecutive rows with the same Title into papers. A paper is complete when a row with another title
+    arrives, so the rows of a paper are expected to be adjacent in the file.
+    """
+
+    def __init__(self):
+        self.columns = None
+        self.title = None
+        self.rows = []
+        self.titles = set()
+
+    def feed(self, records):
+        papers = []
+        for record in records:
+            if self.columns is None:
+                if 'Title' not in record:
+                    raise ValueError("CSV has no Title column")
+                self.columns = record
+                continue
+            row = dict(zip(self.columns, record + [''] * (len(self.columns) - len(record))))
+            if row['Title'] != self.title and self.rows:
+                papers.append(self.rows)
+                self.rows = []
+            if row['Title'] != self.title:
+                if row['Title'] in self.titles:
+                    logging.warning(f"Rows of paper '{row['Title']}' are not adjacent, they are processed as "
+                                    f"separate papers")
+                self.titles.add(row['Title'])
+                self.title = row['Title']
+            self.rows.append(row)
+        return papers
+
+    def close(self):
+        papers = [self.rows] if self.rows else []
+        self.rows = []
+        return papers
+
+
+async def stream_papers(request, delimiter: str = '\t'):
+    """
+    Yield the rows of each paper of the uploaded CSV as soon as the paper is complete.
+    """
+    reader = MultipartFileReader(request.headers.get('content-type', ''))
+    records = CsvRecordReader(delimiter)
+    grouper = PaperGrouper()
+    async for chunk in request.stream():
+        data = reader.feed(chunk)
+        if reader.filename is not None and not reader.filename.endswith('.csv'):
+            raise ValueError("File is not a CSV")
+        for paper in grouper.feed(records.feed(data)):
+            yield paper
+    if reader.filename is None:
+        raise ValueError("No file was uploaded")
+    for paper in grouper.feed(records.feed(b'', final=True)) + grouper.close():
+        yield paper
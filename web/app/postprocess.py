@@ -0,0 +1,302 @@
+import os
+import re
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+from influencemapper.util import infer_is_funded as _infer_is_funded
+
+from canonical import AuthorCanonicalizer, Canonicalizer, normalize_author
+
+SOURCE_COLUMNS = ['id', 'title', 'disclosure']
+ENT_COLUMNS = ['ent_id', 'org_name', 'ent-ind support']
+AUTHOR_COLUMNS = ['author_id', 'author_name', 'affiliation', 'email']
+REL_TYPE_COLUMNS = ['rel_id', 'relationship_type']
+STUDY_RESULT_COLUMNS = ['res_id', 'source', 'entity', 'relationship_type', 'relationship_indication']
+AUTHOR_RESULT_COLUMNS = ['res_id', 'source', 'entity', 'author', 'relationship_type']
+
+
+# The words influencemapper.util.infer_is_funded looks for in an org name, to classify whole columns of names at
+# once. Names containing one of UNLIKELY_KEYWORDS or LONG_NAMES, or one of ABBREVIATIONS as a word or in
+# parentheses, are unlikely to be funded; failing that, names containing one of POSSIBLY_KEYWORDS possibly are.
+UNLIKELY_KEYWORDS = [
+    'university', 'college', 'school', 'program', 'hospital', 'department', 'agency', 'bureau', 'registry', 'federal',
+    'government', 'ministry', 'municipal', 'state', 'national',
+    'universidad', 'colegio', 'escuela', 'programa', 'departamento', 'agencia', 'oficina', 'registro', 'gobierno',
+    'ministerio', 'estado', 'nacional',
+    'université', 'collège', 'école', 'programme', 'hôpital', 'département', 'agence', 'registre', 'fédéral',
+    'gouvernement', 'ministère', 'état',
+    'universität', 'schule', 'programm', 'krankenhaus', 'abteilung', 'agentur', 'büro', 'register', 'bundes',
+    'regierung', 'ministerium', 'kommunal', 'staat',
+    'università', 'scuola', 'ospedale', 'dipartimento', 'agenzia', 'ufficio', 'federale', 'governo', 'ministero',
+    'comunale', 'stato', 'nazionale',
+    'universiteit', 'ziekenhuis', 'afdeling', 'agentschap', 'federaal', 'overheid', 'ministerie', 'gemeentelijk',
+    'nationaal'
+]
+ABBREVIATIONS = ['NIH', 'NCI', 'NTP', 'NIEHS', 'NIOSH', 'EPA', 'CDC']
+LONG_NAMES = ['National Institutes of Health', 'National Cancer Institute', 'National Toxicology Program',
+              'National Institute of Environmental Health Sciences',
+              'National Institute for Occupational Safety and Health', 'Environmental Protection Agency',
+              'Centers for Disease Control and Prevention']
+POSSIBLY_KEYWORDS = ['council', 'academy', 'fund', 'foundation', 'health', 'society', 'union', 'division']
+
+
+def substring_pattern(substrings):
+    # Names are compared upper-cased, like infer_is_funded does
+    return '|'.join(re.escape(substring.upper()) for substring in substrings)
+
+
+UNLIKELY_PATTERN = substring_pattern(UNLIKELY_KEYWORDS + LONG_NAMES + list(chain.from_iterable(
+    (f'({abbreviation})', f' {abbreviation}', f'{abbreviation} ') for abbreviation in ABBREVIATIONS)))
+POSSIBLY_PATTERN = substring_pattern(POSSIBLY_KEYWORDS)
+
+
+# infer_is_funded is a pure function of the org name; the cache is shared by every session of the process
+@lru_cache(maxsize=int(os.getenv('IS_FUNDED_CACHE_SIZE', 100000)))
+def infer_is_funded(org_name):
+    return _infer_is_funded(org_name)
+
+
+def funding_support(org_names):
+    """
+    infer_is_funded of each org name, computed for all of them at once.
+    """
+    names = pd.Series(org_names, dtype=object).str.strip()
+    upper = names.str.upper()
+    unlikely = upper.str.contains(UNLIKELY_PATTERN).to_numpy(dtype=bool) | upper.isin(ABBREVIATIONS).to_numpy()
+    possibly = upper.str.contains(POSSIBLY_PATTERN).to_numpy(dtype=bool)
+    return np.select([unlikely, possibly, (names == 'N/A').to_numpy()], ['Unlikely', 'Possibly', 'N/A'],
+                     'Likely').astype(object)
+
+
+def entity_frame(ent_ids, org_names):
+    return pd.DataFrame({'ent_id': ent_ids, 'org_name': org_names, 'ent-ind support': funding_support(org_names)},
+                        columns=ENT_COLUMNS)
+
+
+class ResultsBuilder(ABC):
+    """
+    Builds the source, entity, relationship type and result tables of a session one result at a time,
+    so that the tables are ready as soon as the last result arrives.
+    IDs are assigned in order of first appearance. Org names that only differ in spelling, like "Pfizer Inc." and
+    "Pfizer", are one entity, named after the first of them. Entities are classified by funding when the tables are
+    built, all at once.
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.entities = Canonicalizer()
+        self.ent_ids = {}
+        self.ent_rows = []
+        self.rel_ids = {}
+        self.rel_rows = []
+        self.result_rows = []
+
+    def entity_id(self, org_name):
+        if org_name not in self.ent_ids:
+            canonical_id = self.entities.add(org_name)
+            if canonical_id == len(self.ent_rows):
+                self.ent_rows.append((f'ent-{canonical_id}', org_name))
+            self.ent_ids[org_name] = self.ent_rows[canonical_id][0]
+        return self.ent_ids[org_name]
+
+    def rel_type_id(self, relationship_type):
+        if relationship_type not in self.rel_ids:
+            self.rel_ids[relationship_type] = f'rel-{len(self.rel_rows)}'
+            self.rel_rows.append((self.rel_ids[relationship_type], relationship_type))
+        return self.rel_ids[relationship_type]
+
+    def add(self, result):
+        source = result['source']
+        self.sources.append((result['id'], source['title'], source['disclosure']))
+        # Results of failed inferences only contribute their source
+        if result['payload'] is not None:
+            self.add_payload(result['id'], source, result['payload'])
+
+    @abstractmethod
+    def add_payload(self, source_id, source, payload):
+        pass
+
+    def entity_table(self):
+        return entity_frame([ent_id for ent_id, _ in self.ent_rows], [org_name for _, org_name in self.ent_rows])
+
+
+class StudyResultsBuilder(ResultsBuilder):
+
+    def add_payload(self, source_id, source, payload):
+        for study_info in payload['study_info']:
+            entity = self.entity_id(study_info['org_name'])
+            for rel in study_info['relationships']:
+                self.result_rows.append((f'res_{len(self.result_rows)}', source_id, entity,
+                                         self.rel_type_id(rel['relationship_type']), rel['relationship_indication']))
+
+    def tables(self):
+        df_source = pd.DataFrame(self.sources, columns=SOURCE_COLUMNS)
+        df_ent = self.entity_table()
+        df_rel_type = pd.DataFrame(self.rel_rows, columns=REL_TYPE_COLUMNS)
+        df_results = pd.DataFrame(self.result_rows, columns=STUDY_RESULT_COLUMNS)
+        return df_source, df_ent, df_rel_type, df_results
+
+
+def author_details(author_info, source):
+    """
+    Affiliation and email of an author, taken from the uploaded rows when the model does not return them.
+    The model may drop or add titles, so names are compared without them.
+    """
+    if 'affiliation' in author_info:
+        return author_info['affiliation'], author_info['email']
+    authors = source.get('authors', [])
+    if author_info['author_name'] in authors:
+        i = authors.index(author_info['author_name'])
+        return source['affiliation'][i], source['email'][i]
+    keys = [normalize_author(author) for author in authors]
+    key = normalize_author(author_info['author_name'])
+    if key in keys:
+        i = keys.index(key)
+        return source['affiliation'][i], source['email'][i]
+    return '', ''
+
+
+class AuthorResultsBuilder(ResultsBuilder):
+
+    def __init__(self):
+        super().__init__()
+        self.authors = AuthorCanonicalizer()
+        self.author_ids = {}
+        self.author_rows = []
+
+    def author_id(self, author):
+        if author not in self.author_ids:
+            canonical_id = self.authors.add(*author)
+            if canonical_id == len(self.author_rows):
+                self.author_rows.append((f'author-{canonical_id}', *author))
+            self.author_ids[author] = self.author_rows[canonical_id][0]
+        return self.author_ids[author]
+
+    def add_payload(self, source_id, source, payload):
+        for author_info in payload['author_info']:
+            author = self.author_id((author_info['author_name'], *author_details(author_info, source)))
+            for rel in author_info['organization']:
+                entity = self.entity_id(rel['org_name'])
+                for relationship in rel['relationship_type']:
+                    self.result_rows.append((f'res_{len(self.result_rows)}', source_id, entity, author,
+                                             self.rel_type_id(relationship)))
+
+    def tables(self):
+        df_source = pd.DataFrame(self.sources, columns=SOURCE_COLUMNS)
+        df_ent = self.entity_table()
+        df_author = pd.DataFrame(self.author_rows, columns=AUTHOR_COLUMNS)
+        df_rel_type = pd.DataFrame(self.rel_rows, columns=REL_TYPE_COLUMNS)
+        df_results = pd.DataFrame(self.result_rows, columns=AUTHOR_RESULT_COLUMNS)
+        return df_source, df_ent, df_author, df_rel_type, df_results
+
+
+
+def prefixed_ids(prefix, count):
+    return [f'{prefix}{i}' for i in range(count)]
+
+
+def source_table(results):
+    return pd.DataFrame([(result['id'], result['source']['title'], result['source']['disclosure'])
+                         for result in results], columns=SOURCE_COLUMNS)
+
+
+def entity_table(org_names):
+    """
+    The entity table and the entity code of each org name. Codes are numbered in order of first appearance, and
+    org names are canonicalized like in ResultsBuilder.
+    """
+    codes, uniques = pd.factorize(org_names)
+    entities = Canonicalizer()
+    canonical = np.fromiter(map(entities.add, uniques), dtype=np.int64, count=len(uniques))
+    return entity_frame(prefixed_ids('ent-', len(entities)), entities.names), canonical[codes]
+
+
+def rel_type_table(relationship_types):
+    codes, uniques = pd.factorize(relationship_types)
+    df_rel_type = pd.DataFrame({
+        'rel_id': prefixed_ids('rel-', len(uniques)),
+        'relationship_type': uniques
+    }, columns=REL_TYPE_COLUMNS)
+    return df_rel_type, codes
+
+
+def id_column(codes, ids):
+    # Result rows reference IDs through categorical codes instead of materializing one string per row
+    return pd.Categorical.from_codes(codes, categories=ids)
+
+
+def explode(df, column, fields, carry):
+    """
+    One row per element of the list column, with the given fields of the elements as columns and
+    the carry columns repeated
+    """
+    lengths = np.fromiter(map(len, df[column]), dtype=np.int64, count=len(df))
+    items = list(chain.from_iterable(df[column]))
+    exploded = pd.DataFrame({field: list(map(itemgetter(field), items)) for field in fields}, columns=fields)
+    for name in carry:
+        exploded[name] = np.repeat(df[name].to_numpy(), lengths)
+    return exploded
+
+
+def study_tables(results):
+    """
+    Columnar equivalent of StudyResultsBuilder for a complete list of results, producing the same tables and IDs.
+    """
+    df_source = source_table(results)
+    records = pd.DataFrame([(result['id'], result['payload']['study_info'])
+                            for result in results if result['payload'] is not None], columns=['id', 'study_info'])
+    orgs = explode(records, 'study_info', ['org_name', 'relationships'], ['id'])
+    df_ent, orgs['entity'] = entity_table(orgs['org_name'])
+    rels = explode(orgs, 'relationships', ['relationship_type', 'relationship_indication'], ['id', 'entity'])
+    df_rel_type, rel_codes = rel_type_table(rels['relationship_type'])
+    df_results = pd.DataFrame({
+        'res_id': prefixed_ids('res_', len(rels)),
+        'source': rels['id'],
+        'entity': id_column(rels['entity'], df_ent['ent_id']),
+        'relationship_type': id_column(rel_codes, df_rel_type['rel_id']),
+        'relationship_indication': rels['relationship_indication']
+    }, columns=STUDY_RESULT_COLUMNS)
+    return df_source, df_ent, df_rel_type, df_results
+
+
+def author_tables(results):
+    """
+    Columnar equivalent of AuthorResultsBuilder for a complete list of results, producing the same tables and IDs.
+    """
+    df_source = source_table(results)
+    records = []
+    for result in results:
+        if result['payload'] is None:
+            continue
+        for author_info in result['payload']['author_info']:
+            records.append((result['id'], author_info['author_name'], *author_details(author_info, result['source']),
+                            author_info['organization']))
+    authors = pd.DataFrame(records, columns=['id', 'author_name', 'affiliation', 'email', 'organization'])
+    # Each distinct author is canonicalized once, in order of first appearance
+    codes, uniques = pd.factorize(pd.Series([author[1:4] for author in records], dtype=object))
+    canonicalizer = AuthorCanonicalizer()
+    canonical = np.fromiter((canonicalizer.add(*author) for author in uniques), dtype=np.int64, count=len(uniques))
+    authors['author'] = canonical[codes]
+    unique_authors = authors.drop_duplicates('author')
+    df_author = pd.DataFrame({
+        'author_id': prefixed_ids('author-', len(unique_authors)),
+        'author_name': unique_authors['author_name'].to_numpy(),
+        'affiliation': unique_authors['affiliation'].to_numpy(),
+        'email': unique_authors['email'].to_numpy()
+    }, columns=AUTHOR_COLUMNS)
+    orgs = explode(authors, 'organization', ['org_name', 'relationship_type'], ['id', 'author'])
+    df_ent, orgs['entity'] = entity_table(orgs['org_name'])
+    rels = orgs.explode('relationship_type', ignore_index=True).dropna(subset=['relationship_type'])
+    df_rel_type, rel_codes = rel_type_table(rels['relationship_type'])
+    df_results = pd.DataFrame({
+        'res_id': prefixed_ids('res_', len(rels)),
+        'source': rels['id'].to_numpy(),
+        'entity': id_column(rels['entity'].to_numpy(dtype=np.int64), df_ent['ent_id']),
+        'author': id_column(rels['author'].to_numpy(dtype=np.int64), df_author['author_id']),
+        'relationship_type': id_column(rel_codes, df_rel_type['rel_id'])
+    }, columns=AUTHOR_RESULT_COLUMNS)
+    return df_source, df_ent, df_author, df_rel_type, df_results
@@ -0,0 +1,96 @@
+import os
+
+# Priority classes, highest first, and the key names the listener's scheduler dispatches jobs from
+PRIORITIES = ('high', 'normal', 'low')
+# Jobs kept waiting in a channel's stream, ahead of the listeners; the rest wait in their session's queue
+SCHEDULE_WINDOW = int(os.getenv('SCHEDULE_WINDOW', 16))
+
+# Queue jobs of a session. While no session has jobs queued and the stream has room, jobs go straight to the
+# channel's stream, so that an idle listener does not have to dispatch them. Otherwise they are added to the
+# session's queue, and a session new to the schedule starts at the virtual time of the session served next.
+ENQUEUE_SCRIPT = """
+local queued = 0
+for i = 5, #KEYS do
+    queued = queued + redis.call('ZCARD', KEYS[i])
+end
+local direct = 0
+if queued == 0 then
+    local waiting = redis.call('XLEN', KEYS[1])
+    local summary = redis.pcall('XPENDING', KEYS[1], ARGV[1])
+    if type(summary) == 'table' and summary.err == nil then
+        waiting = waiting - summary[1]
+    end
+    direct = math.max(math.min(tonumber(ARGV[2]) - waiting, #ARGV - 5), 0)
+end
+for i = 6, 5 + direct do
+    redis.call('XADD', KEYS[1], '*', 'data', ARGV[i])
+end
+if 5 + direct < #ARGV then
+    for i = 6 + direct, #ARGV do
+        redis.call('RPUSH', KEYS[2], ARGV[i])
+    end
+    redis.call('INCRBY', KEYS[3], #ARGV - 5 - direct)
+    redis.call('HSET', KEYS[4], ARGV[3], ARGV[4])
+    local schedule = KEYS[5 + tonumber(ARGV[5])]
+    if not redis.call('ZSCORE', schedule, ARGV[3]) then
+        local head = redis.call('ZRANGE', schedule, 0, 0, 'WITHSCORES')
+        redis.call('ZADD', schedule, head[2] or 0, ARGV[3])
+    end
+end
+return direct
+"""
+
+# Drop the jobs a session still has queued, and the session from the schedule
+PURGE_SCRIPT = """
+local queued = redis.call('LLEN', KEYS[2])
+if queued > 0 then
+    redis.call('DEL', KEYS[2])
+    redis.call('DECRBY', KEYS[3], queued)
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+for i = 5, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+return queued
+"""
+
+
+def check_priority(priority: str, weight: float):
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}, expected one of {', '.join(PRIORITIES)}")
+    if not weight > 0:
+        raise ValueError("The weight of a session must be positive")
+
+
+class SessionQueue:
+    """
+    Queues the jobs of one session for the listeners' fair scheduling across sessions. Sessions of a higher
+    priority are served first; sessions of the same priority take turns, in proportion to their weight.
+    """
+
+    def __init__(self, redis_client, session_id, priority='normal', weight=1.0, group_name=None,
+                 window=SCHEDULE_WINDOW):
+        self.session_id = session_id
+        self.priority = PRIORITIES.index(priority)
+        self.weight = weight
+        self.group_name = group_name or os.getenv('STREAM_GROUP', 'listener')
+        self.window = window
+        self.script = redis_client.register_script(ENQUEUE_SCRIPT)
+        self.purge_script = redis_client.register_script(PURGE_SCRIPT)
+
+    def keys(self, channel_name):
+        return [channel_name, f'jobs:{channel_name}:{self.session_id}', f'backlog:{channel_name}',
+                f'weights:{channel_name}'] + [f'schedule:{channel_name}:{priority}' for priority in PRIORITIES]
+
+    def enqueue(self, channel_name, jobs: list[bytes]):
+        """
+        Queue serialized jobs of a channel. Returns the number of jobs that went straight to the channel's stream.
+        """
+        return self.script(keys=self.keys(channel_name),
+                           args=[self.group_name, self.window, self.session_id, self.weight, self.priority, *jobs])
+
+    def purge(self, channel_name):
+        """
+        Drop the jobs of a channel still in the session's queue. Returns how many were dropped.
+        """
+        return self.purge_script(keys=self.keys(channel_name), args=[self.session_id])
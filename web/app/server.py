@@ -2,32 +2,73 @@ import asyncio
 import json
 import os
 import logging
+import time
 import uuid
 from contextlib import asynccontextmanager
 from typing import Optional
 
 import redis.asyncio as aioredis
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, Header, HTTPException, Query
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.requests import Request
-from influencemapper.util import infer_is_funded
 from pandas import DataFrame
-from pandas.core.apply import relabel_result
-from pydantic import BaseModel
-import pandas as pd
-import io
-import zipfile
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+from starlette.responses import Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
+try:
+    # orjson serializes jobs several times faster than json; it is used when installed
+    from orjson import dumps as dump_job
+except ImportError:
+    def dump_job(job):
+        return json.dumps(job).encode('utf-8')
+
+from admission import ACCEPT, DEFER, Admission
+from export import build_archive, check_format, export_key, find_archive, store_archive, stream_archive
+from ingest import stream_papers
+from postprocess import AuthorResultsBuilder, StudyResultsBuilder, author_tables, study_tables
+from scheduling import SessionQueue, check_priority
+from store import ResultStore
+
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(level=log_level)
 
 redis_client: Optional[aioredis.Redis] = None
-pubsub: Optional[aioredis.client.PubSub] = None
+result_store: Optional[ResultStore] = None
+# SQLite database keeping the results of every session; empty to disable it
+RESULT_STORE_PATH = os.getenv('RESULT_STORE_PATH', 'results.db')
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+# Seconds before results that could not be added to the result store are tried again
+STORE_RETRY_SECONDS = float(os.getenv('STORE_RETRY_SECONDS', 10))
+# Sessions whose results are still being added to the result store, resumed when the web app restarts
+STORING_KEY = 'sessions:storing'
+# How long /events blocks on a session's result stream before sending a keep-alive
+EVENTS_BLOCK_MS = int(os.getenv('EVENTS_BLOCK_MS', 15000))
+# Jobs are queued in pipelines of up to PUBLISH_CHUNK_SIZE jobs
+PUBLISH_CHUNK_SIZE = int(os.getenv('PUBLISH_CHUNK_SIZE', 500))
+PUBLISH_FLUSH_MS = int(os.getenv('PUBLISH_FLUSH_MS', 50))
+# Queue one paper_channel job per paper, answered with a single inference for both the study and the authors
+COMBINED_MODE = os.getenv('COMBINED_MODE', '0') == '1'
+# Queue the jobs of each session apart, for the listeners to take turns between sessions
+FAIR_SCHEDULING = os.getenv('FAIR_SCHEDULING', '1') == '1'
+
+# Latency buckets in seconds, from Redis round-trips to slow uploads
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+JOBS_PUBLISHED = Counter('web_jobs_published_total', 'Jobs queued for the listeners', ['channel'])
+PUBLISH_SECONDS = Histogram('web_publish_seconds', 'Time to queue a chunk of jobs in Redis', buckets=LATENCY_BUCKETS)
+PAPERS_UPLOADED = Counter('web_papers_uploaded_total', 'Papers read from uploaded CSVs')
+UPLOAD_SECONDS = Histogram('web_upload_seconds', 'Time to read an uploaded CSV and queue its jobs',
+                           buckets=LATENCY_BUCKETS)
+POSTPROCESS_SECONDS = Histogram('web_postprocess_seconds', 'Time to build the tables of a session', ['channel'],
+                                buckets=LATENCY_BUCKETS)
+ARCHIVE_SECONDS = Histogram('web_archive_seconds', 'Time to build and store the zip archive of a session',
+                            buckets=LATENCY_BUCKETS)
+SSE_SESSIONS = Gauge('web_sse_sessions_active', 'Sessions with an open /events stream', multiprocess_mode='livesum')
+UPLOADS = Counter('web_uploads_total', 'Uploads by admission decision', ['decision'])
 
 async def get_redis_client():
     redis_host = os.getenv('REDIS_HOST', 'localhost')
@@ -37,13 +78,18 @@ async def get_redis_client():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_client, pubsub
+    global redis_client, result_store
     redis_client = await get_redis_client()
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe('result', ignore_subscribe_messages=True)
+    if RESULT_STORE_PATH:
+        result_store = ResultStore(RESULT_STORE_PATH)
+        await resume_persisting()
     yield
+    for task in list(persist_tasks):
+        task.cancel()
     await redis_client.close()
     await redis_client.connection_pool.disconnect()
+    if result_store is not None:
+        result_store.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -58,51 +104,118 @@ app.add_middleware(
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "dist"))
 
 
-class AuthorInfoRequest(BaseModel):
-    authors: list[str]
-    disclosure: str
-    title: str
-    affiliation: list[str]
-    email: list[str]
-
-class StudyInfoRequest(BaseModel):
-    disclosure: str
-    title: str
-
-
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-async def publish_infos(df: DataFrame, channel: str):
-    tasks = []
-    data_id = 0
-    data_ids = []
-
-    for key, group in df.groupby("Title"):
-        if channel == 'author_channel':
-            data = AuthorInfoRequest(
-                authors=group["Author Name"].tolist(),
-                disclosure=group["Disclosure Statement"].iloc[0],
-                title=group['Title'].iloc[0],
-                affiliation=group['Affiliation'].tolist(),
-                email=group['Email'].tolist()
-            )
-        else:
-            data = StudyInfoRequest(
-                disclosure=group["Disclosure Statement"].iloc[0],
-                title=group['Title'].iloc[0]
-            )
-        data = {
+def build_payload(channel: str, title: str, disclosure: str, authors: list[str], affiliation: list[str],
+                  email: list[str]):
+    """
+    The payload of a job, in the shape of influencemapper's AuthorInfoRequest and StudyInfoRequest.
+    Built as a plain dict since it only holds strings read from the CSV.
+    """
+    if channel in ('author_channel', 'paper_channel'):
+        return {'authors': authors, 'disclosure': disclosure, 'title': title, 'affiliation': affiliation,
+                'email': email}
+    return {'disclosure': disclosure, 'title': title}
+
+
+def build_job(rows: list[dict], channel: str, data_id: int, session_id: Optional[str] = None):
+    payload = build_payload(channel, rows[0]['Title'], rows[0]["Disclosure Statement"],
+                            [row["Author Name"] for row in rows], [row['Affiliation'] for row in rows],
+                            [row['Email'] for row in rows])
+    return {
+        'id': data_id,
+        'payload': payload,
+        'channel': channel,
+        'session_id': session_id
+    }
+
+
+def publish_jobs(jobs: list[dict], queue: Optional[SessionQueue] = None):
+    """
+    Queue a chunk of jobs in one pipeline, i.e. one round-trip to Redis, or with one call per channel to the
+    session's queue.
+    """
+    for job in jobs:
+        JOBS_PUBLISHED.labels(channel=job['channel']).inc()
+    if queue is not None:
+        channels = {}
+        for job in jobs:
+            channels.setdefault(job['channel'], []).append(dump_job(job))
+        return asyncio.gather(*(queue.enqueue(channel, channel_jobs) for channel, channel_jobs in channels.items()))
+    pipe = redis_client.pipeline(transaction=False)
+    for job in jobs:
+        pipe.xadd(job['channel'], {'data': dump_job(job)})
+    return pipe.execute()
+
+
+async def purge_session(session_id: str, channels, queue: Optional[SessionQueue] = None):
+    """
+    Drop the jobs of a session that are still queued, in its session queue or a channel's stream, and the results
+    already published. Jobs a listener is working on are left to finish.
+    """
+    for channel in channels:
+        # The session queue goes first, so that no job is dispatched to the stream once it has been scanned
+        if queue is not None:
+            await queue.purge(channel)
+        start = '-'
+        while entries := await redis_client.xrange(channel, min=start, count=PUBLISH_CHUNK_SIZE):
+            stale = [entry_id for entry_id, fields in entries
+                     if session_id.encode('utf-8') in fields.get(b'data', b'')
+                     and json.loads(fields[b'data']).get('session_id') == session_id]
+            if stale:
+                await redis_client.xdel(channel, *stale)
+            start = b'(' + entries[-1][0]
+    await redis_client.delete(f'result:{session_id}')
+
+
+class JobPublisher:
+    """
+    Buffers jobs and queues them in chunks of chunk_size. A job waits at most flush_ms in the buffer
+    while more jobs are added, so the first jobs of an upload are queued right away.
+    """
+
+    def __init__(self, chunk_size: int = PUBLISH_CHUNK_SIZE, flush_ms: int = PUBLISH_FLUSH_MS,
+                 queue: Optional[SessionQueue] = None):
+        self.chunk_size = chunk_size
+        self.queue = queue
+        self.flush_ms = flush_ms
+        self.jobs = []
+        self.last_flush = None
+
+    async def add(self, job: dict):
+        self.jobs.append(job)
+        if len(self.jobs) >= self.chunk_size or self.last_flush is None or \
+                (time.monotonic() - self.last_flush) * 1000 >= self.flush_ms:
+            await self.flush()
+
+    async def flush(self):
+        if self.jobs:
+            with PUBLISH_SECONDS.time():
+                await publish_jobs(self.jobs, self.queue)
+            self.jobs = []
+        self.last_flush = time.monotonic()
+
+
+async def publish_infos(df: DataFrame, channel: str, session_id: Optional[str] = None):
+    papers = df.groupby("Title").agg({
+        "Disclosure Statement": "first",
+        "Author Name": list,
+        "Affiliation": list,
+        "Email": list
+    })
+    jobs = []
+    for data_id, (title, disclosure, authors, affiliation, email) in enumerate(papers.itertuples()):
+        jobs.append({
             'id': data_id,
-            'payload': data.model_dump(),
-            'channel': channel
-        }
-        tasks.append(redis_client.publish(channel, json.dumps(data)))
-        data_ids.append(data_id)
-        data_id += 1
-    return tasks, data_ids
+            'payload': build_payload(channel, title, disclosure, authors, affiliation, email),
+            'channel': channel,
+            'session_id': session_id
+        })
+    tasks = [publish_jobs(jobs[i:i + PUBLISH_CHUNK_SIZE]) for i in range(0, len(jobs), PUBLISH_CHUNK_SIZE)]
+    return tasks, list(range(len(jobs)))
 
 
 async def publish_author_infos(df: DataFrame):
@@ -119,213 +232,349 @@ async def publish_study_infos(df: DataFrame):
     )
 
 async def postprocess_study_results(results):
-    sources = []
-    orgs = []
-    rel_types = []
-    study_results = []
-    # study_relationships = ['Perform analysis', 'Collect data', 'Coordinate the study', 'Design the study',
-    #                     'Fund the study', 'Participate in the study', 'Review the study', 'Supply the study',
-    #                     'Supply data to the study', 'Support the study', 'Write the study', 'Other']
-    for result in results:
-        id = result['id']
-        source = result['source']
-        study_info = result['payload']['study_info']
-        for i in range(len(study_info)):
-            org_name = study_info[i]['org_name']
-            orgs.append(org_name)
-            relationships = study_info[i]['relationships']
-            for rel in relationships:
-                rel_types.append(rel['relationship_type'])
-        sources.append((id, source['title'], source['disclosure']))
-    # A roundabout way to get unique source, ent. If we implemented database, this will be refactored
-    df_source = pd.DataFrame(sources, columns=['id', 'title', 'disclosure'])
-    df_ent = pd.DataFrame([(f'ent-{i}', org, infer_is_funded(org)) for i, org in enumerate(set(orgs))], columns=['ent_id', 'org_name', 'ent-ind support'])
-    df_rel_type = pd.DataFrame([(f'rel-{i}', rel) for i, rel in enumerate(set(rel_types))], columns=['rel_id', 'relationship_type'])
-
-    dict_ent = dict(zip(df_ent['org_name'], df_ent['ent_id']))
-    dict_rel_type = dict(zip(df_rel_type['relationship_type'], df_rel_type['rel_id']))
-
-    result_id = 0
-    for result in results:
-        study_info = result['payload']['study_info']
-        for i in range(len(study_info)):
-            org_name = study_info[i]['org_name']
-            orgs.append(org_name)
-            relationships = study_info[i]['relationships']
-            for rel in relationships:
-                relationship_type = rel['relationship_type']
-                relationship_indication = rel['relationship_indication']
-                study_results.append({
-                    'res_id': f'res_{result_id}',
-                    'source': result['id'],
-                    'entity': dict_ent[org_name],
-                    'relationship_type': dict_rel_type[relationship_type],
-                    'relationship_indication': relationship_indication
-                })
-                result_id += 1
-    df_results = pd.DataFrame(study_results, columns=['res_id', 'source', 'entity', 'relationship_type', 'relationship_indication'])
-    return df_source, df_ent, df_rel_type, df_results
+    # The tables of one session; the results of every session are kept in the result store
+    return await asyncio.to_thread(study_tables, results)
 
 
 async def postprocess_author_results(results):
-    sources = []
-    orgs = []
-    authors = []
-    author_results = []
-    rel_types = []
-    # author_relationships = ['Honorarium', 'Named Professor', 'Received research materials directly', 'Patent license',
-    #                         'Other/Unspecified', 'Personal fees', 'Salary support', 'Received research materials indirectly',
-    #                         'Equity', 'Expert testimony', 'Consultant', 'Board member', 'Founder of entity or organization', 'Received travel support', 'Holds Chair', 'Fellowship', 'Scholarship',
-    #                         'Collaborator', 'Received research grant funds directly', 'No Relationship', 'Speakers’ bureau', 'Employee of', 'Received research grant funds indirectly', 'Patent', 'Award',
-    #                         'Research Trial committee member', 'Supported', 'Former employee of']
-    for result in results:
-        id = result['id']
-        source = result['source']
-        author_info = result['payload']['author_info']
-        for i in range(len(author_info)):
-            author = author_info[i]['author_name']
-            rels = author_info[i]['organization']
-            affiliation = author_info[i]['affiliation']
-            email = author_info[i]['email']
-            for rel in rels:
-                orgs.append(rel['org_name'])
-                relationships = rel['relationship_type']
-                for relationship in relationships:
-                    rel_types.append(relationship)
-            authors.append((author, affiliation, email))
-        sources.append((id, source['title'], source['disclosure']))
-    df_source = pd.DataFrame(sources, columns=['id', 'title', 'disclosure'])
-    df_ent = pd.DataFrame([(f'ent-{i}', org, infer_is_funded(org)) for i, org in enumerate(set(orgs))], columns=['ent_id', 'org_name', 'ent-ind support'])
-    # TODO: deal with authors with similar name
-    df_author = pd.DataFrame([(f'author-{i}', author[0], author[1], author[2]) for i, author in enumerate(set(authors))], columns=['author_id', 'author_name', 'affiliation', 'email'])
-    df_rel_type = pd.DataFrame([(f'rel-{i}', rel) for i, rel in enumerate(set(rel_types))],
-                               columns=['rel_id', 'relationship_type'])
-    dict_ent = dict(zip(df_ent['org_name'], df_ent['ent_id']))
-    dict_author = dict(zip(df_author['author_name'], df_author['author_id']))
-    dict_rel_type = dict(zip(df_rel_type['relationship_type'], df_rel_type['rel_id']))
-
-    result_id = 0
-    for result in results:
-        author_info = result['payload']['author_info']
-        for i in range(len(author_info)):
-            author = author_info[i]['author_name']
-            rels = author_info[i]['organization']
-            for rel in rels:
-                org_name = rel['org_name']
-                relationships = rel['relationship_type']
-                for relationship in relationships:
-                    author_results.append({
-                        'res_id': f'res_{result_id}',
-                        'source': result['id'],
-                        'entity': dict_ent[org_name],
-                        'author': dict_author[author],
-                        'relationship_type': dict_rel_type[relationship]
-                    })
-                    result_id += 1
-    df_results = pd.DataFrame(author_results, columns=['res_id', 'source', 'entity', 'author', 'relationship_type'])
-    return df_source, df_ent, df_author, df_rel_type, df_results
+    return await asyncio.to_thread(author_tables, results)
+
+async def track_session(stream):
+    # Counts the stream as active until the client disconnects or the session is done
+    SSE_SESSIONS.inc()
+    try:
+        async for event in stream:
+            yield event
+    finally:
+        SSE_SESSIONS.dec()
+
+def stream_id(entry_id):
+    """
+    A stream entry ID as a comparable tuple, or None if it is not one.
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    try:
+        milliseconds, _, sequence = entry_id.partition('-')
+        return int(milliseconds), int(sequence or 0)
+    except (AttributeError, ValueError):
+        return None
+
+async def session_eta(session_id, total_message):
+    # The session is done once all its results are in; until then, at most when every queued job is
+    if await redis_client.xlen(f'result:{session_id}') >= total_message:
+        return 0
+    eta = await Admission(redis_client).estimate()
+    return round(eta, 1) if eta is not None else None
 
 @app.get('/events')
-async def events(session_id: str):
+async def events(session_id: str, last_event_id: Optional[str] = Header(None)):
+    """
+    Stream the results of a session as they arrive. Results are read from the session's result stream, so a client
+    that reconnects with Last-Event-ID only receives the results it missed, and a session that is already done
+    is served from its stored archive without being post-processed again.
+    The start event gives the number of results and the estimated seconds until the session is done.
+    """
     async def event_stream():
         message_count = 0
         total_message = await redis_client.hget(session_id, 'total_message')
-        yield f"event: start\ndata: {int(total_message)}\n\n"
         total_message = int(total_message) if total_message else 0
+        start = {'total_message': total_message, 'eta_seconds': await session_eta(session_id, total_message)}
+        yield f"event: start\ndata: {json.dumps(start)}\n\n"
+        resume_after = stream_id(last_event_id) if last_event_id else None
+        export_format = await session_format(session_id)
+        archive_ready = await redis_client.exists(export_key(session_id, export_format))
         study_results = []
         author_results = []
+        study_builder = StudyResultsBuilder()
+        author_builder = AuthorResultsBuilder()
+        last_id = '0'
         while message_count < total_message:
-            message = await pubsub.get_message()
-            if message:
+            response = await redis_client.xread({f'result:{session_id}': last_id}, count=100, block=EVENTS_BLOCK_MS)
+            if not response:
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
                 try:
-                    result = json.loads(message['data'])
+                    result = json.loads(fields[b'data'])
                     if result['channel'] == 'study_channel':
                         msg = f"event: received_study"
-                        study_results.append(result)
+                        if not archive_ready:
+                            study_results.append(result)
+                            study_builder.add(result)
                     else:
                         msg = f"event: received_author"
-                        author_results.append(result)
-                except TypeError as e:
-                    logging.error(f"Could not decode message: {message}.\n Error: {e}")
+                        if not archive_ready:
+                            author_results.append(result)
+                            author_builder.add(result)
+                except (TypeError, KeyError) as e:
+                    logging.error(f"Could not decode message: {fields}.\n Error: {e}")
                     continue
-                data = {
-                    'id': result['id'],
-                    'channel': result['channel']
-                }
-                msg = f"{msg}\ndata: {json.dumps(data)}"
-                yield msg + '\n\n'
-                logging.info(f"Received message: {result}")
                 message_count += 1
+                # Results the client already received are only added to the tables
+                if resume_after is None or stream_id(entry_id) > resume_after:
+                    data = {
+                        'id': result['id'],
+                        'channel': result['channel']
+                    }
+                    msg = f"id: {entry_id.decode('utf-8')}\n{msg}\ndata: {json.dumps(data)}"
+                    yield msg + '\n\n'
+                    logging.info(f"Received message: {result}")
                 if message_count == total_message:
                     logging.info(f'Received {message_count} of {total_message} messages')
-                    all_study_results = await postprocess_study_results(study_results)
-                    study_df_source, study_df_ent, study_df_rel_type, study_df_results = all_study_results
-                    open('study_df_source.csv', 'w').write(study_df_source.to_csv(index=False))
-                    open('study_df_ent.csv', 'w').write(study_df_ent.to_csv(index=False))
-                    open('study_df_rel_type.csv', 'w').write(study_df_rel_type.to_csv(index=False))
-                    open('study_df_results.csv', 'w').write(study_df_results.to_csv(index=False))
-                    all_author_results = await postprocess_author_results(author_results)
-                    author_df_source, author_df_ent, author_df_author, author_df_rel_type, author_df_results = all_author_results
-                    open('author_df_source.csv', 'w').write(author_df_source.to_csv(index=False))
-                    open('author_df_ent.csv', 'w').write(author_df_ent.to_csv(index=False))
-                    open('author_df_author.csv', 'w').write(author_df_author.to_csv(index=False))
-                    open('author_df_rel_type.csv', 'w').write(author_df_rel_type.to_csv(index=False))
-                    open('author_df_results.csv', 'w').write(author_df_results.to_csv(index=False))
-                    open('study_results.json', 'w').write(json.dumps(study_results))
-                    open('author_results.json', 'w').write(json.dumps(author_results))
-                    with zipfile.ZipFile('results.zip', 'w') as zipf:
-                        zipf.write('study_results.json')
-                        zipf.write('author_results.json')
-                        zipf.write('study_df_source.csv')
-                        zipf.write('study_df_ent.csv')
-                        zipf.write('study_df_rel_type.csv')
-                        zipf.write('study_df_results.csv')
-                        zipf.write('author_df_source.csv')
-                        zipf.write('author_df_ent.csv')
-                        zipf.write('author_df_author.csv')
-                        zipf.write('author_df_rel_type.csv')
-                        zipf.write('author_df_results.csv')
-                    os.remove('study_results.json')
-                    os.remove('author_results.json')
-                    os.remove('study_df_source.csv')
-                    os.remove('study_df_ent.csv')
-                    os.remove('study_df_rel_type.csv')
-                    os.remove('study_df_results.csv')
-                    os.remove('author_df_source.csv')
-                    os.remove('author_df_ent.csv')
-                    os.remove('author_df_author.csv')
-                    os.remove('author_df_rel_type.csv')
-                    os.remove('author_df_results.csv')
-                    yield f"event: done\ndata: results.zip\n\n"
-            else:
-                await asyncio.sleep(0.1)
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+                    if not archive_ready:
+                        await export_session(session_id, study_builder, author_builder, study_results, author_results,
+                                             export_format)
+                    yield f"event: done\ndata: {session_id}.zip\n\n"
+    return StreamingResponse(track_session(event_stream()), media_type="text/event-stream")
 
-@app.get('/download/{file_name}')
-async def download(file_name: str):
-    return FileResponse(file_name)
+async def store_results(session_id, results):
+    # Results already stored, e.g. when a session is resumed, are ignored by the store
+    if result_store is not None and results:
+        await asyncio.to_thread(result_store.add, session_id, results)
 
-@app.post('/upload')
-async def upload_csv(request: Request, file: UploadFile = File(...)):
-    if not file.filename.endswith(".csv"):
-        return {"error": "File is not a CSV"}
-    else:
-        content = await file.read()
-        dtype_dict = {
-            "PDF File": "string",
-            "Title": "string",
-            "Author Name": "string",
-            "Affiliation": "string",
-            "Email": "string",
-            "Disclosure Statement": "string"
+
+async def persist_session(session_id: str, total_message: int):
+    """
+    Add the results of a session to the result store as they arrive, whether or not a client follows the session on
+    /events. Results that cannot be stored are logged and read again from the session's result stream until they
+    are, or until the stream expires.
+    """
+    result_stream = f'result:{session_id}'
+    received = 0
+    last_id = '0'
+    while received < total_message:
+        response = await redis_client.xread({result_stream: last_id}, count=100, block=EVENTS_BLOCK_MS)
+        if not response:
+            if received and not await redis_client.exists(result_stream):
+                logging.error(f"Results of session {session_id} expired before they were all stored")
+                break
+            continue
+        entries = response[0][1]
+        results = []
+        for _, fields in entries:
+            try:
+                results.append(json.loads(fields[b'data']))
+            except (TypeError, KeyError) as e:
+                logging.error(f"Could not decode message: {fields}.\n Error: {e}")
+        try:
+            await store_results(session_id, results)
+        except Exception as e:
+            logging.error(f"Could not store results of session {session_id}: {e}")
+            await asyncio.sleep(STORE_RETRY_SECONDS)
+            if not await redis_client.exists(result_stream):
+                logging.error(f"Results of session {session_id} expired before they were all stored")
+                break
+            continue
+        received += len(entries)
+        last_id = entries[-1][0]
+    await redis_client.srem(STORING_KEY, session_id)
+
+
+persist_tasks = set()
+
+
+def persist_in_background(session_id: str, total_message: int):
+    task = asyncio.create_task(persist_session(session_id, total_message))
+    # The event loop only keeps weak references to tasks
+    persist_tasks.add(task)
+    task.add_done_callback(persist_tasks.discard)
+
+
+async def resume_persisting():
+    for session_id in await redis_client.smembers(STORING_KEY):
+        session_id = session_id.decode('utf-8')
+        total_message = await redis_client.hget(session_id, 'total_message')
+        if total_message is None:
+            await redis_client.srem(STORING_KEY, session_id)
+        else:
+            persist_in_background(session_id, int(total_message))
+
+async def session_format(session_id):
+    export_format = await redis_client.hget(session_id, 'export_format')
+    return export_format.decode('utf-8') if export_format else 'csv'
+
+async def export_session(session_id, study_builder, author_builder, study_results, author_results,
+                         export_format='csv'):
+    # Building the tables is CPU-bound, so it runs in a worker thread rather than stalling the other sessions' streams
+    with POSTPROCESS_SECONDS.labels(channel='study_channel').time():
+        study_df_source, study_df_ent, study_df_rel_type, study_df_results = \
+            await asyncio.to_thread(study_builder.tables)
+    with POSTPROCESS_SECONDS.labels(channel='author_channel').time():
+        author_df_source, author_df_ent, author_df_author, author_df_rel_type, author_df_results = \
+            await asyncio.to_thread(author_builder.tables)
+    tables = {
+        'study_df_source': study_df_source,
+        'study_df_ent': study_df_ent,
+        'study_df_rel_type': study_df_rel_type,
+        'study_df_results': study_df_results,
+        'author_df_source': author_df_source,
+        'author_df_ent': author_df_ent,
+        'author_df_author': author_df_author,
+        'author_df_rel_type': author_df_rel_type,
+        'author_df_results': author_df_results
+    }
+    documents = {
+        'study_results.json': study_results,
+        'author_results.json': author_results
+    }
+    with ARCHIVE_SECONDS.time():
+        archive = await asyncio.to_thread(build_archive, tables, documents, export_format)
+        await store_archive(redis_client, session_id, archive, export_format)
+
+def replay_results(entries, study_builder, author_builder, study_results, author_results):
+    for entry_id, fields in entries:
+        result = json.loads(fields[b'data'])
+        if result['channel'] == 'study_channel':
+            study_results.append(result)
+            study_builder.add(result)
+        else:
+            author_results.append(result)
+            author_builder.add(result)
+
+async def export_stored_results(session_id, export_format):
+    """
+    Export a finished session in another format, from the results kept in its result stream.
+    Returns False if the session is not finished or its results expired.
+    """
+    total_message = await redis_client.hget(session_id, 'total_message')
+    result_stream = f'result:{session_id}'
+    if not total_message or await redis_client.xlen(result_stream) < int(total_message):
+        return False
+    study_results, author_results = [], []
+    study_builder, author_builder = StudyResultsBuilder(), AuthorResultsBuilder()
+    start = '-'
+    while entries := await redis_client.xrange(result_stream, min=start, count=1000):
+        # Replaying the results through the builders is CPU-bound, so it runs in a worker thread
+        await asyncio.to_thread(replay_results, entries, study_builder, author_builder, study_results, author_results)
+        start = b'(' + entries[-1][0]
+    await export_session(session_id, study_builder, author_builder, study_results, author_results, export_format)
+    return True
+
+@app.get('/metrics')
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def get_store():
+    if result_store is None:
+        raise HTTPException(status_code=503, detail="The result store is disabled")
+    return result_store
+
+async def query_page(query, limit, id_column, *args):
+    """
+    A page of a store listing, with the cursor of the next page or None if this is the last one.
+    """
+    items = await asyncio.to_thread(query, *args, limit=limit)
+    return {'items': items, 'next': items[-1][id_column] if len(items) == limit else None}
+
+@app.get('/entities')
+async def list_entities(name: Optional[str] = None, after: int = Query(0, ge=0),
+                        limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    Entities of every session, optionally those whose name starts with `name`. Pass `next` as `after` for the next page.
+    """
+    return await query_page(get_store().entities, limit, 'ent_id', name, after)
+
+@app.get('/entities/{ent_id}/studies')
+async def entity_studies(ent_id: int, after: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    return await query_page(get_store().entity_study_results, limit, 'res_id', ent_id, after)
+
+@app.get('/entities/{ent_id}/authors')
+async def entity_authors(ent_id: int, after: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    return await query_page(get_store().entity_author_results, limit, 'res_id', ent_id, after)
+
+@app.get('/authors')
+async def list_authors(name: Optional[str] = None, after: int = Query(0, ge=0),
+                       limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    Authors of every session, optionally those whose name starts with `name`. Pass `next` as `after` for the next page.
+    """
+    return await query_page(get_store().authors, limit, 'author_id', name, after)
+
+@app.get('/authors/{author_id}/entities')
+async def author_entities(author_id: int, after: int = Query(0, ge=0),
+                          limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    return await query_page(get_store().author_entity_results, limit, 'res_id', author_id, after)
+
+@app.get('/download/{file_name}')
+async def download(file_name: str, export_format: Optional[str] = Query(None, alias='format')):
+    """
+    Download the archive of a session, in the session's export format or the one asked for. An archive in another
+    format is built from the session's stored results on first request.
+    """
+    session_id = file_name.removesuffix('.zip')
+    export_format = export_format or await session_format(session_id)
+    try:
+        check_format(export_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    archive = await find_archive(redis_client, session_id, export_format)
+    if not archive and await export_stored_results(session_id, export_format):
+        archive = await find_archive(redis_client, session_id, export_format)
+    if not archive:
+        raise HTTPException(status_code=404, detail="Export not found or expired")
+    path, size = archive
+    return StreamingResponse(
+        stream_archive(path),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{session_id}.zip"',
+            "Content-Length": str(size)
         }
-        df = pd.read_csv(io.StringIO(content.decode("utf-8")), delimiter='\t', dtype=dtype_dict,
-                         keep_default_na=False)
-        author_tasks, author_ids = await publish_infos(df, 'author_channel')
-        study_tasks, study_ids = await publish_infos(df, 'study_channel')
-        total_message = len(author_tasks) + len(study_tasks)
-        await asyncio.gather(*(author_tasks+study_tasks))
-        session_id = str(uuid.uuid4())
-        await redis_client.hset(session_id, 'total_message', str(total_message))
-        return {"session_id": session_id}
+    )
 
+@app.post('/upload')
+async def upload_csv(request: Request, export_format: str = Query('csv'), priority: str = Query('normal'),
+                     weight: float = Query(1.0)):
+    """
+    Read the uploaded CSV as it arrives and queue the jobs of each paper as soon as all its rows are read.
+    The tables of the session are exported in export_format: csv, parquet or arrow.
+    Listeners take turns between the sessions of the same priority (high, normal or low), giving each a share of
+    the jobs in proportion to its weight.
+    Uploads are deferred (429) or rejected (503) with a Retry-After while the listeners are overloaded. An accepted
+    upload is answered with the estimated seconds until every queued job, its own included, is done.
+    An unknown export format, priority or weight is answered with 400.
+    A CSV that cannot be read, or an upload cut short, is answered with 400 and the jobs it queued are dropped.
+    """
+    try:
+        check_format(export_format)
+        check_priority(priority, weight)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    admission = Admission(redis_client)
+    decision = await admission.check()
+    UPLOADS.labels(decision=decision.action).inc()
+    if decision.action != ACCEPT:
+        eta = f"{decision.eta:.0f}s" if decision.eta is not None else "an unknown time"
+        raise HTTPException(status_code=429 if decision.action == DEFER else 503,
+                            detail=f"The queued jobs will take {eta} to be done. "
+                                   f"Try again in {decision.retry_after}s",
+                            headers={'Retry-After': str(decision.retry_after)})
+    session_id = str(uuid.uuid4())
+    data_id = 0
+    queue = SessionQueue(redis_client, session_id, priority, weight) if FAIR_SCHEDULING else None
+    publisher = JobPublisher(queue=queue)
+    # Combined jobs are answered with a study result and an author result, so a paper always yields two results
+    channels = ('paper_channel',) if COMBINED_MODE else ('author_channel', 'study_channel')
+    start = time.perf_counter()
+    try:
+        async for rows in stream_papers(request):
+            for channel in channels:
+                await publisher.add(build_job(rows, channel, data_id, session_id))
+            data_id += 1
+        await publisher.flush()
+    except (ValueError, ClientDisconnect) as e:
+        # The session is never started, so the jobs queued before the failure would only waste inference
+        if data_id:
+            await purge_session(session_id, channels, queue)
+        raise HTTPException(status_code=400, detail=str(e) or "The upload was interrupted")
+    UPLOAD_SECONDS.observe(time.perf_counter() - start)
+    PAPERS_UPLOADED.inc(data_id)
+    total_message = 2 * data_id
+    await redis_client.hset(session_id, mapping={'total_message': str(total_message), 'export_format': export_format})
+    if result_store is not None:
+        await redis_client.sadd(STORING_KEY, session_id)
+        persist_in_background(session_id, total_message)
+    eta = await admission.estimate()
+    return {"session_id": session_id, "eta_seconds": round(eta, 1) if eta is not None else None}
@@ -0,0 +1,258 @@
+import sqlite3
+import threading
+
+from canonical import AuthorCanonicalizer, Canonicalizer
+from postprocess import author_details, infer_is_funded
+
+# Entities, authors and relationship types are shared by every session; sources and relationships are kept per
+# session. A source is keyed by channel as well, since the study and the author results of a paper arrive apart.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    session_id TEXT NOT NULL,
+    source_id INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    title TEXT,
+    disclosure TEXT,
+    error TEXT,
+    PRIMARY KEY (session_id, source_id, channel)
+);
+CREATE TABLE IF NOT EXISTS entities (
+    ent_id INTEGER PRIMARY KEY,
+    org_name TEXT NOT NULL UNIQUE,
+    ent_ind_support TEXT
+);
+CREATE INDEX IF NOT EXISTS entities_org_name ON entities (org_name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS authors (
+    author_id INTEGER PRIMARY KEY,
+    author_name TEXT NOT NULL,
+    affiliation TEXT NOT NULL,
+    email TEXT NOT NULL,
+    UNIQUE (author_name, affiliation, email)
+);
+CREATE INDEX IF NOT EXISTS authors_author_name ON authors (author_name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS relationship_types (
+    rel_id INTEGER PRIMARY KEY,
+    relationship_type TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS study_relationships (
+    res_id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    source_id INTEGER NOT NULL,
+    ent_id INTEGER NOT NULL REFERENCES entities,
+    rel_id INTEGER NOT NULL REFERENCES relationship_types,
+    relationship_indication TEXT
+);
+CREATE INDEX IF NOT EXISTS study_relationships_entity ON study_relationships (ent_id, res_id);
+CREATE INDEX IF NOT EXISTS study_relationships_source ON study_relationships (session_id, source_id);
+CREATE TABLE IF NOT EXISTS author_relationships (
+    res_id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    source_id INTEGER NOT NULL,
+    ent_id INTEGER NOT NULL REFERENCES entities,
+    author_id INTEGER NOT NULL REFERENCES authors,
+    rel_id INTEGER NOT NULL REFERENCES relationship_types
+);
+CREATE INDEX IF NOT EXISTS author_relationships_entity ON author_relationships (ent_id, res_id);
+CREATE INDEX IF NOT EXISTS author_relationships_author ON author_relationships (author_id, res_id);
+CREATE INDEX IF NOT EXISTS author_relationships_source ON author_relationships (session_id, source_id);
+"""
+
+
+def name_pattern(name):
+    # Names are matched by prefix, which the NOCASE indexes can serve
+    escaped = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+class ResultStore:
+    """
+    The results of every session in a SQLite database, queryable across sessions. Results are added as they arrive;
+    adding the same result twice has no effect, so a session can be replayed. Listings are paginated by ID: pass the
+    last ID of a page as `after` to get the next one.
+    Calls are blocking and serialized on one connection; the web app makes them from worker threads.
+
+    Org names and authors are canonicalized against every entity and author already stored, so the same
+    organization keeps one ent_id across sessions however it is spelled. Entities another process adds while this
+    one runs are only matched by exact name until the store is opened again.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            # WAL lets the readers of other processes run while results are written
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(SCHEMA)
+            self.load()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def load(self):
+        """
+        Index the stored entities and authors, in the order they were added, for canonicalization.
+        """
+        self.canonical_entities = Canonicalizer()
+        self.entity_ids = []
+        for ent_id, org_name in self.connection.execute('SELECT ent_id, org_name FROM entities ORDER BY ent_id'):
+            if self.canonical_entities.register(org_name) == len(self.entity_ids):
+                self.entity_ids.append(ent_id)
+        self.canonical_authors = AuthorCanonicalizer()
+        self.author_ids = []
+        for author_id, *author in self.connection.execute(
+                'SELECT author_id, author_name, affiliation, email FROM authors ORDER BY author_id'):
+            if self.canonical_authors.add(*author, register=True) == len(self.author_ids):
+                self.author_ids.append(author_id)
+
+    def get_id(self, table, id_column, columns):
+        names = ', '.join(columns)
+        condition = ' AND '.join(f'{name} = ?' for name in columns)
+        values = list(columns.values())
+        row = self.connection.execute(f'SELECT {id_column} FROM {table} WHERE {condition}', values).fetchone()
+        if row is not None:
+            return row[0]
+        placeholders = ', '.join('?' * len(columns))
+        return self.connection.execute(f'INSERT INTO {table} ({names}) VALUES ({placeholders})', values).lastrowid
+
+    def entity_id(self, org_name):
+        canonical_id = self.canonical_entities.add(org_name)
+        if canonical_id == len(self.entity_ids):
+            # Another process may have stored the name since this one loaded the entities
+            row = self.connection.execute('SELECT ent_id FROM entities WHERE org_name = ?', (org_name,)).fetchone()
+            self.entity_ids.append(row[0] if row is not None else self.connection.execute(
+                'INSERT INTO entities (org_name, ent_ind_support) VALUES (?, ?)',
+                (org_name, infer_is_funded(org_name))).lastrowid)
+        return self.entity_ids[canonical_id]
+
+    def rel_type_id(self, relationship_type):
+        return self.get_id('relationship_types', 'rel_id', {'relationship_type': relationship_type})
+
+    def author_id(self, author_name, affiliation, email):
+        canonical_id = self.canonical_authors.add(author_name, affiliation, email)
+        if canonical_id == len(self.author_ids):
+            self.author_ids.append(self.get_id('authors', 'author_id', {
+                'author_name': author_name, 'affiliation': affiliation, 'email': email}))
+        return self.author_ids[canonical_id]
+
+    def add_study_payload(self, session_id, source_id, payload):
+        rows = []
+        for study_info in payload['study_info']:
+            ent_id = self.entity_id(study_info['org_name'])
+            for rel in study_info['relationships']:
+                rows.append((session_id, source_id, ent_id, self.rel_type_id(rel['relationship_type']),
+                             rel['relationship_indication']))
+        self.connection.executemany('INSERT INTO study_relationships (session_id, source_id, ent_id, rel_id, '
+                                    'relationship_indication) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def add_author_payload(self, session_id, source_id, source, payload):
+        rows = []
+        for author_info in payload['author_info']:
+            author_id = self.author_id(author_info['author_name'], *author_details(author_info, source))
+            for rel in author_info['organization']:
+                ent_id = self.entity_id(rel['org_name'])
+                for relationship in rel['relationship_type']:
+                    rows.append((session_id, source_id, ent_id, author_id, self.rel_type_id(relationship)))
+        self.connection.executemany('INSERT INTO author_relationships (session_id, source_id, ent_id, author_id, '
+                                    'rel_id) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def add(self, session_id, results):
+        """
+        Add results of a session in one transaction.
+        """
+        with self.lock:
+            try:
+                with self.connection:
+                    for result in results:
+                        self.add_result(session_id, result)
+            except Exception:
+                # The canonical IDs given out in the transaction were rolled back with it
+                self.load()
+                raise
+
+    def add_result(self, session_id, result):
+        source = result['source']
+        added = self.connection.execute(
+            'INSERT OR IGNORE INTO sources (session_id, source_id, channel, title, disclosure, error) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (session_id, result['id'], result['channel'], source['title'], source['disclosure'],
+             result['error'])).rowcount
+        if not added or result['payload'] is None:
+            return
+        if result['channel'] == 'study_channel':
+            self.add_study_payload(session_id, result['id'], result['payload'])
+        else:
+            self.add_author_payload(session_id, result['id'], source, result['payload'])
+
+    def query(self, sql, params):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def entities(self, name=None, after=0, limit=50):
+        """
+        Entities whose name starts with `name`, with the number of papers they appear in.
+        """
+        condition = "AND org_name LIKE ? ESCAPE '\\'" if name else ''
+        params = [after] + ([name_pattern(name)] if name else []) + [limit]
+        return self.query(f"""
+            SELECT ent_id, org_name, ent_ind_support,
+                (SELECT COUNT(*) FROM (
+                    SELECT session_id, source_id FROM study_relationships WHERE ent_id = e.ent_id
+                    UNION SELECT session_id, source_id FROM author_relationships WHERE ent_id = e.ent_id)) AS papers
+            FROM entities AS e
+            WHERE ent_id > ? {condition}
+            ORDER BY ent_id LIMIT ?""", params)
+
+    def authors(self, name=None, after=0, limit=50):
+        """
+        Authors whose name starts with `name`, with the number of papers they appear in.
+        """
+        condition = "AND author_name LIKE ? ESCAPE '\\'" if name else ''
+        params = [after] + ([name_pattern(name)] if name else []) + [limit]
+        return self.query(f"""
+            SELECT author_id, author_name, affiliation, email,
+                (SELECT COUNT(*) FROM (SELECT DISTINCT session_id, source_id FROM author_relationships
+                                       WHERE author_id = a.author_id)) AS papers
+            FROM authors AS a
+            WHERE author_id > ? {condition}
+            ORDER BY author_id LIMIT ?""", params)
+
+    def entity_study_results(self, ent_id, after=0, limit=50):
+        """
+        The relationships of an entity with the studies of every session.
+        """
+        return self.query("""
+            SELECT r.res_id, r.session_id, r.source_id, s.title, t.relationship_type, r.relationship_indication
+            FROM study_relationships AS r
+            JOIN relationship_types AS t USING (rel_id)
+            LEFT JOIN sources AS s ON s.session_id = r.session_id AND s.source_id = r.source_id
+                AND s.channel = 'study_channel'
+            WHERE r.ent_id = ? AND r.res_id > ?
+            ORDER BY r.res_id LIMIT ?""", (ent_id, after, limit))
+
+    def author_results(self, column, value, after=0, limit=50):
+        return self.query(f"""
+            SELECT r.res_id, r.session_id, r.source_id, s.title, r.author_id, a.author_name, r.ent_id, e.org_name,
+                t.relationship_type
+            FROM author_relationships AS r
+            JOIN authors AS a USING (author_id)
+            JOIN entities AS e USING (ent_id)
+            JOIN relationship_types AS t USING (rel_id)
+            LEFT JOIN sources AS s ON s.session_id = r.session_id AND s.source_id = r.source_id
+                AND s.channel = 'author_channel'
+            WHERE r.{column} = ? AND r.res_id > ?
+            ORDER BY r.res_id LIMIT ?""", (value, after, limit))
+
+    def entity_author_results(self, ent_id, after=0, limit=50):
+        """
+        The relationships of an entity with the authors of every session.
+        """
+        return self.author_results('ent_id', ent_id, after, limit)
+
+    def author_entity_results(self, author_id, after=0, limit=50):
+        """
+        The relationships of an author with entities, in every session.
+        """
+        return self.author_results('author_id', author_id, after, limit)
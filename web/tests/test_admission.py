@@ -0,0 +1,75 @@
+import os
+import time
+
+import pytest
+import redis.asyncio as redis
+from fastapi import HTTPException
+
+import admission
+import server
+
+CHANNEL_KEYS = [key for channel_name in admission.CHANNELS for key in (channel_name, f'backlog:{channel_name}')]
+
+
+@pytest.fixture
+async def redisdb():
+    redis_host = os.getenv('REDIS_HOST', 'localhost')
+    redis_port = os.getenv('REDIS_PORT', 6379)
+    return await redis.from_url(f"redis://{redis_host}:{redis_port}")
+
+async def reset(redisdb):
+    await redisdb.delete(*CHANNEL_KEYS, *[key async for key in redisdb.scan_iter('completed:*')])
+
+async def record_completed(redisdb, channel_name, counts, now):
+    # Completed jobs of the whole buckets before now, most recent last; listeners leave idle buckets unset
+    current = int(now // admission.BUCKET_SECONDS)
+    for bucket, count in zip(range(current - len(counts), current), counts):
+        if count:
+            await redisdb.set(admission.completed_key(channel_name, bucket), count)
+
+async def queue_jobs(redisdb, channel_name, count):
+    for i in range(count):
+        await redisdb.xadd(channel_name, {'data': str(i)})
+
+@pytest.mark.asyncio
+async def test_admission_load(redisdb):
+    await reset(redisdb)
+    now = 1000000.0
+    await record_completed(redisdb, 'author_channel', [20, 0, 10], now)
+    await record_completed(redisdb, 'study_channel', [5], now - 3600)
+    await queue_jobs(redisdb, 'author_channel', 3)
+    await redisdb.set('backlog:author_channel', 27)
+    await queue_jobs(redisdb, 'study_channel', 2)
+    load = await admission.Admission(redisdb, window=300).load(now)
+    # Idle buckets do not count, and completions older than the window are forgotten
+    assert load == {'author_channel': (30, 1.5), 'study_channel': (2, None), 'paper_channel': (0, None)}
+    assert admission.Admission.eta(load) is None
+    del load['study_channel']
+    assert admission.Admission.eta(load) == 20
+    assert admission.Admission.eta({'author_channel': (0, None)}) == 0
+
+@pytest.mark.asyncio
+async def test_admission_check(redisdb):
+    await reset(redisdb)
+    await record_completed(redisdb, 'paper_channel', [10], time.time())
+    await queue_jobs(redisdb, 'paper_channel', 5)
+    await redisdb.set('backlog:paper_channel', 45)
+    decision = await admission.Admission(redisdb, max_wait=60, max_jobs=100).check()
+    assert (decision.action, decision.eta) == (admission.ACCEPT, 50)
+    decision = await admission.Admission(redisdb, max_wait=20, max_jobs=100).check()
+    assert (decision.action, decision.retry_after) == (admission.DEFER, 30)
+    decision = await admission.Admission(redisdb, max_wait=20, max_jobs=40).check()
+    assert (decision.action, decision.retry_after) == (admission.REJECT, 11)
+
+@pytest.mark.asyncio
+async def test_upload_rejected(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    monkeypatch.setattr(server, 'Admission', lambda client: admission.Admission(client, max_jobs=10, retry_after=60))
+    await reset(redisdb)
+    await redisdb.set('backlog:study_channel', 10)
+    # The upload is turned down before its body is read
+    with pytest.raises(HTTPException) as error:
+        await server.upload_csv(None, 'csv', 'normal', 1.0)
+    assert error.value.status_code == 503
+    assert error.value.headers == {'Retry-After': '60'}
+    await reset(redisdb)
@@ -0,0 +1,40 @@
+from canonical import AuthorCanonicalizer, Canonicalizer, normalize_author, normalize_org
+
+
+def test_normalize():
+    assert normalize_org('The Pfizer Company') == 'pfizer'
+    assert normalize_org('Merck & Co., Inc.') == 'merck'
+    assert normalize_org('Merck & Co.') == 'merck'
+    assert normalize_org('Eli Lilly and Company') == 'eli lilly'
+    assert normalize_org('Johnson & Johnson') == 'johnson and johnson'
+    assert normalize_org('Procter & Gamble Co.') == 'procter and gamble'
+    assert normalize_org('Hôpital Sainte-Justine') == 'hopital sainte justine'
+    assert normalize_org('Co') == 'co'
+    assert normalize_author('Dr. John Smith, PhD') == 'john smith'
+
+
+def test_canonicalizer():
+    canonicalizer = Canonicalizer()
+    names = ['Pfizer Inc.', 'National Institutes of Health', 'PFIZER', 'National Institute of Health',
+             'Study Group 1', 'Study Group 2', 'University of Toronto', 'University of Ottawa']
+    assert [canonicalizer.add(name) for name in names] == [0, 1, 0, 1, 2, 3, 4, 5]
+    assert canonicalizer.names[:2] == ['Pfizer Inc.', 'National Institutes of Health']
+    # Names registered as canonical are not matched with the others
+    assert canonicalizer.register('National Institute of Healths') == 6
+
+
+def test_canonicalizer_common_words():
+    canonicalizer = Canonicalizer(max_block_size=2)
+    assert [canonicalizer.add(f'University of Place{i} Campus') for i in range(5)] == [0, 1, 2, 3, 4]
+    # Only the uncommon word finds the candidate
+    assert canonicalizer.add('University of Place3 Campuses') == 3
+    assert canonicalizer.add('University of Somewhere') == 5
+
+
+def test_author_canonicalizer():
+    canonicalizer = AuthorCanonicalizer()
+    assert canonicalizer.add('Dr. John Smith', 'McGill', 'john@mcgill.ca') == 0
+    assert canonicalizer.add('John Smith', 'UofT', 'JOHN@mcgill.ca ') == 0
+    assert canonicalizer.add('John Smith', 'University of Toronto', '') == 1
+    assert canonicalizer.add('John Smith', 'University of Toronto Inc', '') == 1
+    assert canonicalizer.add('Emily Johnson', 'University of Toronto', '') == 2
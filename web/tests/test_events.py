@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import zipfile
+
+import pandas as pd
+import redis.asyncio as redis
+from fastapi import HTTPException
+import pytest
+from prometheus_client import REGISTRY
+
+import export
+import server
+
+
+def make_result(data_id, channel, session_id):
+    key = 'study_info' if channel == 'study_channel' else 'author_info'
+    return {
+        'id': data_id,
+        'source': {'title': f'Title {data_id}', 'disclosure': 'The author declares no conflict of interest.'},
+        'payload': {key: []},
+        'error': None,
+        'channel': channel,
+        'session_id': session_id
+    }
+
+@pytest.fixture
+async def redisdb():
+    redis_host = os.getenv('REDIS_HOST', 'localhost')
+    redis_port = os.getenv('REDIS_PORT', 6379)
+    return await redis.from_url(f"redis://{redis_host}:{redis_port}")
+
+@pytest.fixture(autouse=True)
+def export_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_DIR', str(tmp_path))
+    return tmp_path
+
+@pytest.mark.asyncio
+async def test_events_reads_own_session(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('session-a', 'result:session-a', 'result:session-b', server.export_key('session-a'))
+    await redisdb.hset('session-a', 'total_message', '2')
+    await redisdb.xadd('result:session-b', {'data': json.dumps(make_result(0, 'study_channel', 'session-b'))})
+    study_id = await redisdb.xadd('result:session-a', {'data': json.dumps(make_result(0, 'study_channel', 'session-a'))})
+    author_id = await redisdb.xadd('result:session-a',
+                                   {'data': json.dumps(make_result(0, 'author_channel', 'session-a'))})
+    response = await server.events('session-a', None)
+    events = [event async for event in response.body_iterator]
+    # Every result of the session is in, so it is as good as done
+    assert events[0] == 'event: start\ndata: {"total_message": 2, "eta_seconds": 0}\n\n'
+    assert events[1] == (f'id: {study_id.decode("utf-8")}\nevent: received_study\n'
+                         f'data: {{"id": 0, "channel": "study_channel"}}\n\n')
+    assert events[2] == (f'id: {author_id.decode("utf-8")}\nevent: received_author\n'
+                         f'data: {{"id": 0, "channel": "author_channel"}}\n\n')
+    assert events[3] == "event: done\ndata: session-a.zip\n\n"
+    assert len(events) == 4
+
+@pytest.mark.asyncio
+async def test_download_session_archive(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('session-c', 'result:session-c', server.export_key('session-c'))
+    await redisdb.hset('session-c', 'total_message', '1')
+    await redisdb.xadd('result:session-c', {'data': json.dumps(make_result(0, 'study_channel', 'session-c'))})
+    response = await server.events('session-c', None)
+    [event async for event in response.body_iterator]
+    response = await server.download('session-c.zip', None)
+    archive = b''.join([chunk async for chunk in response.body_iterator])
+    assert response.headers['content-length'] == str(len(archive))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        assert 'study_df_source.csv' in zipf.namelist()
+        assert json.loads(zipf.read('study_results.json'))[0]['session_id'] == 'session-c'
+        assert zipf.read('study_df_source.csv').decode('utf-8').splitlines()[0] == 'id,title,disclosure'
+
+@pytest.mark.asyncio
+async def test_archive_stored_on_disk(redisdb, export_dir, monkeypatch):
+    monkeypatch.setattr(export, 'CHUNK_SIZE', 16)
+    expired = export_dir / 'expired.zip'
+    expired.write_bytes(b'old')
+    os.utime(expired, (0, 0))
+    buffer = io.BytesIO(b'archive' * 10)
+    await export.store_archive(redisdb, 'session-g', buffer)
+    # Redis only holds the name of the file, which expires with it
+    name = (await redisdb.get(server.export_key('session-g'))).decode('utf-8')
+    assert 0 < await redisdb.ttl(server.export_key('session-g')) <= export.EXPORT_TTL
+    assert (export_dir / name).read_bytes() == b'archive' * 10
+    assert buffer.closed
+    assert not expired.exists()
+    path, size = await export.find_archive(redisdb, 'session-g')
+    assert size == 70
+    assert b''.join([chunk async for chunk in export.stream_archive(path)]) == b'archive' * 10
+    (export_dir / name).unlink()
+    assert await export.find_archive(redisdb, 'session-g') is None
+    await redisdb.delete(server.export_key('session-g'))
+
+@pytest.mark.asyncio
+async def test_download_other_format(redisdb, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('session-f', 'result:session-f', server.export_key('session-f'),
+                         server.export_key('session-f', 'parquet'))
+    await redisdb.hset('session-f', 'total_message', '1')
+    await redisdb.xadd('result:session-f', {'data': json.dumps(make_result(0, 'study_channel', 'session-f'))})
+    response = await server.events('session-f', None)
+    [event async for event in response.body_iterator]
+    response = await server.download('session-f.zip', 'parquet')
+    archive = b''.join([chunk async for chunk in response.body_iterator])
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        assert 'study_df_source.csv' not in zipf.namelist()
+        df = pd.read_parquet(io.BytesIO(zipf.read('study_df_source.parquet')))
+        assert list(df.columns) == ['id', 'title', 'disclosure']
+
+@pytest.mark.asyncio
+async def test_download_unknown_format(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    with pytest.raises(HTTPException) as error:
+        await server.download('session-c.zip', 'xlsx')
+    assert error.value.status_code == 400
+
+@pytest.mark.asyncio
+async def test_metrics(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('session-d', 'result:session-d', server.export_key('session-d'))
+    await redisdb.hset('session-d', 'total_message', '1')
+    await redisdb.xadd('result:session-d', {'data': json.dumps(make_result(0, 'study_channel', 'session-d'))})
+    response = await server.events('session-d', None)
+    events = response.body_iterator
+    await events.__anext__()
+    assert REGISTRY.get_sample_value('web_sse_sessions_active') == 1
+    [event async for event in events]
+    assert REGISTRY.get_sample_value('web_sse_sessions_active') == 0
+    response = await server.get_metrics()
+    text = response.body.decode('utf-8')
+    assert '# TYPE web_sse_sessions_active gauge' in text
+    assert 'web_postprocess_seconds_count{channel="study_channel"}' in text
+    assert 'web_archive_seconds_bucket{le="+Inf"}' in text
+
+@pytest.mark.asyncio
+async def test_events_resume_from_last_event_id(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('session-e', 'result:session-e', server.export_key('session-e'))
+    await redisdb.hset('session-e', 'total_message', '2')
+    first_id = await redisdb.xadd('result:session-e', {'data': json.dumps(make_result(0, 'study_channel', 'session-e'))})
+    response = await server.events('session-e', None)
+    events = response.body_iterator
+    start = await events.__anext__()
+    assert start.startswith("event: start\ndata: ")
+    assert json.loads(start.removeprefix("event: start\ndata: "))['total_message'] == 2
+    assert await events.__anext__() == (f'id: {first_id.decode("utf-8")}\nevent: received_study\n'
+                                        f'data: {{"id": 0, "channel": "study_channel"}}\n\n')
+    # The client disconnects and the last result arrives in the meantime
+    await events.aclose()
+    last_id = await redisdb.xadd('result:session-e', {'data': json.dumps(make_result(0, 'author_channel', 'session-e'))})
+    response = await server.events('session-e', first_id.decode('utf-8'))
+    events = [event async for event in response.body_iterator]
+    assert events[1] == (f'id: {last_id.decode("utf-8")}\nevent: received_author\n'
+                         f'data: {{"id": 0, "channel": "author_channel"}}\n\n')
+    assert events[2] == "event: done\ndata: session-e.zip\n\n"
+    assert len(events) == 3
+
+    def fail(*args):
+        raise AssertionError("The archive of a finished session is not built again")
+
+    monkeypatch.setattr(server, 'build_archive', fail)
+    response = await server.events('session-e', last_id.decode('utf-8'))
+    events = [event async for event in response.body_iterator]
+    assert events[1:] == ["event: done\ndata: session-e.zip\n\n"]
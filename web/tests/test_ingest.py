@@ -0,0 +1,132 @@
+import json
+import os
+from functools import partial
+
+import redis.asyncio as redis
+import pytest
+from fastapi import HTTPException
+from starlette.requests import ClientDisconnect
+
+import server
+from ingest import stream_papers
+from scheduling import PRIORITIES, SessionQueue
+
+CSV = (
+    'PDF File\tTitle\tAuthor Name\tAffiliation\tEmail\tDisclosure Statement\n'
+    'a.pdf\tAdvances in Cancer Immunotherapy\tDr. John Smith\tMcGill\tjohn@mcgill.ca\t'
+    '"The author declares no conflict of interest.\nFunded by the ""National Cancer Institute""."\n'
+    'a.pdf\tAdvances in Cancer Immunotherapy\tDr. Emily Johnson\tUofT\temily@utoronto.ca\t'
+    '"The author declares no conflict of interest.\nFunded by the ""National Cancer Institute""."\n'
+    '\n'
+    'b.pdf\tVaccine Trial\tDr. Jane Doe\t\t\tSupported by Pfizer.\n'
+)
+CHANNELS = ('author_channel', 'study_channel')
+
+
+class FakeRequest:
+    def __init__(self, filename, content, chunk_size=7, disconnect_at=None):
+        boundary = 'influencemapper-boundary'
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.headers = {'content-type': f'multipart/form-data; boundary={boundary}'}
+        self.body = (f'--{boundary}\r\n'
+                     f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                     f'Content-Type: text/csv\r\n\r\n').encode('utf-8') + content + \
+                    f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self.chunk_size = chunk_size
+        self.disconnect_at = disconnect_at
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            if self.disconnect_at is not None and start >= self.disconnect_at:
+                raise ClientDisconnect()
+            yield self.body[start:start + self.chunk_size]
+
+
+@pytest.fixture
+async def redisdb():
+    redis_host = os.getenv('REDIS_HOST', 'localhost')
+    redis_port = os.getenv('REDIS_PORT', 6379)
+    return await redis.from_url(f"redis://{redis_host}:{redis_port}")
+
+@pytest.mark.asyncio
+async def test_stream_papers():
+    papers = [paper async for paper in stream_papers(FakeRequest('data.csv', CSV))]
+    assert [len(paper) for paper in papers] == [2, 1]
+    assert [row['Author Name'] for row in papers[0]] == ['Dr. John Smith', 'Dr. Emily Johnson']
+    assert papers[0][0]['Disclosure Statement'] == \
+        'The author declares no conflict of interest.\nFunded by the "National Cancer Institute".'
+    assert papers[1][0] == {'PDF File': 'b.pdf', 'Title': 'Vaccine Trial', 'Author Name': 'Dr. Jane Doe',
+                            'Affiliation': '', 'Email': '', 'Disclosure Statement': 'Supported by Pfizer.'}
+
+@pytest.mark.asyncio
+async def test_stream_papers_quote_inside_field():
+    csv = (
+        'PDF File\tTitle\tAuthor Name\tAffiliation\tEmail\tDisclosure Statement\n'
+        'a.pdf\tAdvances in Cancer Immunotherapy\tDr. John Smith\t\t\tFunded by a 5" grant.\n'
+        'b.pdf\tVaccine Trial\tDr. Jane Doe\t\t\t"Supported by ""Pfizer""."\n'
+    )
+    papers = [paper async for paper in stream_papers(FakeRequest('data.csv', csv))]
+    assert [paper[0]['Disclosure Statement'] for paper in papers] == ['Funded by a 5" grant.',
+                                                                      'Supported by "Pfizer".']
+
+@pytest.mark.asyncio
+async def test_stream_papers_rejects_other_encodings():
+    with pytest.raises(ValueError):
+        [paper async for paper in stream_papers(FakeRequest('data.csv', CSV.encode('utf-8') + b'\xff\n'))]
+
+@pytest.mark.asyncio
+async def test_stream_papers_rejects_other_files():
+    with pytest.raises(ValueError):
+        [paper async for paper in stream_papers(FakeRequest('data.txt', CSV))]
+
+@pytest.mark.asyncio
+async def test_upload_csv(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await redisdb.delete('author_channel', 'study_channel')
+    response = await server.upload_csv(FakeRequest('data.csv', CSV, chunk_size=1024), 'csv', 'normal', 1.0)
+    assert await redisdb.hget(response['session_id'], 'total_message') == b'4'
+    jobs = [json.loads(fields[b'data']) for _, fields in await redisdb.xrange('author_channel')]
+    assert [job['id'] for job in jobs] == [0, 1]
+    assert jobs[0]['payload']['authors'] == ['Dr. John Smith', 'Dr. Emily Johnson']
+    assert jobs[0]['session_id'] == response['session_id']
+    assert await redisdb.xlen('study_channel') == 2
+    assert 'eta_seconds' in response
+
+async def reset(redisdb):
+    for channel in CHANNELS:
+        await redisdb.delete(channel, f'backlog:{channel}', f'weights:{channel}',
+                             *[f'schedule:{channel}:{priority}' for priority in PRIORITIES],
+                             *await redisdb.keys(f'jobs:{channel}:*'))
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('export_format,priority,weight', [('xlsx', 'normal', 1.0), ('csv', 'urgent', 1.0),
+                                                           ('csv', 'normal', 0.0)])
+async def test_upload_csv_invalid_options(redisdb, monkeypatch, export_format, priority, weight):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    await reset(redisdb)
+    with pytest.raises(HTTPException) as e:
+        await server.upload_csv(FakeRequest('data.csv', CSV), export_format, priority, weight)
+    assert e.value.status_code == 400
+    for channel in CHANNELS:
+        assert await redisdb.xlen(channel) == 0
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('request_', [
+    FakeRequest('data.csv', CSV.encode('utf-8') + b'c.pdf\tTrial\tDr. \xff\t\t\tNone.\n'),
+    FakeRequest('data.csv', CSV + CSV.replace('a.pdf', 'c.pdf'), disconnect_at=700)
+])
+async def test_upload_csv_failure_drops_jobs(redisdb, monkeypatch, request_):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    # Every job is queued as soon as it is built, and all but the first of each channel wait in the session queue
+    monkeypatch.setattr(server, 'JobPublisher', partial(server.JobPublisher, flush_ms=0))
+    monkeypatch.setattr(server, 'SessionQueue', partial(SessionQueue, window=1))
+    await reset(redisdb)
+    with pytest.raises(HTTPException) as e:
+        await server.upload_csv(request_, 'csv', 'normal', 1.0)
+    assert e.value.status_code == 400
+    for channel in CHANNELS:
+        assert await redisdb.xlen(channel) == 0
+        assert await redisdb.keys(f'jobs:{channel}:*') == []
+        assert int(await redisdb.get(f'backlog:{channel}') or 0) == 0
+        assert await redisdb.zcard(f'schedule:{channel}:normal') == 0
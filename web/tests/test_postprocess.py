@@ -0,0 +1,157 @@
+import pytest
+from influencemapper.util import infer_is_funded as _infer_is_funded
+
+import server
+from postprocess import AuthorResultsBuilder, StudyResultsBuilder, funding_support
+
+STUDY_RESULTS = [
+    {
+        'id': 0,
+        'source': {'title': 'Advances in Cancer Immunotherapy', 'disclosure': 'Funded by the National Cancer Institute.'},
+        'payload': {'study_info': [
+            {'org_name': 'National Cancer Institute', 'relationships': [
+                {'relationship_type': 'Fund the study', 'relationship_indication': 'Yes'},
+                {'relationship_type': 'Design the study', 'relationship_indication': 'No'}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'study_channel'
+    },
+    {
+        'id': 1,
+        'source': {'title': 'Vaccine Trial', 'disclosure': 'Supported by Pfizer and the National Cancer Institute.'},
+        'payload': {'study_info': [
+            {'org_name': 'Pfizer', 'relationships': [
+                {'relationship_type': 'Fund the study', 'relationship_indication': 'Yes'}
+            ]},
+            {'org_name': 'National Cancer Institute', 'relationships': [
+                {'relationship_type': 'Support the study', 'relationship_indication': 'Yes'}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'study_channel'
+    },
+    {
+        'id': 2,
+        'source': {'title': 'Unfinished', 'disclosure': 'A very long statement.'},
+        'payload': None,
+        'error': 'Inference did not finish. Try again later.',
+        'channel': 'study_channel'
+    }
+]
+
+AUTHOR_RESULTS = [
+    {
+        'id': 0,
+        'source': {'title': 'Vaccine Trial', 'disclosure': 'Dr. Smith consults for Pfizer.',
+                   'authors': ['Dr. John Smith', 'Dr. Emily Johnson'], 'affiliation': ['McGill', 'UofT'],
+                   'email': ['john@mcgill.ca', 'emily@utoronto.ca']},
+        'payload': {'author_info': [
+            {'author_name': 'Dr. John Smith', 'organization': [
+                {'org_name': 'Pfizer', 'relationship_type': ['Consultant', 'Honorarium']}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'author_channel'
+    }
+]
+
+# The same entities and author, spelled differently by the model
+VARIANT_RESULTS = [
+    {
+        'id': 0,
+        'source': {'title': 'Vaccine Trial', 'disclosure': 'Dr. Smith consults for Pfizer.',
+                   'authors': ['Dr. John Smith'], 'affiliation': ['McGill'], 'email': ['john@mcgill.ca']},
+        'payload': {'author_info': [
+            {'author_name': 'Dr. John Smith', 'organization': [
+                {'org_name': 'Pfizer Inc.', 'relationship_type': ['Consultant']}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'author_channel'
+    },
+    {
+        'id': 1,
+        'source': {'title': 'Vaccine Trial 2', 'disclosure': 'John Smith consults for Pfizer and Merck & Co.',
+                   'authors': ['John Smith'], 'affiliation': ['McGill University'], 'email': ['John@McGill.ca']},
+        'payload': {'author_info': [
+            {'author_name': 'John Smith, PhD', 'organization': [
+                {'org_name': 'PFIZER', 'relationship_type': ['Consultant']},
+                {'org_name': 'Merck and Co', 'relationship_type': ['Honorarium']}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'author_channel'
+    }
+]
+
+
+def test_study_builder():
+    builder = StudyResultsBuilder()
+    for result in STUDY_RESULTS:
+        builder.add(result)
+    df_source, df_ent, df_rel_type, df_results = builder.tables()
+    assert df_source['id'].tolist() == [0, 1, 2]
+    assert df_ent.values.tolist() == [['ent-0', 'National Cancer Institute', 'Unlikely'], ['ent-1', 'Pfizer', 'Likely']]
+    assert df_rel_type['relationship_type'].tolist() == ['Fund the study', 'Design the study', 'Support the study']
+    assert df_results.values.tolist() == [
+        ['res_0', 0, 'ent-0', 'rel-0', 'Yes'],
+        ['res_1', 0, 'ent-0', 'rel-1', 'No'],
+        ['res_2', 1, 'ent-1', 'rel-0', 'Yes'],
+        ['res_3', 1, 'ent-0', 'rel-2', 'Yes']
+    ]
+
+
+def test_author_builder():
+    builder = AuthorResultsBuilder()
+    for result in AUTHOR_RESULTS:
+        builder.add(result)
+    df_source, df_ent, df_author, df_rel_type, df_results = builder.tables()
+    assert df_author.values.tolist() == [['author-0', 'Dr. John Smith', 'McGill', 'john@mcgill.ca']]
+    assert df_results.values.tolist() == [
+        ['res_0', 0, 'ent-0', 'author-0', 'rel-0'],
+        ['res_1', 0, 'ent-0', 'author-0', 'rel-1']
+    ]
+
+
+def test_builder_canonicalizes():
+    builder = AuthorResultsBuilder()
+    for result in VARIANT_RESULTS:
+        builder.add(result)
+    df_source, df_ent, df_author, df_rel_type, df_results = builder.tables()
+    assert df_ent['org_name'].tolist() == ['Pfizer Inc.', 'Merck and Co']
+    assert df_author.values.tolist() == [['author-0', 'Dr. John Smith', 'McGill', 'john@mcgill.ca']]
+    assert df_results['entity'].tolist() == ['ent-0', 'ent-0', 'ent-1']
+
+
+def assert_same_tables(tables, expected_tables):
+    for df, expected in zip(tables, expected_tables):
+        assert df.columns.tolist() == expected.columns.tolist()
+        assert df.astype(object).values.tolist() == expected.astype(object).values.tolist()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('results', [STUDY_RESULTS, STUDY_RESULTS[2:], []])
+async def test_postprocess_study_matches_builder(results):
+    builder = StudyResultsBuilder()
+    for result in results:
+        builder.add(result)
+    assert_same_tables(await server.postprocess_study_results(results), builder.tables())
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('results', [AUTHOR_RESULTS, VARIANT_RESULTS, []])
+async def test_postprocess_author_matches_builder(results):
+    builder = AuthorResultsBuilder()
+    for result in results:
+        builder.add(result)
+    assert_same_tables(await server.postprocess_author_results(results), builder.tables())
+
+
+def test_funding_support():
+    org_names = ['Pfizer', 'National Cancer Institute', 'NIH', 'nih', 'The NIH Foundation', 'Support (CDC)',
+                 'EPAX Labs', 'Health Canada', 'Gates Foundation', 'Université de Montréal', 'Bürogemeinschaft',
+                 'N/A', ' N/A ', 'n/a', '  Merck & Co.  ', 'Centers for Disease Control and Prevention', 'Straße AG',
+                 'Fundação Oswaldo Cruz', 'Unionville Pharma', '']
+    assert funding_support(org_names).tolist() == [_infer_is_funded(org_name) for org_name in org_names]
+    assert funding_support([]).tolist() == []
@@ -3,47 +3,95 @@ import json
 import os
 from pathlib import Path
 
-import aioredis
+import redis.asyncio as redis
 import pytest
 
 import server
 import pandas as pd
+from scheduling import PRIORITIES, SessionQueue, check_priority
+
+DISCLOSURE = ("The author declares no conflict of interest. This research was funded by the National Cancer Institute. "
+              "No financial or non-financial competing interests are reported.")
 
 @pytest.fixture
 def test_df():
     resource_path = Path(__file__).parent / 'resources' / 'data.csv'
-    return pd.read_csv(resource_path)
+    return pd.read_csv(resource_path, sep='\t')
 
 @pytest.fixture
 async def redisdb():
     redis_host = os.getenv('REDIS_HOST', 'localhost')
     redis_port = os.getenv('REDIS_PORT', 6379)
-    return await aioredis.from_url(f"redis://{redis_host}:{redis_port}")
+    return await redis.from_url(f"redis://{redis_host}:{redis_port}")
 
 @pytest.mark.asyncio
 async def test_publish_author(redisdb, monkeypatch, test_df):
     channel_name = 'author_channel'
     monkeypatch.setattr(server, 'redis_client', redisdb)
-    pubsub = redisdb.pubsub()
-    await pubsub.subscribe(channel_name)
-    await asyncio.sleep(1)
-    await pubsub.get_message()
-    await server.publish_infos(test_df, channel_name)
-    await asyncio.sleep(1)
-    message = await pubsub.get_message()
-    exp_data = {"authors": ["Dr. John Smith", "Dr. Emily Johnson"], "disclosure": "The author declares no conflict of interest. This research was funded by the National Cancer Institute. No financial or non-financial competing interests are reported."}
-    assert json.loads(message['data'].decode('utf-8')) == exp_data
+    await redisdb.delete(channel_name)
+    tasks, _ = await server.publish_infos(test_df, channel_name)
+    await asyncio.gather(*tasks)
+    entries = await redisdb.xrange(channel_name)
+    assert len(entries) == 1
+    exp_data = {"authors": ["Dr. John Smith", "Dr. Emily Johnson"], "disclosure": DISCLOSURE,
+                "title": "Advances in Cancer Immunotherapy",
+                "affiliation": ["McGill University", "University of Toronto"],
+                "email": ["john.smith@mcgill.ca", "emily.johnson@utoronto.ca"]}
+    assert json.loads(entries[0][1][b'data'].decode('utf-8'))['payload'] == exp_data
 
 @pytest.mark.asyncio
 async def test_publish_study(redisdb, monkeypatch, test_df):
     channel_name = 'study_channel'
     monkeypatch.setattr(server, 'redis_client', redisdb)
-    pubsub = redisdb.pubsub()
-    await pubsub.subscribe(channel_name)
-    await asyncio.sleep(1)
-    await pubsub.get_message()
-    await server.publish_infos(test_df, channel_name)
-    await asyncio.sleep(1)
-    message = await pubsub.get_message()
-    exp_data = {"disclosure": "The author declares no conflict of interest. This research was funded by the National Cancer Institute. No financial or non-financial competing interests are reported."}
-    assert json.loads(message['data'].decode('utf-8')) == exp_data
\ No newline at end of file
+    await redisdb.delete(channel_name)
+    tasks, _ = await server.publish_infos(test_df, channel_name)
+    await asyncio.gather(*tasks)
+    entries = await redisdb.xrange(channel_name)
+    exp_data = {"disclosure": DISCLOSURE, "title": "Advances in Cancer Immunotherapy"}
+    assert json.loads(entries[0][1][b'data'].decode('utf-8'))['payload'] == exp_data
+
+@pytest.mark.asyncio
+async def test_publish_in_chunks(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    monkeypatch.setattr(server, 'PUBLISH_CHUNK_SIZE', 4)
+    await redisdb.delete('study_channel')
+    df = pd.DataFrame({
+        'Title': [f'Title {i // 2}' for i in range(20)],
+        'Author Name': [f'Author {i}' for i in range(20)],
+        'Affiliation': [''] * 20,
+        'Email': [''] * 20,
+        'Disclosure Statement': [f'Disclosure {i // 2}' for i in range(20)]
+    })
+    tasks, data_ids = await server.publish_infos(df, 'study_channel', 'session')
+    # One pipeline per chunk of 4 jobs
+    assert len(tasks) == 3
+    await asyncio.gather(*tasks)
+    assert data_ids == list(range(10))
+    entries = await redisdb.xrange('study_channel')
+    assert json.loads(entries[0][1][b'data']) == {
+        'id': 0,
+        'payload': {'disclosure': 'Disclosure 0', 'title': 'Title 0'},
+        'channel': 'study_channel',
+        'session_id': 'session'
+    }
+    assert len(entries) == 10
+
+@pytest.mark.asyncio
+async def test_session_queue(redisdb):
+    channel_name = 'fair_channel'
+    await redisdb.delete(channel_name, 'jobs:fair_channel:first', 'jobs:fair_channel:second', 'backlog:fair_channel',
+                         'weights:fair_channel', *(f'schedule:fair_channel:{priority}' for priority in PRIORITIES))
+    first = SessionQueue(redisdb, 'first', window=2)
+    # Jobs go straight to the stream while it has room and no session is queued
+    assert await first.enqueue(channel_name, [b'1', b'2', b'3']) == 2
+    assert await redisdb.xlen(channel_name) == 2
+    assert await redisdb.lrange('jobs:fair_channel:first', 0, -1) == [b'3']
+    await redisdb.xtrim(channel_name, maxlen=0)
+    # Once a session is queued, the others queue behind it even if the stream has room
+    second = SessionQueue(redisdb, 'second', 'high', 2.0, window=2)
+    assert await second.enqueue(channel_name, [b'4']) == 0
+    assert await redisdb.zrange('schedule:fair_channel:high', 0, -1) == [b'second']
+    assert await redisdb.hget('weights:fair_channel', 'second') == b'2.0'
+    assert await redisdb.get('backlog:fair_channel') == b'2'
+    with pytest.raises(ValueError):
+        check_priority('urgent', 1.0)
@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+
+import pytest
+import redis.asyncio as redis
+
+import server
+from store import ResultStore
+
+
+def study_result(data_id, org_names):
+    return {
+        'id': data_id,
+        'source': {'title': f'Title {data_id}', 'disclosure': 'Funded by ' + ' and '.join(org_names)},
+        'payload': {'study_info': [
+            {'org_name': org_name, 'relationships': [
+                {'relationship_type': 'Fund the study', 'relationship_indication': 'Yes'}
+            ]} for org_name in org_names
+        ]},
+        'error': None,
+        'channel': 'study_channel'
+    }
+
+
+def author_result(data_id, org_name):
+    return {
+        'id': data_id,
+        'source': {'title': f'Title {data_id}', 'disclosure': f'Dr. Smith consults for {org_name}.',
+                   'authors': ['Dr. John Smith'], 'affiliation': ['McGill'], 'email': ['john@mcgill.ca']},
+        'payload': {'author_info': [
+            {'author_name': 'Dr. John Smith', 'organization': [
+                {'org_name': org_name, 'relationship_type': ['Consultant']}
+            ]}
+        ]},
+        'error': None,
+        'channel': 'author_channel'
+    }
+
+
+@pytest.fixture
+async def redisdb():
+    redis_host = os.getenv('REDIS_HOST', 'localhost')
+    redis_port = os.getenv('REDIS_PORT', 6379)
+    return await redis.from_url(f"redis://{redis_host}:{redis_port}")
+
+
+def test_store_across_sessions():
+    store = ResultStore(':memory:')
+    store.add('session-a', [study_result(0, ['Pfizer', 'National Cancer Institute']), author_result(0, 'Pfizer')])
+    store.add('session-b', [study_result(0, ['Pfizer'])])
+    # Replayed results are ignored
+    store.add('session-a', [study_result(0, ['Pfizer', 'National Cancer Institute'])])
+    entities = store.entities()
+    assert [(entity['org_name'], entity['papers']) for entity in entities] == \
+           [('Pfizer', 2), ('National Cancer Institute', 1)]
+    assert [entity['org_name'] for entity in store.entities('pfi')] == ['Pfizer']
+    studies = store.entity_study_results(entities[0]['ent_id'])
+    assert [(study['session_id'], study['title']) for study in studies] == [('session-a', 'Title 0'),
+                                                                             ('session-b', 'Title 0')]
+    [author] = store.authors('Dr. J')
+    assert (author['affiliation'], author['papers']) == ('McGill', 1)
+    [relationship] = store.author_entity_results(author['author_id'])
+    assert (relationship['org_name'], relationship['relationship_type']) == ('Pfizer', 'Consultant')
+
+
+def test_store_canonicalizes(tmp_path):
+    path = str(tmp_path / 'results.db')
+    store = ResultStore(path)
+    store.add('session-a', [study_result(0, ['Pfizer Inc.']), author_result(0, 'Pfizer')])
+    store.close()
+    # Names are matched with the entities stored by earlier runs
+    store = ResultStore(path)
+    store.add('session-b', [study_result(0, ['PFIZER']), author_result(0, 'The Pfizer Company')])
+    [entity] = store.entities()
+    assert (entity['org_name'], entity['papers']) == ('Pfizer Inc.', 2)
+    [author] = store.authors()
+    assert author['papers'] == 2
+
+
+def test_store_pages():
+    store = ResultStore(':memory:')
+    store.add('session-a', [study_result(i, [f'Org {i}']) for i in range(5)])
+    first = store.entities(limit=2)
+    second = store.entities(after=first[-1]['ent_id'], limit=2)
+    assert [entity['org_name'] for entity in first + second] == ['Org 0', 'Org 1', 'Org 2', 'Org 3']
+    # Wildcards in the name are matched literally
+    assert store.entities('Org_') == []
+
+
+async def add_session(redisdb):
+    await redisdb.delete('session-s', 'result:session-s', server.export_key('session-s'))
+    await redisdb.hset('session-s', 'total_message', '2')
+    await redisdb.sadd(server.STORING_KEY, 'session-s')
+    result = dict(study_result(0, ['Pfizer']), session_id='session-s')
+    await redisdb.xadd('result:session-s', {'data': json.dumps(result)})
+    await redisdb.xadd('result:session-s', {'data': json.dumps(dict(author_result(0, 'Pfizer'),
+                                                                    session_id='session-s'))})
+
+
+@pytest.mark.asyncio
+async def test_persist_session(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    monkeypatch.setattr(server, 'result_store', ResultStore(':memory:'))
+    await add_session(redisdb)
+    # No client follows the session on /events
+    await server.persist_session('session-s', 2)
+    assert not await redisdb.sismember(server.STORING_KEY, 'session-s')
+    page = await server.list_entities(None, 0, 1)
+    assert [entity['org_name'] for entity in page['items']] == ['Pfizer']
+    assert page['next'] == page['items'][0]['ent_id']
+    page = await server.entity_authors(page['next'], 0, 50)
+    assert [relationship['author_name'] for relationship in page['items']] == ['Dr. John Smith']
+    assert page['next'] is None
+    await redisdb.delete('session-s', 'result:session-s', server.export_key('session-s'))
+
+
+@pytest.mark.asyncio
+async def test_persist_session_retries(redisdb, monkeypatch):
+    monkeypatch.setattr(server, 'redis_client', redisdb)
+    monkeypatch.setattr(server, 'STORE_RETRY_SECONDS', 0)
+    store = ResultStore(':memory:')
+    add = store.add
+    calls = []
+
+    def add_once_failing(session_id, results):
+        calls.append(len(results))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        add(session_id, results)
+
+    monkeypatch.setattr(store, 'add', add_once_failing)
+    monkeypatch.setattr(server, 'result_store', store)
+    await add_session(redisdb)
+    await server.persist_session('session-s', 2)
+    assert calls == [2, 2]
+    assert [entity['org_name'] for entity in store.entities()] == ['Pfizer']
+    await redisdb.delete('session-s', 'result:session-s', server.export_key('session-s'))